@@ -14,4 +14,4 @@ JISC Research Data Shared Service : Format Indentification and analysis.
 
 Initialisation module for package, kicks of the flask app.
 """
-from .corptest import APP
+from .corptest import APP, init_app
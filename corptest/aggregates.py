@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""
+Aggregate analyses of SourceIndex contents.
+
+Aggregates are plain, JSON serialisable dictionaries. Once an index is complete
+its aggregates are stored in the IndexAggregate table against the index's
+version tag so they're only computed once.
+"""
+import collections
+import json
+
+from sqlalchemy import and_, func
+from sqlalchemy.orm import aliased
+
+from .database import DB_SESSION
+from .model_sources import FormatTool, FormatToolRelease, IndexAggregate, Key
+from .model_properties import ByteSequenceProperty, Property, PropertyValue
+from .utilities import check_param_not_none
+
+DISAGREEMENT_PROPERTIES = ('MIME', 'PUID')
+SIZE_PERCENTILES = (10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99)
+
+def cached_aggregate(source_index, name, compute):
+    """Return the aggregate compute(source_index), from the IndexAggregate
+    table if it was stored for the index's current version. Aggregates of
+    incomplete indexes are computed on every call and never stored."""
+    check_param_not_none(source_index, "source_index")
+    if not source_index.is_complete:
+        return compute(source_index)
+    version_tag = source_index.version_tag
+    aggregate = IndexAggregate.by_index_and_name(source_index, name)
+    if aggregate is not None and aggregate.version_tag == version_tag:
+        return json.loads(aggregate.value)
+    value = json.dumps(compute(source_index))
+    IndexAggregate.putdate(source_index, name, version_tag, value)
+    return json.loads(value)
+
+def release_names():
+    """Return a dict of FormatToolRelease id, as a string, to tool name and version."""
+    query = DB_SESSION.query(FormatToolRelease.id, FormatTool.name, FormatToolRelease.version).\
+        join(FormatToolRelease.format_tool)
+    return dict((str(release_id), '{} {}'.format(name, version))
+                for release_id, name, version in query)
+
+def _cell_aliases():
+    return aliased(ByteSequenceProperty, name='prop_a'), \
+        aliased(ByteSequenceProperty, name='prop_b')
+
+def disagreement_matrix(source_index, prop_name):
+    """Cross tabulates the prop_name values reported by every pair of tool
+    releases for the keys of source_index, in a single grouped query joining
+    the byte sequence properties of each key to themselves. Returns a dict:
+      - property: prop_name;
+      - tools: release id to release name, see release_names(); and
+      - pairs: a list with an entry per pair of releases holding the release
+        ids, the agreed and disagreed [count, size] totals and cells, a list
+        of the distinct value pairs with their key count and total size, most
+        common first.
+    Only keys that both tools of a pair gave a result for are counted."""
+    check_param_not_none(source_index, "source_index")
+    prop_a, prop_b = _cell_aliases()
+    val_a = aliased(PropertyValue, name='val_a')
+    val_b = aliased(PropertyValue, name='val_b')
+    query = DB_SESSION.query(prop_a.format_tool_release_id, prop_b.format_tool_release_id,
+                             val_a.id, val_a.value, val_b.id, val_b.value,
+                             func.count(Key.id), func.sum(Key.size)).\
+        select_from(Key).\
+        join(prop_a, prop_a.byte_sequence_id == Key.byte_sequence_id).\
+        join(prop_b, and_(prop_b.byte_sequence_id == Key.byte_sequence_id,
+                          prop_b.prop_id == prop_a.prop_id,
+                          prop_b.format_tool_release_id > prop_a.format_tool_release_id)).\
+        join(Property, Property.id == prop_a.prop_id).\
+        join(val_a, val_a.id == prop_a.prop_val_id).\
+        join(val_b, val_b.id == prop_b.prop_val_id).\
+        filter(Key.source_index_id == source_index.id).\
+        filter(Property.name == prop_name).\
+        group_by(prop_a.format_tool_release_id, prop_b.format_tool_release_id,
+                 val_a.id, val_a.value, val_b.id, val_b.value)
+    pairs = {}
+    for release_a, release_b, id_a, value_a, id_b, value_b, count, size in query:
+        pair = pairs.get((release_a, release_b))
+        if pair is None:
+            pair = {'releases': [release_a, release_b], 'agreed': [0, 0],
+                    'disagreed': [0, 0], 'cells': []}
+            pairs[(release_a, release_b)] = pair
+        agree = id_a == id_b
+        totals = pair['agreed'] if agree else pair['disagreed']
+        totals[0] += count
+        totals[1] += size
+        pair['cells'].append({'a_value_id': id_a, 'a_value': value_a,
+                              'b_value_id': id_b, 'b_value': value_b,
+                              'count': count, 'size': size, 'agree': agree})
+    for pair in pairs.values():
+        pair['cells'].sort(key=lambda cell: (-cell['count'], cell['a_value'], cell['b_value']))
+    return {
+        'property': prop_name,
+        'tools': release_names(),
+        'pairs': [pairs[key] for key in sorted(pairs)]
+    }
+
+def cached_disagreement_matrix(source_index, prop_name):
+    """Return disagreement_matrix(source_index, prop_name) via cached_aggregate."""
+    return cached_aggregate(source_index, 'disagreements_' + prop_name,
+                            lambda index: disagreement_matrix(index, prop_name))
+
+def keys_for_cell(source_index, prop_name, release_a, release_b, value_a_id, value_b_id):
+    """Return a query for the keys of source_index, in path order, where
+    release_a reported the value with id value_a_id and release_b value_b_id
+    for the property prop_name, i.e. the keys counted in a matrix cell."""
+    check_param_not_none(source_index, "source_index")
+    prop_a, prop_b = _cell_aliases()
+    return Key.query.\
+        join(prop_a, prop_a.byte_sequence_id == Key.byte_sequence_id).\
+        join(prop_b, and_(prop_b.byte_sequence_id == Key.byte_sequence_id,
+                          prop_b.prop_id == prop_a.prop_id)).\
+        join(Property, Property.id == prop_a.prop_id).\
+        filter(Key.source_index_id == source_index.id).\
+        filter(Property.name == prop_name).\
+        filter(prop_a.format_tool_release_id == release_a).\
+        filter(prop_b.format_tool_release_id == release_b).\
+        filter(prop_a.prop_val_id == value_a_id).\
+        filter(prop_b.prop_val_id == value_b_id).\
+        order_by(Key.path)
+
+def size_statistics(sizes):
+    """Returns a dict of statistics for a NumPy array of sizes in bytes: count,
+    total, min, max, mean, percentiles, a dict of SIZE_PERCENTILES to size, and
+    histogram, a list of [min, max, count, total] power of two size buckets.
+    Bucket 0 holds empty files, bucket n > 0 sizes from 2**(n-1) to 2**n - 1."""
+    import numpy as np
+    if not sizes.size:
+        return {'count': 0, 'total': 0, 'min': None, 'max': None, 'mean': None,
+                'percentiles': {}, 'histogram': []}
+    # frexp exponents are floor(log2(size)) + 1 for sizes > 0 and 0 for 0
+    buckets = np.frexp(sizes.astype(np.float64))[1]
+    counts = np.bincount(buckets)
+    totals = np.bincount(buckets, weights=sizes)
+    percentiles = np.percentile(sizes, SIZE_PERCENTILES)
+    return {
+        'count': int(sizes.size),
+        'total': int(sizes.sum()),
+        'min': int(sizes.min()),
+        'max': int(sizes.max()),
+        'mean': float(sizes.mean()),
+        'percentiles': dict((str(centile), float(value))
+                            for centile, value in zip(SIZE_PERCENTILES, percentiles)),
+        'histogram': [[0 if bucket == 0 else 2 ** (bucket - 1), 2 ** bucket - 1,
+                       int(counts[bucket]), int(totals[bucket])]
+                      for bucket in range(len(counts))]
+    }
+
+def size_distribution(source_index, prop_name='MIME'):
+    """Computes size_statistics for all of the keys in source_index and for the
+    keys of each prop_name value reported by each tool release, pulling the key
+    sizes in one bulk query per grouping. Returns a dict:
+      - property: prop_name;
+      - tools: release id to release name, see release_names();
+      - overall: the statistics for the whole index; and
+      - formats: a list of dicts with release, value and statistics entries,
+        one per release and value, most common first."""
+    import numpy as np
+    check_param_not_none(source_index, "source_index")
+    sizes = np.array(DB_SESSION.query(Key.size).\
+                     filter(Key.source_index_id == source_index.id).all(),
+                     dtype=np.int64).reshape(-1)
+    rows = np.array(DB_SESSION.query(ByteSequenceProperty.format_tool_release_id,
+                                     ByteSequenceProperty.prop_val_id, Key.size).\
+                    select_from(Key).\
+                    join(ByteSequenceProperty,
+                         ByteSequenceProperty.byte_sequence_id == Key.byte_sequence_id).\
+                    join(Property, Property.id == ByteSequenceProperty.prop_id).\
+                    filter(Key.source_index_id == source_index.id).\
+                    filter(Property.name == prop_name).all(),
+                    dtype=np.int64).reshape(-1, 3)
+    formats = []
+    if rows.size:
+        # Sort rows by release then value so each group is a contiguous slice
+        order = np.lexsort((rows[:, 1], rows[:, 0]))
+        rows = rows[order]
+        starts = np.flatnonzero(np.any(np.diff(rows[:, :2], axis=0), axis=1)) + 1
+        values = dict(DB_SESSION.query(PropertyValue.id, PropertyValue.value).\
+                      filter(PropertyValue.id.in_(set(rows[:, 1].tolist()))))
+        for group in np.split(rows, starts):
+            formats.append({'release': int(group[0, 0]),
+                            'value': values[int(group[0, 1])],
+                            'statistics': size_statistics(group[:, 2])})
+        formats.sort(key=lambda entry: (-entry['statistics']['count'], entry['value']))
+    return {
+        'property': prop_name,
+        'tools': release_names(),
+        'overall': size_statistics(sizes),
+        'formats': formats
+    }
+
+def cached_size_distribution(source_index, prop_name='MIME'):
+    """Return size_distribution(source_index, prop_name) via cached_aggregate."""
+    return cached_aggregate(source_index, 'sizes_' + prop_name,
+                            lambda index: size_distribution(index, prop_name))
+
+def _release_with_most_results(source_index, prop_name):
+    """Return the id of the tool release that reported prop_name for the most
+    keys of source_index, or None if none did."""
+    count = func.count(Key.id)
+    row = DB_SESSION.query(ByteSequenceProperty.format_tool_release_id, count).\
+        select_from(Key).\
+        join(ByteSequenceProperty,
+             ByteSequenceProperty.byte_sequence_id == Key.byte_sequence_id).\
+        join(Property, Property.id == ByteSequenceProperty.prop_id).\
+        filter(Key.source_index_id == source_index.id).\
+        filter(Property.name == prop_name).\
+        group_by(ByteSequenceProperty.format_tool_release_id).\
+        order_by(count.desc(), ByteSequenceProperty.format_tool_release_id).first()
+    return row[0] if row else None
+
+def group_breakdown(source_index, prop_name='PUID', release_id=None):
+    """Breaks down the keys of source_index by their stored group, see
+    KeyGrouper, using two grouped queries on the (source_index_id, group)
+    index. The format mix of each group is the prop_name values reported by
+    the tool release release_id, defaulting to the release with most results.
+    Returns a dict:
+      - property: prop_name;
+      - release: the release id used for the format mix, or None;
+      - tools: release id to release name, see release_names(); and
+      - groups: a list of dicts with group, count, size and formats, a list of
+        [value, count, size] lists, largest first."""
+    check_param_not_none(source_index, "source_index")
+    if release_id is None:
+        release_id = _release_with_most_results(source_index, prop_name)
+    # Grouped on the raw column so the index is used, keys without a group
+    # are NULL or '' and are merged here
+    groups = collections.OrderedDict()
+    query = DB_SESSION.query(Key.group, func.count(Key.id), func.sum(Key.size)).\
+        filter(Key.source_index_id == source_index.id).\
+        group_by(Key.group).order_by(Key.group)
+    for group, count, size in query:
+        group = group or ''
+        entry = groups.setdefault(group, {'group': group, 'count': 0, 'size': 0,
+                                          'formats': []})
+        entry['count'] += count
+        entry['size'] += size if size else 0
+    if release_id is not None:
+        count = func.count(Key.id)
+        query = DB_SESSION.query(Key.group, PropertyValue.value, count, func.sum(Key.size)).\
+            select_from(Key).\
+            join(ByteSequenceProperty,
+                 ByteSequenceProperty.byte_sequence_id == Key.byte_sequence_id).\
+            join(Property, Property.id == ByteSequenceProperty.prop_id).\
+            join(PropertyValue, PropertyValue.id == ByteSequenceProperty.prop_val_id).\
+            filter(Key.source_index_id == source_index.id).\
+            filter(Property.name == prop_name).\
+            filter(ByteSequenceProperty.format_tool_release_id == release_id).\
+            group_by(Key.group, PropertyValue.value)
+        formats = collections.defaultdict(dict)
+        for group, value, value_count, size in query:
+            merged = formats[group or ''].setdefault(value, [value, 0, 0])
+            merged[1] += value_count
+            merged[2] += size if size else 0
+        for group, values in formats.items():
+            groups[group]['formats'] = sorted(values.values(),
+                                              key=lambda fmt: (-fmt[1], fmt[0]))
+    return {
+        'property': prop_name,
+        'release': release_id,
+        'tools': release_names(),
+        'groups': sorted(groups.values(), key=lambda group: -group['size'])
+    }
+
+def cached_group_breakdown(source_index, prop_name='PUID', release_id=None):
+    """Return group_breakdown(source_index, prop_name, release_id) via cached_aggregate."""
+    return cached_aggregate(source_index, 'groups_{}_{}'.format(prop_name, release_id),
+                            lambda index: group_breakdown(index, prop_name, release_id))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""
+Managed store for generated report artefacts, e.g. PDF reports.
+
+Artefacts live beneath <root>/<index id>/ named after the index version tag
+and the artefact's extension. An artefact is only regenerated when the index's
+version tag changes and the store is kept under a byte quota by evicting the
+least recently used artefacts.
+"""
+import logging
+import os
+import os.path
+import tempfile
+import threading
+
+from .corptest import APP
+from .database import DB_SESSION
+from .model_sources import SourceIndex
+from .utilities import check_param_not_none, create_dirs
+
+RDSS_ROOT = APP.config.get('RDSS_ROOT')
+ARTEFACT_ROOT = os.path.join(RDSS_ROOT, 'artefacts')
+
+class ArtefactStore(object):
+    """Disk store of report artefacts keyed by SourceIndex id and version,
+    artefacts are generated by background threads."""
+    def __init__(self, root, quota):
+        check_param_not_none(root, "root")
+        self.__root = root
+        self.__quota = quota
+        self.__lock = threading.Lock()
+        self.__generating = set()
+
+    @property
+    def root(self):
+        """Return the root directory of the artefact store."""
+        return self.__root
+
+    @property
+    def quota(self):
+        """Return the maximum size in bytes of the artefact store."""
+        return self.__quota
+
+    @property
+    def size(self):
+        """Return the total size in bytes of all stored artefacts."""
+        return sum(size for _, size, _ in self._artefacts())
+
+    def artefact_path(self, source_index, ext):
+        """Return the path of the artefact for the current version of source_index."""
+        return os.path.join(self.__root, str(source_index.id),
+                            '{}.{}'.format(source_index.version_tag, ext))
+
+    def is_generating(self, source_index, ext):
+        """Return True if the artefact is currently being generated."""
+        with self.__lock:
+            return self.artefact_path(source_index, ext) in self.__generating
+
+    def get(self, source_index, ext):
+        """Return the path to the current artefact, or None if it hasn't been
+        generated yet. Touches the artefact so that it counts as recently used."""
+        path = self.artefact_path(source_index, ext)
+        if not os.path.isfile(path):
+            return None
+        os.utime(path, None)
+        return path
+
+    def get_or_generate(self, source_index, ext, generator):
+        """Return the path of the current artefact if there is one, otherwise
+        start a background thread that calls generator(source_index, path) to
+        create it and return None. Only one generation runs per artefact."""
+        path = self.get(source_index, ext)
+        if path is not None:
+            return path
+        path = self.artefact_path(source_index, ext)
+        with self.__lock:
+            if path in self.__generating:
+                return None
+            self.__generating.add(path)
+        thread = threading.Thread(target=self._generate,
+                                  args=(source_index.id, ext, path, generator))
+        thread.daemon = True
+        thread.start()
+        return None
+
+    def _generate(self, source_index_id, ext, path, generator):
+        """Thread target, generates an artefact to a temp file in the index's
+        artefact directory and renames it into place so readers never see a
+        partial artefact."""
+        try:
+            directory = os.path.dirname(path)
+            create_dirs(directory)
+            source_index = SourceIndex.by_id(source_index_id)
+            temp_fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            os.close(temp_fd)
+            try:
+                generator(source_index, temp_path)
+                os.rename(temp_path, path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            logging.info("Generated artefact %s", path)
+            self._remove_stale(directory, path, ext)
+            self.evict(keep=path)
+        except Exception: # pylint: disable-msg=W0703
+            logging.exception("Failed to generate artefact %s", path)
+        finally:
+            DB_SESSION.remove()
+            with self.__lock:
+                self.__generating.discard(path)
+
+    @staticmethod
+    def _remove_stale(directory, current, ext):
+        """Remove artefacts of the same type made from earlier index versions."""
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if path != current and name.endswith('.' + ext):
+                os.remove(path)
+
+    def _artefacts(self):
+        """Generator of (path, size, last used) tuples for all stored artefacts."""
+        if not os.path.isdir(self.__root):
+            return
+        for index_dir in os.listdir(self.__root):
+            directory = os.path.join(self.__root, index_dir)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                yield path, stat.st_size, stat.st_mtime
+
+    def evict(self, keep=None):
+        """Remove least recently used artefacts until the store is within quota,
+        the artefact at path keep is never evicted."""
+        artefacts = sorted(self._artefacts(), key=lambda artefact: artefact[2])
+        total = sum(size for _, size, _ in artefacts)
+        for path, size, _ in artefacts:
+            if total <= self.__quota:
+                break
+            if path == keep:
+                continue
+            logging.info("Evicting artefact %s, %d bytes", path, size)
+            os.remove(path)
+            total -= size
+
+ARTEFACTS = ArtefactStore(ARTEFACT_ROOT, APP.config.get('ARTEFACT_QUOTA'))
@@ -10,34 +10,68 @@
 # about the terms of this license.
 # http://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
 """Classes for binary object store"""
+from argparse import ArgumentParser, RawTextHelpFormatter
+import binascii
 import collections
+from contextlib import closing
 import errno
+import hashlib
 import logging
 import os.path
+import sqlite3
+import stat
+import threading
+import time
+import uuid
 
-from .utilities import check_param_not_none, sha1_path, sha1_copy_by_path
-from .utilities import only_files, create_dirs
+from .utilities import check_param_not_none, sha1_path, copy_file
+from .utilities import create_dirs
+from .const import EPILOG
 from .corptest import APP
+from .metrics import METRICS
 from .model_sources import ByteSequence
 
 RDSS_ROOT = APP.config.get('RDSS_ROOT')
+BLOB_STORE_FAN_OUT = APP.config.get('BLOB_STORE_FAN_OUT')
+
+BLOB_LOOKUPS = METRICS.counter('corptest_blobstore_lookups_total',
+                               'BlobStore lookups by result, hit or miss.', ('result',))
+BLOB_EVICTED_BYTES = METRICS.counter('corptest_blobstore_evicted_bytes_total',
+                                     'Bytes evicted from the BlobStore to keep within quota.')
 
 class Sha1Lookup(object): # pragma: no cover
-    """ Look up class for serialsed sha1sum() results. """
+    """ Look up class for serialsed sha1sum() results, loaded from the default
+    source path on first use unless initialise() has been called. """
     sha1_lookup = collections.defaultdict(dict)
+    __loaded = False
+    __lock = threading.Lock()
 
     @classmethod
     def initialise(cls, source_path=os.path.join(RDSS_ROOT, 'blobstore-sha1s.txt')):
         """ Clear and load the lookup table from the supplied or default source_path. """
-        cls.sha1_lookup.clear()
-        if os.path.isfile(source_path):
-            cls._update_lookup_from_path(source_path)
+        with cls.__lock:
+            cls.sha1_lookup.clear()
+            if os.path.isfile(source_path):
+                cls._update_lookup_from_path(source_path)
+            cls.__loaded = True
 
     @classmethod
     def get_sha1(cls, etag):
         """ Retrieve and return a hex SHA1 value by etag. """
+        cls.__ensure_loaded()
         return cls.sha1_lookup.get(etag, None)
 
+    @classmethod
+    def add(cls, etag, sha1):
+        """ Record the hex SHA1 value of the object with etag. """
+        cls.__ensure_loaded()
+        cls.sha1_lookup.update({etag : sha1})
+
+    @classmethod
+    def __ensure_loaded(cls):
+        if not cls.__loaded:
+            cls.initialise()
+
     @classmethod
     def _update_lookup_from_path(cls, source_path):
         with open(source_path) as src_file:
@@ -47,58 +81,461 @@ class Sha1Lookup(object): # pragma: no cover
                 sha1 = parts[0]
                 cls.sha1_lookup.update({etag : sha1})
 
+class BlobIndex(object):
+    """ Compact in memory index of the SHA1s and sizes of the blobs in a store.
+    Digests are held as a sorted array of 20 byte strings with a parallel array
+    of sizes, 28 bytes a blob, and searched by bisection. Blobs added since the
+    arrays were built are kept in a small dictionary that's merged into the
+    arrays once it reaches MERGE_THRESHOLD entries, removed blobs are marked
+    with a size of -1 until then. The arrays and dictionary are replaced
+    together in a single assignment so lookups, which take no lock, always see
+    a consistent set while changes are serialised by the store. """
+    MERGE_THRESHOLD = 4096
+
+    def __init__(self, digests=None, sizes=None):
+        import numpy as np
+        # (digests, sizes, added) where added maps digest to size
+        self.__state = (np.array([], dtype='S20') if digests is None else digests,
+                        np.array([], dtype=np.int64) if sizes is None else sizes, {})
+        self.__removed = 0
+        self.__total = int(self.__state[1].sum())
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Build an index from an iterable of (20 byte digest, size) rows sorted
+        by digest, as returned by BlobManifest.rows(). """
+        import numpy as np
+        digests = []
+        sizes = []
+        for digest, size in rows:
+            digests.append(bytes(digest))
+            sizes.append(size)
+        return cls(np.array(digests, dtype='S20'), np.array(sizes, dtype=np.int64))
+
+    def __len__(self):
+        digests, _, added = self.__state
+        return len(digests) - self.__removed + len(added)
+
+    def __contains__(self, sha1):
+        return self.get_size(sha1) is not None
+
+    def __iter__(self):
+        digests, sizes, added = self.__state
+        for digest, size in zip(digests, sizes):
+            if size < 0:
+                continue
+            # NumPy strips trailing null bytes from fixed width strings
+            yield binascii.hexlify(digest.ljust(20, b'\0')).decode('ascii')
+        for digest in list(added):
+            yield binascii.hexlify(digest).decode('ascii')
+
+    @property
+    def total_size(self):
+        """ Returns the total size in bytes of the indexed blobs. """
+        return self.__total
+
+    def get_size(self, sha1):
+        """ Returns the size of the blob with hex sha1, or None if the blob
+        isn't indexed. """
+        digest = binascii.unhexlify(sha1)
+        digests, sizes, added = self.__state
+        size = added.get(digest)
+        if size is not None:
+            return size
+        pos = self.__position(digests, digest)
+        if pos is not None and sizes[pos] >= 0:
+            return int(sizes[pos])
+        return None
+
+    def add(self, sha1, size):
+        """ Index the blob with hex sha1 and size, if it isn't already. """
+        if sha1 in self:
+            return
+        digest = binascii.unhexlify(sha1)
+        digests, sizes, added = self.__state
+        self.__total += size
+        pos = self.__position(digests, digest)
+        if pos is not None:
+            # Previously removed
+            sizes[pos] = size
+            self.__removed -= 1
+            return
+        added[digest] = size
+        if len(added) >= self.MERGE_THRESHOLD:
+            self.__merge()
+
+    def remove(self, sha1):
+        """ Remove the blob with hex sha1 from the index, if it's indexed. """
+        digest = binascii.unhexlify(sha1)
+        digests, sizes, added = self.__state
+        size = added.pop(digest, None)
+        if size is None:
+            pos = self.__position(digests, digest)
+            if pos is None or sizes[pos] < 0:
+                return
+            size = int(sizes[pos])
+            sizes[pos] = -1
+            self.__removed += 1
+        self.__total -= size
+
+    @staticmethod
+    def __position(digests, digest):
+        pos = int(digests.searchsorted(digest))
+        if pos < len(digests) and digests[pos] == digest.rstrip(b'\0'):
+            return pos
+        return None
+
+    def __merge(self):
+        import numpy as np
+        digests, sizes, added = self.__state
+        digests = np.concatenate((digests, np.array(list(added.keys()), dtype='S20')))
+        sizes = np.concatenate((sizes, np.array(list(added.values()), dtype=np.int64)))
+        order = digests.argsort(kind='mergesort')
+        order = order[sizes[order] >= 0]
+        self.__state = (digests[order], sizes[order], {})
+        self.__removed = 0
+
+class BlobManifest(object):
+    """ SQLite manifest of the blobs in a store, one row of binary SHA1 digest,
+    size and last access time per blob, so a store can be opened without
+    listing and stating every blob file. Each call uses its own connection and
+    transaction so it's safe to use from any thread. """
+    __schema = 'CREATE TABLE IF NOT EXISTS blob (sha1 BLOB PRIMARY KEY, ' +\
+               'size INTEGER NOT NULL, last_access REAL NOT NULL DEFAULT 0) WITHOUT ROWID'
+    __access_index = 'CREATE INDEX IF NOT EXISTS blob_last_access ON blob (last_access)'
+
+    def __init__(self, path):
+        check_param_not_none(path, "path")
+        self.__path = path
+        self.__schema_lock = threading.Lock()
+        self.__has_schema = False
+
+    @property
+    def path(self):
+        """ Returns the path of the manifest's database file. """
+        return self.__path
+
+    def exists(self):
+        """ Returns True if the manifest's database file exists. """
+        return os.path.isfile(self.__path)
+
+    def rows(self):
+        """ Returns a list of (20 byte digest, size) tuples for every blob in
+        the manifest, sorted by digest. """
+        with closing(self.__connect()) as conn:
+            return conn.execute('SELECT sha1, size FROM blob ORDER BY sha1').fetchall()
+
+    def least_recent(self):
+        """ Generator of (hex sha1, size) tuples for every blob in the manifest,
+        least recently accessed first. """
+        with closing(self.__connect()) as conn:
+            for digest, size in conn.execute('SELECT sha1, size FROM blob ORDER BY last_access'):
+                yield binascii.hexlify(bytes(digest)).decode('ascii'), size
+
+    def add(self, sha1, size, last_access):
+        """ Record the blob with hex sha1, size and last access time. """
+        self.add_all([(sha1, size, last_access)])
+
+    def add_all(self, blobs):
+        """ Record the blobs in an iterable of (hex sha1, size, last access time)
+        tuples in a single transaction. """
+        with closing(self.__connect()) as conn:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO blob (sha1, size, last_access) ' +
+                                 'VALUES (?, ?, ?)',
+                                 ((_to_digest(sha1), size, last_access)
+                                  for sha1, size, last_access in blobs))
+
+    def touch_all(self, accesses):
+        """ Update the last access times of blobs from an iterable of (hex sha1,
+        time) tuples in a single transaction. """
+        with closing(self.__connect()) as conn:
+            with conn:
+                conn.executemany('UPDATE blob SET last_access = ? WHERE sha1 = ?',
+                                 ((last_access, _to_digest(sha1))
+                                  for sha1, last_access in accesses))
+
+    def remove_all(self, sha1s):
+        """ Remove the blobs with the hex sha1s in an iterable in a single
+        transaction. """
+        with closing(self.__connect()) as conn:
+            with conn:
+                conn.executemany('DELETE FROM blob WHERE sha1 = ?',
+                                 ((_to_digest(sha1),) for sha1 in sha1s))
+
+    def clear(self):
+        """ Remove every blob from the manifest. """
+        with closing(self.__connect()) as conn:
+            with conn:
+                conn.execute('DELETE FROM blob')
+
+    def __connect(self):
+        conn = sqlite3.connect(self.__path, timeout=30)
+        if not self.__has_schema:
+            with self.__schema_lock:
+                self.__create_schema(conn)
+        return conn
+
+    def __create_schema(self, conn):
+        with conn:
+            conn.execute(self.__schema)
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(blob)')]
+            if 'last_access' not in columns:
+                # Manifests written before access times were tracked
+                conn.execute('ALTER TABLE blob ADD COLUMN last_access REAL NOT NULL DEFAULT 0')
+            conn.execute(self.__access_index)
+        self.__has_schema = True
+
+def _to_digest(sha1):
+    return sqlite3.Binary(binascii.unhexlify(sha1))
+
+class BlobWriter(object):
+    """ Write only file like object that adds the bytes written to it to a
+    BlobStore. They're hashed as they're written to a temporary file beside the
+    blobs, which commit() renames into place, so a blob's bytes are never read
+    back. Used as a context manager it commits on success and aborts if an
+    exception is raised. Get one from BlobStore.writer(). """
+    def __init__(self, store, temp_path, pin=False):
+        self.__store = store
+        self.__temp_path = temp_path
+        self.__pin = pin
+        self.__file = open(temp_path, 'wb')
+        self.__hasher = hashlib.sha1()
+        self.__size = 0
+
+    @property
+    def sha1(self):
+        """ Returns the hex SHA1 of the bytes written so far. """
+        return self.__hasher.hexdigest()
+
+    @property
+    def size(self):
+        """ Returns the number of bytes written so far. """
+        return self.__size
+
+    @staticmethod
+    def seekable():
+        """ Writes must be sequential for the running hash to be right. """
+        return False
+
+    def write(self, data):
+        """ Write and hash data. """
+        self.__file.write(data)
+        self.__hasher.update(data)
+        self.__size += len(data)
+
+    def commit(self):
+        """ Adds the bytes written to the store, pinning the blob if the writer
+        was created with pin=True, and returns their ByteSequence. """
+        self.__file.close()
+        byte_sequence = ByteSequence(self.sha1, self.__size)
+        try:
+            self.__store._add_blob(self.__temp_path, byte_sequence, # pylint: disable-msg=W0212
+                                   self.__pin)
+        finally:
+            self.abort()
+        return byte_sequence
+
+    def abort(self):
+        """ Discards the bytes written. """
+        self.__file.close()
+        if os.path.exists(self.__temp_path):
+            os.remove(self.__temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
 class BlobStore(object):
-    """ Hash identified store for binary objects. """
+    """ Hash identified store for binary objects. The blobs are recorded in a
+    manifest alongside them that's loaded into a compact index on first use,
+    rather than on construction. When a manifest already exists it's reconciled
+    against the blob directory by a background thread, otherwise it's built by
+    listing the directory.
+
+    Blobs are spread over fan_out levels of directories named for successive
+    pairs of SHA1 characters, ab/cd/abcd... for a fan out of 2, so no directory
+    holds more than a few thousand entries. A fan out of 0 is the original flat
+    layout, which lookups fall back to until a store's been migrated.
+
+    A store with a quota of more than 0 bytes is a cache: once adding a blob
+    takes it over quota the least recently used blobs are evicted until it's
+    down to EVICT_TO of its quota. Access times are buffered in memory and
+    written to the manifest in batches. Pinned blobs are never evicted. """
     __blobpath = 'blobs/'
-    def __init__(self, root):
+    __manifest_name = 'manifest.sqlite'
+    __max_fan_out = 4
+    # Fraction of the quota an eviction frees space down to
+    EVICT_TO = 0.9
+    # Number of buffered access times that triggers a write to the manifest
+    ACCESS_FLUSH_SIZE = 1024
+    # Age in seconds of an abandoned temporary file that reconcile() removes
+    STALE_TEMP_SECONDS = 24 * 60 * 60
+    def __init__(self, root, fan_out=0, quota=0):
+        if fan_out < 0 or fan_out > self.__max_fan_out:
+            raise ValueError("Argument fan_out must be between 0 and {}.".format(
+                self.__max_fan_out))
+        if quota < 0:
+            raise ValueError("Argument quota can not be less than zero.")
         self.__root = root
-        self.__size = 0
-        self.__blobs = collections.defaultdict(dict)
-        logging.warning("Initialising BlobStore")
-        self.__initialise()
+        self.__fan_out = fan_out
+        self.__quota = quota
+        self.__manifest = BlobManifest(os.path.join(root, self.__manifest_name))
+        self.__index = None
+        self.__loaded = False
+        self.__lock = threading.RLock()
+        self.__evict_lock = threading.Lock()
+        self.__reconciler = None
+        self.__pins = {}
+        self.__accessed = {}
+        self.__hits = 0
+        self.__misses = 0
 
     def get_blob(self, sha1):
         """ Get a blob by it's key. """
         self.__check_sha1_arg(sha1)
-        return self.blobs.get(sha1, None)
+        size = self.blobs.get_size(sha1)
+        return None if size is None else ByteSequence(sha1, size)
 
     @property
     def blob_count(self):
         """ Returns the number of blobs in the store. """
-        return len(self.__blobs)
+        return len(self.blobs)
 
     @property
     def blobs(self):
-        """ Returns the number of blobs in the store. """
-        return self.__blobs
+        """ Returns the store's BlobIndex. """
+        self.__ensure_loaded()
+        return self.__index
 
     @property
     def size(self):
         """ Returns the number of bytes in the store. """
-        if self.__size < 1:
-            self.__size = self.__calculate_size()
-        return self.__size
+        return self.blobs.total_size
 
     @property
     def root(self):
         """Get the root directory for the BLOB store"""
         return self.__root
 
+    @property
+    def fan_out(self):
+        """Get the number of directory levels blobs are spread over"""
+        return self.__fan_out
+
+    @property
+    def quota(self):
+        """Get the maximum size of the BLOB store in bytes, 0 for no limit"""
+        return self.__quota
+
+    @property
+    def manifest(self):
+        """Get the BlobManifest for the BLOB store"""
+        return self.__manifest
+
+    @property
+    def hits(self):
+        """ Returns the number of lookups that found a copy of the blob. """
+        return self.__hits
+
+    @property
+    def misses(self):
+        """ Returns the number of lookups that didn't find a copy of the blob. """
+        return self.__misses
+
+    @property
+    def hit_rate(self):
+        """ Returns the fraction of lookups that found a copy of the blob, or
+        None if there haven't been any lookups. """
+        lookups = self.__hits + self.__misses
+        return float(self.__hits) / lookups if lookups else None
+
     def has_copy(self, sha1):
         """Returns true if the BlobStore has a copy of the file for tha passed sha1."""
         self.__check_sha1_arg(sha1)
         return os.path.isfile(self.get_blob_path(sha1))
 
+    def lookup(self, sha1):
+        """Returns the path of the blob if the store has a copy, counting a hit
+        and recording the access, otherwise counts a miss and returns None.
+        sha1 may be None for an object whose SHA1 isn't known, a miss."""
+        if sha1 is not None and self.has_copy(sha1):
+            self.touch(sha1)
+            with self.__lock:
+                self.__hits += 1
+            BLOB_LOOKUPS.inc(('hit',))
+            return self.get_blob_path(sha1)
+        with self.__lock:
+            self.__misses += 1
+        BLOB_LOOKUPS.inc(('miss',))
+        return None
+
+    def touch(self, sha1):
+        """Records an access to the blob for least recently used eviction."""
+        with self.__lock:
+            self.__accessed[sha1] = time.time()
+            if len(self.__accessed) < self.ACCESS_FLUSH_SIZE:
+                return
+        self.__flush_accesses()
+
+    def __flush_accesses(self):
+        with self.__lock:
+            accessed, self.__accessed = self.__accessed, {}
+        if accessed:
+            self.__manifest.touch_all(accessed.items())
+
+    def pin(self, sha1):
+        """Protects the blob from eviction until it's unpinned, pins are
+        counted so a blob can be pinned by several users at once. A blob can
+        be pinned before it's added."""
+        self.__check_sha1_arg(sha1)
+        with self.__lock:
+            self.__pins[sha1] = self.__pins.get(sha1, 0) + 1
+
+    def unpin(self, sha1):
+        """Releases a pin taken by pin()."""
+        with self.__lock:
+            count = self.__pins.get(sha1, 0) - 1
+            if count > 0:
+                self.__pins[sha1] = count
+            else:
+                self.__pins.pop(sha1, None)
+
+    def is_pinned(self, sha1):
+        """Returns True if the blob is pinned against eviction."""
+        with self.__lock:
+            return sha1 in self.__pins
+
     def replace_blobs(self, blobs):
-        """ Loads the datacentre lookup dictionary from fp (a read() supporting
-        file like object)."""
+        """ Replaces the manifest and index with the ByteSequences in blobs, a
+        dictionary keyed by sha1. """
         check_param_not_none(blobs, "blobs")
-        self.blobs.clear()
-        self.__size = 0
-        self.__blobs = blobs
+        now = time.time()
+        with self.__lock:
+            self.__check_and_create_root()
+            self.__manifest.clear()
+            self.__manifest.add_all((sha1, byte_seq.size, now)
+                                    for sha1, byte_seq in blobs.items())
+            self.__index = BlobIndex.from_rows(self.__manifest.rows())
+            self.__loaded = True
+
+    def writer(self, pin=False):
+        """ Returns a BlobWriter that adds the bytes written to it to the store,
+        pinned against eviction if pin is True. """
+        self.__ensure_loaded()
+        return BlobWriter(self, self.__temp_path(), pin)
 
     def add_file(self, file_path, sha1=None):
-        """ Adds file at path to corpus and returns the sha1. """
+        """ Adds file at path to corpus and returns its ByteSequence. The file
+        is read once, to calculate or check its SHA1, then copied with
+        copy_file(), a reflink or in kernel copy where possible, to a temporary
+        name that's renamed into place, so the store never holds a partial blob.
+        """
         if sha1:
             self.__check_sha1_arg(sha1)
         check_param_not_none(file_path, "file_path")
@@ -109,17 +546,102 @@ class BlobStore(object):
                           .format(sha1,
                                   byte_sequence.sha1,
                                   file_path))
-        sha1 = byte_sequence.sha1
-        if sha1 not in self.blobs.keys():
-            dest_path = self.get_blob_path(sha1)
-            calc_sha1 = sha1_copy_by_path(file_path, dest_path)
-            if calc_sha1 != sha1:
-                raise IOError(errno.ENOENT, os.strerror(errno.ENOENT),
-                              'SHA1 failure copying {}.'.format(file_path))
-            self.blobs.update({byte_sequence.sha1 : byte_sequence})
+        if byte_sequence.sha1 not in self.blobs:
+            temp_path = self.__temp_path()
+            try:
+                method = copy_file(file_path, temp_path)
+                logging.debug("Copied %s to the BlobStore by %s", file_path, method)
+                self._add_blob(temp_path, byte_sequence)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
 
         return byte_sequence
 
+    def _add_blob(self, temp_path, byte_sequence, pin=False):
+        """ Renames the complete blob at temp_path, a temporary file in the
+        store, into place and records it, then evicts blobs if the store's over
+        quota. A blob the store already has is just discarded. """
+        sha1 = byte_sequence.sha1
+        if pin:
+            self.pin(sha1)
+        try:
+            if sha1 in self.blobs:
+                os.remove(temp_path)
+                self.touch(sha1)
+                return
+            self.__rename_into_place(temp_path, self.layout_path(sha1))
+            with self.__lock:
+                self.__manifest.add(sha1, byte_sequence.size, time.time())
+                self.__index.add(sha1, byte_sequence.size)
+        except Exception:
+            if pin:
+                self.unpin(sha1)
+            raise
+        if self.__quota and self.size > self.__quota:
+            self.evict()
+
+    def __rename_into_place(self, temp_path, dest_path, attempts=3):
+        """ Renames temp_path to dest_path creating its fan out directories,
+        which a migration in another process may remove as it empties them, so
+        they're created again if they vanish before the rename. """
+        for attempt in range(attempts):
+            if self.__fan_out:
+                create_dirs(os.path.dirname(dest_path))
+            try:
+                os.rename(temp_path, dest_path)
+                return
+            except OSError as excep:
+                if excep.errno != errno.ENOENT or attempt + 1 == attempts or \
+                        not os.path.exists(temp_path):
+                    raise
+
+    def __temp_path(self):
+        """ Returns a unique temporary file path beside the blobs, so it's on
+        the same file system and can be renamed into place. """
+        return os.path.join(self.blob_root, '{}.tmp'.format(uuid.uuid4().hex))
+
+    def evict(self):
+        """ Removes the least recently used blobs that aren't pinned until the
+        store is down to EVICT_TO of its quota. Only one eviction runs at a
+        time, others return straight away. Returns the number of bytes freed.
+        """
+        if not self.__quota or not self.__evict_lock.acquire(False):
+            return 0
+        try:
+            self.__flush_accesses()
+            excess = self.size - int(self.__quota * self.EVICT_TO)
+            candidates = []
+            with closing(self.__manifest.least_recent()) as blobs:
+                for sha1, size in blobs:
+                    if excess <= 0:
+                        break
+                    if not self.is_pinned(sha1):
+                        candidates.append((sha1, size))
+                        excess -= size
+            evicted = []
+            freed = 0
+            with self.__lock:
+                for sha1, size in candidates:
+                    # Pinned or used since the candidates were chosen
+                    if sha1 in self.__pins or sha1 in self.__accessed:
+                        continue
+                    try:
+                        os.remove(self.get_blob_path(sha1))
+                    except OSError as excep:
+                        if excep.errno != errno.ENOENT:
+                            raise
+                    self.__index.remove(sha1)
+                    evicted.append(sha1)
+                    freed += size
+                self.__manifest.remove_all(evicted)
+            BLOB_EVICTED_BYTES.inc(amount=freed)
+            logging.info("Evicted %d blobs, %d bytes, from BlobStore %s", len(evicted), freed,
+                         self.__root)
+            return freed
+        finally:
+            self.__evict_lock.release()
+
     @property
     def blob_root(self):
         """ Return the BlobStore's root directory. """
@@ -127,49 +649,107 @@ class BlobStore(object):
 
     def clear(self):
         """ Clears all blobs from a store. """
-        for blob_name in only_files(self.blob_root):
-            file_path = os.path.join(self.blob_root, blob_name)
-            os.remove(file_path)
-        self.blobs.clear()
-        self.__size = 0
+        self.__ensure_loaded()
+        with self.__lock:
+            for _, file_path in self.blob_files():
+                os.remove(file_path)
+            self.__manifest.clear()
+            self.__index = BlobIndex()
+            self.__accessed = {}
 
     def hash_check(self):
         """Performs a hash check of all BLOBs in the store"""
-        fnamelst = only_files(self.blob_root)
-        tuples_to_check = [(fname,
-                            sha1_path(os.path.join(self.blob_root,
-                                                   fname))) for fname in fnamelst]
+        self.__ensure_loaded()
         retval = True
-        for to_check in tuples_to_check:
-            if to_check[0] != to_check[1]:
-                logging.warning('Digest mis-maatch for file %s%s, calculated: %s',
-                                self.blob_root, to_check[0], to_check[1])
+        for sha1, file_path in self.blob_files():
+            calc_sha1 = sha1_path(file_path)
+            if sha1 != calc_sha1:
+                logging.warning('Digest mis-maatch for file %s, calculated: %s',
+                                file_path, calc_sha1)
                 retval = False
         return retval
 
     def get_blob_path(self, sha1):
-        """Returns the file path of a the BLOB called blob_name"""
+        """Returns the file path of a the BLOB called blob_name, the path in the
+        flat layout if the blob's only there, otherwise its layout_path()."""
         self.__check_sha1_arg(sha1)
-        return os.path.join(self.blob_root, sha1)
+        path = self.layout_path(sha1)
+        if self.__fan_out and not os.path.isfile(path):
+            flat_path = os.path.join(self.blob_root, sha1)
+            if os.path.isfile(flat_path):
+                return flat_path
+        return path
+
+    def layout_path(self, sha1):
+        """Returns the file path of the BLOB called sha1 in the store's layout."""
+        parts = [sha1[level * 2:level * 2 + 2] for level in range(self.__fan_out)]
+        return os.path.join(self.blob_root, *(parts + [sha1]))
 
-    def __calculate_size(self):
-        """ Returns the recalculated total size of the blob store but doesn't
-        update the cls.SIZE attribute.
+    def blob_files(self):
+        """Generator of (sha1, path) tuples for the blob files in the store, in
+        either layout."""
+        for directory, _, file_names in os.walk(self.blob_root):
+            for file_name in file_names:
+                if ByteSequence.is_sha1(file_name):
+                    yield file_name, os.path.join(directory, file_name)
+
+    def migrate(self, workers=8):
+        """Moves blobs that aren't at their layout_path(), e.g. those in the
+        flat layout, into place using workers threads then removes the old
+        layout's directories that the moves emptied. Directories of the current
+        layout are left as blobs may be being added to them. The store can be
+        used throughout as lookups check both layouts. Returns the number of
+        blobs moved."""
+        from multiprocessing.pool import ThreadPool
+        self.__ensure_loaded()
+        emptied = set()
+        def _moves():
+            for sha1, path in self.blob_files():
+                if path != self.layout_path(sha1):
+                    emptied.add(os.path.dirname(path))
+                    yield path, self.layout_path(sha1)
+        pool = ThreadPool(workers)
+        try:
+            moved = sum(pool.imap_unordered(_move_blob, _moves(), chunksize=64))
+        finally:
+            pool.close()
+            pool.join()
+        root_depth = self.blob_root.rstrip(os.sep).count(os.sep)
+        for directory in sorted(emptied, key=len, reverse=True):
+            # Work up to, but not into, the current layout's directories
+            while directory.rstrip(os.sep).count(os.sep) - root_depth > self.__fan_out:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    # Not empty, or already removed
+                    break
+                directory = os.path.dirname(directory)
+        return moved
+
+    def __ensure_loaded(self):
+        """ Creates the root directories and loads the blob index the first time
+        the store is used.
         """
-        total_size = 0
-        for byte_seq in self.blobs.values():
-            total_size += byte_seq.size
-        return total_size
+        if self.__loaded:
+            return
+        with self.__lock:
+            if not self.__loaded:
+                self.__initialise()
 
     def __initialise(self):
-        """ If persist_to exists, tries to load a serialised lookup table from it.
-        Populates lookup table and saves to persist_to if persist_to doesn't exist.
+        """ Loads the index from the manifest and starts a background reconcile
+        if the manifest exists, otherwise builds the manifest from the blob
+        directory.
         """
-        logging.warning("Checking BlobStore root")
         self.__check_and_create_root()
-        logging.warning("Reloading BlobStore")
-        self.reload_blobs()
-        return
+        if self.__manifest.exists():
+            logging.info("Loading BlobStore manifest %s", self.__manifest.path)
+            self.__index = BlobIndex.from_rows(self.__manifest.rows())
+            self.__loaded = True
+            self.start_reconcile()
+        else:
+            logging.warning("Building BlobStore manifest %s", self.__manifest.path)
+            self.reconcile()
 
     def __check_and_create_root(self):
         """ Checks that the root dirs for the BlobStore exist and makes
@@ -186,22 +766,128 @@ class BlobStore(object):
             raise ValueError("Argument sha1 must be a 40 character HEX string.")
 
     def reload_blobs(self):
-        """ Clears the lookup dictionary and loads the details of blob files
-        from scratch.
+        """ Reconciles the manifest with the blob directory and reloads the
+        index from it.
+        """
+        self.__check_and_create_root()
+        self.reconcile()
+
+    def start_reconcile(self):
+        """ Starts reconciling the manifest with the blob directory on a
+        background thread, unless a reconcile is already running. """
+        with self.__lock:
+            if self.__reconciler is not None and self.__reconciler.is_alive():
+                return
+            self.__reconciler = threading.Thread(target=self.__background_reconcile,
+                                                 name='blobstore-reconcile')
+            self.__reconciler.daemon = True
+            self.__reconciler.start()
+
+    def wait_for_reconcile(self, timeout=None):
+        """ Waits for a running background reconcile to finish, returns False
+        if it's still running after timeout seconds. """
+        reconciler = self.__reconciler
+        if reconciler is not None:
+            reconciler.join(timeout)
+            return not reconciler.is_alive()
+        return True
+
+    def __background_reconcile(self):
+        try:
+            added, removed = self.reconcile()
+            logging.info("Reconciled BlobStore manifest, %d blobs added, %d removed",
+                         added, removed)
+        except Exception: # pylint: disable-msg=W0703
+            logging.exception("Failed to reconcile BlobStore manifest %s",
+                              self.__manifest.path)
+
+    def reconcile(self):
+        """ Brings the manifest into line with the blob directory, recording
+        blob files it's missing and dropping rows for blob files that have gone,
+        then reloads the index. The manifest is read before the directory is
+        listed so blobs added meanwhile aren't mistaken for deleted ones.
+        Returns an (added, removed) tuple of blob counts.
         """
-        self.blobs.clear()
-        for blob_name in only_files(self.blob_root):
-            file_path = os.path.join(self.blob_root, blob_name)
-            size = os.stat(file_path).st_size
-            byte_seq = ByteSequence(blob_name, size)
-            self.blobs.update({byte_seq.sha1 : byte_seq})
-
-def main(): # pragma: no cover
+        self.__remove_stale_temps()
+        recorded = dict((binascii.hexlify(bytes(digest)).decode('ascii'), size)
+                        for digest, size in self.__manifest.rows())
+        on_disk = {}
+        for blob_name, file_path in self.blob_files():
+            try:
+                status = os.stat(file_path)
+            except OSError:
+                # Moved by a migration, it'll be found in its new directory
+                continue
+            if stat.S_ISREG(status.st_mode):
+                on_disk[blob_name] = (status.st_size, status.st_mtime)
+        missing = [(sha1, size, modified) for sha1, (size, modified) in on_disk.items()
+                   if recorded.get(sha1) != size]
+        gone = [sha1 for sha1 in recorded if sha1 not in on_disk]
+        with self.__lock:
+            self.__manifest.add_all(missing)
+            self.__manifest.remove_all(gone)
+            self.__index = BlobIndex.from_rows(self.__manifest.rows())
+            self.__loaded = True
+        return len(missing), len(gone)
+
+    def __remove_stale_temps(self):
+        """ Removes temporary files abandoned by interrupted writes. """
+        stale = time.time() - self.STALE_TEMP_SECONDS
+        for file_name in os.listdir(self.blob_root):
+            if not file_name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.blob_root, file_name)
+            try:
+                if os.path.getmtime(path) < stale:
+                    os.remove(path)
+            except OSError:
+                # Committed or removed meanwhile
+                pass
+
+def _move_blob(move):
+    """Renames a blob from its source to destination path, returns 1 if it was
+    moved. A blob already at the destination is a duplicate and is removed."""
+    src_path, dest_path = move
+    create_dirs(os.path.dirname(dest_path))
+    try:
+        if os.path.isfile(dest_path):
+            os.remove(src_path)
+            return 0
+        os.rename(src_path, dest_path)
+    except OSError as excep:
+        # Already moved by another worker or process
+        if excep.errno != errno.ENOENT:
+            raise
+        return 0
+    return 1
+
+DEFAULTS = {
+    'description': """JISC Research Data Shared Service (RDSS) BlobStore.
+Reports the size of the BlobStore and migrates it to the configured layout.""",
+    'epilog': EPILOG
+}
+
+def main(args=None): # pragma: no cover
     """
-    Main method entry point, parses DOIs from Datacite and outputs to
-    STDOUT.
+    Main method entry point, outputs the BlobStore's size to STDOUT and
+    optionally migrates its blobs to the configured fan out layout.
     """
-    blob_store = BlobStore(os.path.join(RDSS_ROOT, 'blobstore'))
+    parser = ArgumentParser(description=DEFAULTS['description'],
+                            epilog=DEFAULTS['epilog'],
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--root', default=os.path.join(RDSS_ROOT, 'blobstore'),
+                        help='BlobStore root directory, default: %(default)s')
+    parser.add_argument('--fan-out', type=int, default=BLOB_STORE_FAN_OUT,
+                        help='directory levels to spread blobs over, default: %(default)s')
+    parser.add_argument('--migrate', action='store_true',
+                        help='move blobs into the fan out layout, the store can be used meanwhile')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='threads moving blobs while migrating, default: %(default)s')
+    args = parser.parse_args(args)
+    blob_store = BlobStore(args.root, args.fan_out)
+    if args.migrate:
+        moved = blob_store.migrate(args.workers)
+        print('Moved {} blobs into a fan out {} layout'.format(moved, args.fan_out))
     print('Blobstore contains {} blobs, {} bytes'.format(blob_store.blob_count,
                                                          blob_store.size))
 
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+""" Thread safe, bounded in memory caches. """
+import collections
+import threading
+import time
+
+class SizedLruCache(object):
+    """Least recently used cache of byte string values bounded by the total
+    size in bytes of the values it holds rather than the number of entries."""
+    def __init__(self, max_bytes):
+        if max_bytes is None or max_bytes < 0:
+            raise ValueError("Argument max_bytes must be zero or greater.")
+        self.__max_bytes = max_bytes
+        self.__size = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    @property
+    def max_bytes(self):
+        """Return the maximum total size of the cached values."""
+        return self.__max_bytes
+
+    @property
+    def size(self):
+        """Return the current total size of the cached values."""
+        return self.__size
+
+    @property
+    def hits(self):
+        """Return the number of get calls that found a value."""
+        return self.__hits
+
+    @property
+    def misses(self):
+        """Return the number of get calls that found nothing."""
+        return self.__misses
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+
+    def get(self, key, default=None):
+        """Return the value cached for key, marking it most recently used."""
+        with self.__lock:
+            value = self.__entries.pop(key, None)
+            if value is None:
+                self.__misses += 1
+                return default
+            self.__entries[key] = value
+            self.__hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache value under key, evicting least recently used entries to stay
+        within max_bytes. Returns False if value is too big to cache at all."""
+        if len(value) > self.__max_bytes:
+            return False
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__size -= len(old)
+            while self.__entries and self.__size + len(value) > self.__max_bytes:
+                _, evicted = self.__entries.popitem(last=False)
+                self.__size -= len(evicted)
+            self.__entries[key] = value
+            self.__size += len(value)
+        return True
+
+    def invalidate(self, key):
+        """Remove any value cached for key."""
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__size -= len(old)
+
+    def clear(self):
+        """Remove all cached values."""
+        with self.__lock:
+            self.__entries.clear()
+            self.__size = 0
+
+def caching_generator(generator, cache, key, max_item_bytes):
+    """Pass through the chunks yielded by generator, collecting them as bytes
+    and caching the complete body under key once the generator is exhausted.
+    Collection is abandoned if the body grows beyond max_item_bytes."""
+    chunks = []
+    size = 0
+    for chunk in generator:
+        if chunks is not None:
+            encoded = chunk.encode('utf-8') if not isinstance(chunk, bytes) else chunk
+            size += len(encoded)
+            if size > max_item_bytes:
+                chunks = None
+            else:
+                chunks.append(encoded)
+        yield chunk
+    if chunks is not None:
+        cache.put(key, b''.join(chunks))
+
+class TtlCache(object):
+    """Least recently used cache bounded by number of entries, where entries
+    also expire ttl seconds after they were cached. A ttl of zero disables
+    caching."""
+    def __init__(self, max_entries, ttl):
+        if max_entries is None or max_entries < 0:
+            raise ValueError("Argument max_entries must be zero or greater.")
+        if ttl is None or ttl < 0:
+            raise ValueError("Argument ttl must be zero or greater.")
+        self.__max_entries = max_entries
+        self.__ttl = ttl
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    @property
+    def max_entries(self):
+        """Return the maximum number of cached entries."""
+        return self.__max_entries
+
+    @property
+    def ttl(self):
+        """Return the number of seconds an entry stays fresh."""
+        return self.__ttl
+
+    @property
+    def hits(self):
+        """Return the number of get calls that found a fresh value."""
+        return self.__hits
+
+    @property
+    def misses(self):
+        """Return the number of get calls that found nothing or a stale value."""
+        return self.__misses
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, default=None):
+        """Return the fresh value cached for key, marking it most recently
+        used, stale values are removed and default returned."""
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                self.__misses += 1
+                return default
+            self.__entries[key] = entry
+            self.__hits += 1
+            return entry[1]
+
+    def peek(self, key, default=None):
+        """Return the fresh value cached for key without counting a hit or
+        miss or changing its recent use."""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                return default
+            return entry[1]
+
+    def put(self, key, value):
+        """Cache value under key, evicting least recently used entries to stay
+        within max_entries."""
+        if not self.__ttl or not self.__max_entries:
+            return
+        with self.__lock:
+            self.__entries.pop(key, None)
+            while len(self.__entries) >= self.__max_entries:
+                self.__entries.popitem(last=False)
+            self.__entries[key] = (time.time() + self.__ttl, value)
+
+    def invalidate(self, key):
+        """Remove any value cached for key."""
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """Remove all values whose key satisfies predicate, returning the
+        number removed."""
+        with self.__lock:
+            stale = [key for key in self.__entries if predicate(key)]
+            for key in stale:
+                del self.__entries[key]
+        return len(stale)
+
+    def clear(self):
+        """Remove all cached values."""
+        with self.__lock:
+            self.__entries.clear()
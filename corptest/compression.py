@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""
+Incremental HTTP content encoding of streamed responses.
+
+gzip is always available, zstd only when the optional zstandard package is
+installed. Compressor objects are fed one chunk at a time so compressing a
+streamed report doesn't buffer it.
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+IDENTITY = 'identity'
+GZIP = 'gzip'
+ZSTD = 'zstd'
+# zlib window bits for a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def available_encodings():
+    """Return the supported content encodings, most preferred first."""
+    return [ZSTD, GZIP] if zstandard is not None else [GZIP]
+
+def choose_encoding(accept_encodings):
+    """Return the preferred encoding from a werkzeug Accept-Encoding header
+    object, or IDENTITY if the client accepts none of the available ones."""
+    best = accept_encodings.best_match(available_encodings())
+    return best if best and accept_encodings[best] > 0 else IDENTITY
+
+def _compressor(encoding, level):
+    if encoding == GZIP:
+        return zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    if encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError("Unsupported content encoding {}.".format(encoding))
+
+def compress_generator(generator, encoding, level=6):
+    """Generator that yields the chunks of generator compressed with encoding.
+    Chunks are yielded as the compressor produces them so memory use is
+    bounded by the compressor's window rather than the size of the body."""
+    if encoding == IDENTITY:
+        for chunk in generator:
+            yield chunk
+        return
+    compressor = _compressor(encoding, level)
+    for chunk in generator:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -35,6 +35,52 @@ class BaseConfig(object):# pylint: disable-msg=R0903
     SQL_PATH = os.path.join(TEMP, 'jisc-rdss-format.db')
     SQL_URL = 'sqlite:///' + SQL_PATH
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Maximum bytes of generated report artefacts, e.g. PDFs, to keep on disk
+    ARTEFACT_QUOTA = 1024 * 1024 * 1024
+    # Maximum bytes of rendered report responses to hold in memory, and the
+    # largest single response that will be cached
+    RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+    RESPONSE_CACHE_MAX_ITEM = 8 * 1024 * 1024
+    # Compress streamed reports with gzip, or zstd if installed, at this level
+    COMPRESS_RESPONSES = True
+    COMPRESSION_LEVEL = 6
+    # Keys are grouped by their first KEY_GROUP_DEPTH folders, or by the
+    # first capture group of KEY_GROUP_REGEX if it's set
+    KEY_GROUP_DEPTH = 1
+    KEY_GROUP_REGEX = None
+    # Number of background indexing worker threads and how often, in seconds,
+    # idle workers check the job table for queued jobs
+    INDEX_WORKERS = 1
+    JOB_POLL_INTERVAL = 5
+    # Seconds between a worker's heartbeats for the jobs it's running, and
+    # how old a running job's heartbeat can get before it's queued again
+    JOB_HEARTBEAT_INTERVAL = 30
+    JOB_HEARTBEAT_TIMEOUT = 120
+    # Running jobs check for pause and cancel requests every INDEX_BATCH_SIZE keys
+    INDEX_BATCH_SIZE = 100
+    # Keys listed ahead of the ones being indexed, the listing pauses when
+    # this many are waiting
+    INDEX_LIST_AHEAD = 100000
+    # Seconds between publishing a running index's progress counters and the
+    # window, in seconds, over which its throughput is measured
+    PROGRESS_FLUSH_INTERVAL = 2
+    PROGRESS_WINDOW = 60
+    # S3 folder listings are cached for S3_LISTING_CACHE_TTL seconds, zero
+    # turns caching off, and at most S3_LISTING_CACHE_ENTRIES are held
+    S3_LISTING_CACHE_TTL = 60
+    S3_LISTING_CACHE_ENTRIES = 1024
+    # Seconds a validated source handle, e.g. a bucket checked with
+    # head_bucket, is reused before it's validated again
+    SOURCE_REFRESH_INTERVAL = 300
+    # Size in bytes of the chunks file downloads are streamed in
+    DOWNLOAD_CHUNK_SIZE = 256 * 1024
+    # Directory levels BlobStore blobs are spread over, ab/cd/<sha1> for 2,
+    # 0 for all blobs in one directory. Existing stores are moved to a new
+    # layout with python -m corptest.blobstore --migrate
+    BLOB_STORE_FAN_OUT = 2
+    # Maximum bytes of S3 objects to keep in the BlobStore, the least recently
+    # used are evicted once it's exceeded, 0 for no limit
+    BLOB_STORE_QUOTA = 10 * 1024 * 1024 * 1024
     FOLDERS = [
         {
             'name' : 'Temp File System',
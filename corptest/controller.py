@@ -15,30 +15,65 @@ from json import dumps
 import logging
 from mimetypes import MimeTypes
 import tempfile
+import time
 try:
-    from urllib.parse import unquote as unquote, quote as quote
+    from urllib.parse import unquote as unquote, quote as quote, urlencode
 except ImportError:
-    from urllib import unquote as unquote, quote as quote
+    from urllib import unquote as unquote, quote as quote, urlencode
 
 from botocore import exceptions
-import dateutil.parser
-import dicttoxml
-from flask import render_template, send_file, request, make_response
+from flask import render_template, send_file, request, make_response, stream_with_context
+from flask import g, redirect
 from flask_negotiate import produces
-from werkzeug.exceptions import BadRequest, Forbidden, NotFound, Unauthorized
-
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import BadRequest, Conflict, Forbidden, NotFound, Unauthorized
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+from .aggregates import DISAGREEMENT_PROPERTIES, cached_disagreement_matrix
+from .aggregates import cached_size_distribution, keys_for_cell, release_names
+from .aggregates import cached_group_breakdown
+from .artefacts import ARTEFACTS
+from .caches import SizedLruCache, caching_generator
+from .compression import IDENTITY, choose_encoding, compress_generator
 from .corptest import APP, __version__
 from .database import DB_SESSION
-from .model_sources import SCHEMES, Source, FormatToolRelease, SourceIndex, Key
+from .diff import IndexDiff, ADDED, CHANGE_TYPES
+from .diff import json_diff_generator, ndjson_diff_generator
+from .indexer import JOBS, add_byte_sequence_properties
+from .metrics import METRICS, CONTENT_TYPE as METRICS_MIME
+from .metrics import query_stats, reset_query_stats
+from .progress import PROGRESS
+from .model_sources import SCHEMES, Source, FormatToolRelease, SourceIndex, Job
 from .model_properties import KeyProperty, Property, PropertyValue, ByteSequenceProperty
-from .reporter import item_pdf_report, source_key_to_dict, report_to_dict, pdf_report
-from .sources import SourceKey, FileSystem, AS3Bucket, BLOBSTORE
-from .utilities import ObjectJsonEncoder, PrettyJsonEncoder
+from .reporter import item_pdf_report, source_key_to_dict, pdf_report
+from .reporter import json_report_generator, xml_report_generator, xml_file_report
+from .reporter import ndjson_report_generator, csv_report_generator
+from .sources import SourceKey, BLOBSTORE, SORT_FIELDS, SORT_NAME, source_file_system
+from .sources import MAX_LISTING_OFFSET
+from .utilities import ObjectJsonEncoder, PrettyJsonEncoder, sha1_string
 ROUTES = True
 
 JSON_MIME = 'application/json'
+NDJSON_MIME = 'application/x-ndjson'
+CSV_MIME = 'text/csv'
 PDF_MIME = 'application/pdf'
 XML_MIME = 'text/xml'
+PAGE_SIZE = 100
+JOB_ACTIONS = ('pause', 'resume', 'cancel')
+# Rendered report bodies keyed by ETag, shared by all request threads
+RESPONSE_CACHE = SizedLruCache(APP.config.get('RESPONSE_CACHE_BYTES'))
+
+REQUEST_SECONDS = METRICS.histogram('corptest_http_request_duration_seconds',
+                                    'Time to handle a request by route, streamed bodies '
+                                    'are timed until the response is returned.',
+                                    ('route', 'method', 'status'))
+REQUEST_QUERIES = METRICS.histogram('corptest_http_request_db_queries',
+                                    'Database queries made handling a request by route.',
+                                    ('route',), buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 1000))
+REQUEST_QUERY_SECONDS = METRICS.histogram('corptest_http_request_db_seconds',
+                                          'Time spent in database queries handling a request '
+                                          'by route.', ('route',))
+
 @APP.route("/")
 def home():
     """Application home page."""
@@ -64,6 +99,14 @@ def details_fs(source_id, encoded_filepath):
     except exceptions.NoCredentialsError:
         raise Unauthorized('No S3 credentials found.')
 
+@APP.route("/source/<int:source_id>/download/<path:encoded_filepath>")
+def download_fs(source_id, encoded_filepath):
+    """Stream a source file, honouring single byte range requests."""
+    try:
+        return _download_item(Source.by_id(source_id), encoded_filepath)
+    except exceptions.NoCredentialsError:
+        raise Unauthorized('No S3 credentials found.')
+
 @APP.route("/api/analyse/<source_id>/<path:encoded_filepath>/")
 @produces(JSON_MIME, XML_MIME, PDF_MIME)
 def file_report(source_id, encoded_filepath):
@@ -76,94 +119,222 @@ def file_report(source_id, encoded_filepath):
         raise Unauthorized('No S3 credentials found.')
 
     key = _fs.get_key(unquote(encoded_filepath))
-    _bs, bs_props = _fs.get_byte_sequence_properties(key)
-    _add_byte_sequence_properties(_bs, bs_props)
-    key.add_byte_sequence(_bs)
     if _request_wants_json():
         logging.debug("JSON file report for %s", key.value)
-        return _json_file_report(key)
+        mimetype, renderer = JSON_MIME, _json_file_report
     elif _request_wants_xml():
         logging.debug("XML file report for %s", key.value)
-        return _xml_file_report(key)
-    logging.debug("PDF file report for %s", key.value)
-    return _pdf_file_report(key)
-
-def _json_file_report(key):
-    response = APP.response_class(
-        response=dumps(source_key_to_dict(key), cls=PrettyJsonEncoder),
-        status=200,
-        mimetype=JSON_MIME
-    )
-    return response
-
-def _xml_file_report(key):
-    xml = dicttoxml.dicttoxml(source_key_to_dict(key))
-    response = APP.response_class(
-        response=xml,
-        status=200,
-        mimetype=XML_MIME
-    )
-    return response
-
-def _pdf_file_report(key):
-    """Download a file from a source."""
-    dest_name = ''
-    with tempfile.NamedTemporaryFile(delete=False) as temp:
-        item_pdf_report(key, temp.name)
-        dest_name = temp.name
-        response = make_response(send_file(dest_name, mimetype=PDF_MIME))
+        mimetype, renderer = XML_MIME, xml_file_report
+    else:
+        logging.debug("PDF file report for %s", key.value)
+        mimetype, renderer = PDF_MIME, _pdf_file_report
+    # The ETag is derived from the file's listing details so that repeat
+    # requests are answered without running the identification tools.
+    etag = sha1_string(u'{}:{}:{}:{}:{}:{}'.format(
+        source_id, key.value, key.size, key.last_modified, mimetype,
+        ','.join(str(release.id) for release in FormatToolRelease.get_enabled())))
+    if _is_not_modified(etag, None):
+        return _not_modified_response(etag, None)
+    body = RESPONSE_CACHE.get(etag)
+    if body is None:
+        _bs, bs_props = _fs.get_byte_sequence_properties(key)
+        add_byte_sequence_properties(_bs, bs_props)
+        key.add_byte_sequence(_bs)
+        body = renderer(key)
+        if len(body) <= APP.config.get('RESPONSE_CACHE_MAX_ITEM'):
+            RESPONSE_CACHE.put(etag, body)
+    response = APP.response_class(response=body, status=200, mimetype=mimetype)
+    if mimetype == PDF_MIME:
         response.headers["Content-Disposition"] = \
             "attachment; " \
             "filename*=UTF-8''{quoted_filename}".format(
                 quoted_filename=quote(key.name.encode('utf8'))
                 )
-        return response
+    return _add_validators(response, etag, None)
+
+def _json_file_report(key):
+    return dumps(source_key_to_dict(key), cls=PrettyJsonEncoder).encode('utf-8')
+
+def _pdf_file_report(key):
+    """Return the bytes of a PDF report for a single key."""
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as temp:
+        item_pdf_report(key, temp.name)
+        return temp.read()
 
 @APP.route("/api/report/<report_id>/")
-@produces(JSON_MIME, XML_MIME, PDF_MIME)
+@produces(JSON_MIME, XML_MIME, PDF_MIME, NDJSON_MIME, CSV_MIME)
 def full_report(report_id):
     """Download a full file system analysis report."""
     report = SourceIndex.by_id(report_id)
+    if report is None:
+        raise NotFound('No report with id %s found' % report_id)
     if _request_wants_json():
         logging.debug("JSON file report for %s:%s", report.source.name, report.root_key)
-        return _json_report(report)
+        return _cached_report(report, json_report_generator, JSON_MIME)
     elif _request_wants_xml():
         logging.debug("XML file report for %s:%s", report.source.name, report.root_key)
-        return _xml_report(report)
+        return _cached_report(report, xml_report_generator, XML_MIME)
+    elif _request_wants(NDJSON_MIME):
+        logging.debug("NDJSON file report for %s:%s", report.source.name, report.root_key)
+        return _cached_report(report, ndjson_report_generator, NDJSON_MIME)
+    elif _request_wants(CSV_MIME):
+        logging.debug("CSV file report for %s:%s", report.source.name, report.root_key)
+        return _cached_report(report, csv_report_generator, CSV_MIME)
     logging.debug("PDF file report for %s:%s", report.source.name, report.root_key)
     return _pdf_report(report)
 
-
-def _json_report(report):
+def _cached_report(report, generator, mimetype):
+    """Answer conditional requests with a 304, otherwise serve the rendered
+    report from the response cache, or stream it, caching complete indexes."""
+    etag, last_modified = _report_validators(report, mimetype)
+    return _cached_stream(etag, last_modified, lambda: generator(report), mimetype,
+                          report.is_complete)
+
+def _cached_stream(etag, last_modified, generator_factory, mimetype, cacheable):
+    """Return a 304 if the client holds the current representation, the cached
+    body if there is one, otherwise stream the chunks from generator_factory(),
+    caching the body if cacheable. Bodies are compressed with the client's
+    preferred content encoding, and cached compressed, so each encoding is a
+    separate representation with its own ETag."""
+    encoding = _response_encoding()
+    if encoding != IDENTITY:
+        etag = '{}-{}'.format(etag, encoding)
+    if _is_not_modified(etag, last_modified):
+        response = _not_modified_response(etag, last_modified)
+    else:
+        body = RESPONSE_CACHE.get(etag)
+        if body is not None:
+            response = APP.response_class(response=body, status=200, mimetype=mimetype)
+        else:
+            chunks = compress_generator(generator_factory(), encoding,
+                                        APP.config.get('COMPRESSION_LEVEL'))
+            if cacheable:
+                chunks = caching_generator(chunks, RESPONSE_CACHE, etag,
+                                           APP.config.get('RESPONSE_CACHE_MAX_ITEM'))
+            response = _streamed_report(chunks, mimetype)
+        if encoding != IDENTITY:
+            response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    return _add_validators(response, etag, last_modified)
+
+def _response_encoding():
+    if not APP.config.get('COMPRESS_RESPONSES'):
+        return IDENTITY
+    return choose_encoding(request.accept_encodings)
+
+def _streamed_report(generator, mimetype):
     response = APP.response_class(
-        response=dumps(report_to_dict(report)),
+        response=stream_with_context(generator),
         status=200,
-        mimetype=JSON_MIME
+        mimetype=mimetype
     )
     return response
 
-def _xml_report(report):
-    xml = dicttoxml.dicttoxml(report_to_dict(report))
-    response = APP.response_class(
-        response=xml,
-        status=200,
-        mimetype=XML_MIME
-    )
+def _report_validators(report, mimetype):
+    """Return the strong ETag and Last-Modified time for a report rendering,
+    Last-Modified is None until the index is complete."""
+    etag = sha1_string(u'{}:{}:{}'.format(report.id, report.version_tag, mimetype))
+    last_modified = _to_utc(report.completed) if report.is_complete else None
+    return etag, last_modified
+
+def _to_utc(local_time):
+    """Convert a naive local datetime to a naive UTC datetime for HTTP headers."""
+    return datetime.utcfromtimestamp(time.mktime(local_time.timetuple()))
+
+def _is_not_modified(etag, last_modified):
+    """Return True if the request's conditional headers show that the client
+    already holds the current representation."""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+def _not_modified_response(etag, last_modified):
+    return _add_validators(APP.response_class(status=304), etag, last_modified)
+
+def _add_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Clients may keep the response but must revalidate it before each use
+    response.headers['Cache-Control'] = 'no-cache'
     return response
 
 def _pdf_report(report):
-    """Download a file from a source."""
-    dest_name = ''
-    with tempfile.NamedTemporaryFile(delete=False) as temp:
-        pdf_report(report, temp.name)
-        dest_name = temp.name
-        response = make_response(send_file(dest_name, mimetype=PDF_MIME))
-        response.headers["Content-Disposition"] = \
-            "attachment; " \
-            "filename*=UTF-8''{quoted_filename}".format(
-                quoted_filename=quote(report.source.name)
-                )
+    """Return the cached PDF report, or kick off background generation and
+    return a 202 generating status that clients should poll."""
+    pdf_path = ARTEFACTS.get_or_generate(report, 'pdf', pdf_report)
+    if pdf_path is None:
+        response = APP.response_class(
+            response=dumps({'status': 'generating', 'report_id': report.id}),
+            status=202,
+            mimetype=JSON_MIME
+        )
+        response.headers['Retry-After'] = '5'
         return response
+    response = make_response(send_file(pdf_path, mimetype=PDF_MIME, conditional=True))
+    response.headers["Content-Disposition"] = \
+        "attachment; " \
+        "filename*=UTF-8''{quoted_filename}".format(
+            quoted_filename=quote(report.source.name)
+            )
+    return response
+
+@APP.route("/api/diff/<int:old_id>/<int:new_id>/")
+@produces(JSON_MIME, NDJSON_MIME)
+def diff_report(old_id, new_id):
+    """Download the changes between two indexes of the same source."""
+    index_diff = _get_diff(old_id, new_id)
+    mimetype = NDJSON_MIME if _request_wants(NDJSON_MIME) else JSON_MIME
+    generator = ndjson_diff_generator if mimetype == NDJSON_MIME else json_diff_generator
+    old_index, new_index = index_diff.old_index, index_diff.new_index
+    etag = sha1_string(u'{}:{}:{}:{}:{}'.format(old_index.id, old_index.version_tag,
+                                               new_index.id, new_index.version_tag,
+                                               mimetype))
+    cacheable = old_index.is_complete and new_index.is_complete
+    last_modified = _to_utc(max(old_index.completed, new_index.completed)) \
+        if cacheable else None
+    return _cached_stream(etag, last_modified, lambda: generator(index_diff), mimetype,
+                          cacheable)
+
+@APP.route("/api/report/<int:report_id>/disagreements/<prop_name>/")
+def disagreements_report(report_id, prop_name):
+    """Download the tool disagreement matrix of a report as JSON."""
+    source_index = _get_report(report_id)
+    return _aggregate_response(source_index, 'disagreements/' + prop_name,
+                               lambda: _get_disagreements(source_index, prop_name))
+
+@APP.route("/api/report/<int:report_id>/sizes/", defaults={'prop_name': 'MIME'})
+@APP.route("/api/report/<int:report_id>/sizes/<prop_name>/")
+def sizes_report(report_id, prop_name):
+    """Download the size distribution of a report, by prop_name value, as JSON."""
+    source_index = _get_report(report_id)
+    if prop_name not in DISAGREEMENT_PROPERTIES:
+        raise NotFound('No size distribution for property %s' % prop_name)
+    return _aggregate_response(source_index, 'sizes/' + prop_name,
+                               lambda: cached_size_distribution(source_index, prop_name))
+
+@APP.route("/api/report/<int:report_id>/groups/", defaults={'prop_name': 'PUID'})
+@APP.route("/api/report/<int:report_id>/groups/<prop_name>/")
+def groups_report(report_id, prop_name):
+    """Download the per group breakdown of a report as JSON."""
+    source_index = _get_report(report_id)
+    return _aggregate_response(source_index,
+                               'groups/{}/{}'.format(prop_name, request.args.get('release')),
+                               lambda: _get_groups(source_index, prop_name))
+
+def _aggregate_response(source_index, name, aggregate_factory):
+    """JSON response for an index aggregate, answering conditional requests."""
+    etag, last_modified = _report_validators(source_index, name)
+    if _is_not_modified(etag, last_modified):
+        return _not_modified_response(etag, last_modified)
+    response = APP.response_class(
+        response=dumps(aggregate_factory()),
+        status=200,
+        mimetype=JSON_MIME
+    )
+    return _add_validators(response, etag, last_modified)
 
 @APP.route("/tools/")
 def tools():
@@ -185,7 +356,49 @@ def toggle_tool_enabed(tool_id):
 @APP.route("/reports/")
 def list_reports():
     """Show the list of existing reports."""
-    return render_template('report_list.html', reports=SourceIndex.all())
+    jobs = dict((job.source_index_id, job) for job in Job.all())
+    return render_template('report_list.html', reports=SourceIndex.all(), jobs=jobs,
+                           progress=PROGRESS.all())
+
+@APP.route("/api/jobs/<int:job_id>/<action>/", methods=['POST'])
+def control_job(job_id, action):
+    """POST method to pause, resume or cancel a background indexing job."""
+    job = Job.by_id(job_id)
+    if job is None:
+        raise NotFound('Job %s not found' % job_id)
+    if action not in JOB_ACTIONS:
+        raise NotFound('Unknown job action %s' % action)
+    if not getattr(job, action)():
+        raise Conflict('Job %s is %s and can\'t %s' % (job_id, job.status, action))
+    if action == 'resume':
+        JOBS.wake()
+    return APP.response_class(response=dumps(_job_to_dict(job)), mimetype=JSON_MIME)
+
+@APP.route("/metrics")
+def metrics():
+    """Application metrics in the Prometheus text format."""
+    return APP.response_class(response=METRICS.exposition(), mimetype=METRICS_MIME)
+
+@APP.route("/api/progress/")
+def all_progress():
+    """JSON progress of the indexes run since the app started, keyed by report id."""
+    return APP.response_class(response=dumps(PROGRESS.all()), mimetype=JSON_MIME)
+
+@APP.route("/api/report/<int:report_id>/progress/")
+def report_progress(report_id):
+    """JSON progress of a running or recently run index."""
+    progress = PROGRESS.get(report_id)
+    if progress is None:
+        raise NotFound('No progress for report %s' % report_id)
+    return APP.response_class(response=dumps(progress), mimetype=JSON_MIME)
+
+@APP.route("/api/jobs/<int:job_id>/")
+def job_status(job_id):
+    """JSON status of a background indexing job."""
+    job = Job.by_id(job_id)
+    if job is None:
+        raise NotFound('Job %s not found' % job_id)
+    return APP.response_class(response=dumps(_job_to_dict(job)), mimetype=JSON_MIME)
 
 @APP.route("/reports/", methods=['POST'])
 def new_report():
@@ -204,10 +417,65 @@ def report_detail(report_id):
     size = source_index.size if source_index.size else 0
     file_count = source_index.key_count if source_index.key_count else 0
     return render_template('report_details.html', report=source_index,
+                           others=[other for other in SourceIndex.by_source(source_index.source)
+                                   if other.id != source_index.id],
                            file_count=file_count,
                            size=size,
                            key_props=KeyProperty.get_properties_for_index(report_id),
-                           bs_props=ByteSequenceProperty.get_properties_for_index(report_id))
+                           bs_props=ByteSequenceProperty.get_properties_for_index(report_id),
+                           sizes=cached_size_distribution(source_index))
+
+@APP.route("/reports/<int:report_id>/diff/<int:other_id>/")
+def report_diff(report_id, other_id):
+    """Show a page of the changes between an earlier index and this one."""
+    index_diff = _get_diff(other_id, report_id)
+    change = request.args.get('change', ADDED)
+    if change not in CHANGE_TYPES:
+        raise BadRequest('Unknown change type %s' % change)
+    page = _requested_page()
+    counts = index_diff.counts()
+    entries = index_diff.changes(change, (page - 1) * PAGE_SIZE, PAGE_SIZE)
+    return render_template('report_diff.html', diff=index_diff, counts=counts,
+                           change=change, page=page,
+                           page_count=max((counts[change][0] - 1) // PAGE_SIZE + 1, 1),
+                           entries=entries, drift=index_diff.format_drift())
+
+@APP.route("/reports/<int:report_id>/disagreements/", defaults={'prop_name': 'PUID'})
+@APP.route("/reports/<int:report_id>/disagreements/<prop_name>/")
+def report_disagreements(report_id, prop_name):
+    """Show the tool disagreement matrix of a report for a property."""
+    source_index = _get_report(report_id)
+    matrix = _get_disagreements(source_index, prop_name)
+    return render_template('report_disagreements.html', report=source_index,
+                           matrix=matrix, prop_names=DISAGREEMENT_PROPERTIES)
+
+@APP.route("/reports/<int:report_id>/disagreements/<prop_name>/" +
+           "<int:release_a>/<int:release_b>/<int:value_a>/<int:value_b>/")
+def report_disagreement_keys(report_id, prop_name, release_a, release_b, value_a, value_b):
+    """Show a page of the keys in a cell of the tool disagreement matrix."""
+    source_index = _get_report(report_id)
+    if prop_name not in DISAGREEMENT_PROPERTIES:
+        raise NotFound('No disagreements for property %s' % prop_name)
+    page = _requested_page()
+    query = keys_for_cell(source_index, prop_name, release_a, release_b, value_a, value_b)
+    key_count = query.count()
+    return render_template('disagreement_keys.html', report=source_index,
+                           prop_name=prop_name, tools=release_names(),
+                           release_a=release_a, release_b=release_b,
+                           value_a=PropertyValue.by_id(value_a),
+                           value_b=PropertyValue.by_id(value_b),
+                           keys=query.offset((page - 1) * PAGE_SIZE).limit(PAGE_SIZE).all(),
+                           key_count=key_count, page=page,
+                           page_count=max((key_count - 1) // PAGE_SIZE + 1, 1))
+
+@APP.route("/reports/<int:report_id>/groups/", defaults={'prop_name': 'PUID'})
+@APP.route("/reports/<int:report_id>/groups/<prop_name>/")
+def report_groups(report_id, prop_name):
+    """Show the per group breakdown of a report."""
+    source_index = _get_report(report_id)
+    return render_template('report_groups.html', report=source_index,
+                           breakdown=_get_groups(source_index, prop_name),
+                           prop_names=DISAGREEMENT_PROPERTIES)
 
 @APP.route("/reports/<int:report_id>/prop/<int:prop_id>/propval/<int:prop_val_id>")
 def report_key_by_prop(report_id, prop_id, prop_val_id):
@@ -284,6 +552,30 @@ def unauth_handler(unauthorized):
                            http_code=401,
                            http_error="Unauthorized")
 
+@APP.before_request
+def start_request_metrics():
+    """Start timing the request and counting its queries."""
+    g.request_start = time.time()
+    reset_query_stats()
+
+@APP.after_request
+def record_request_metrics(response):
+    """Record the request's latency and query count against its route."""
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.time() - start,
+                                (route, request.method, response.status_code))
+        queries, seconds = query_stats()
+        REQUEST_QUERIES.observe(queries, (route,))
+        REQUEST_QUERY_SECONDS.observe(seconds, (route,))
+    return response
+
+@APP.before_first_request
+def start_jobs():
+    """Start the background indexing workers."""
+    JOBS.start()
+
 @APP.teardown_appcontext
 def shutdown_session(exception=None):
     """Tear down the database session."""
@@ -293,46 +585,50 @@ def shutdown_session(exception=None):
 
 def _folder_list(source, encoded_filepath, show_hidden):
     _fs, filter_key = _get_fs_and_key(source, encoded_filepath)
+    if request.args.get('refresh') == 'true':
+        _fs.invalidate_listings(filter_key)
     if not _fs.key_exists(filter_key):
         raise NotFound('Folder %s not found' % encoded_filepath)
-    folders = _fs.list_folders(filter_key=filter_key, show_hidden=show_hidden)
-    files = _fs.list_files(filter_key=filter_key, show_hidden=show_hidden)
+    sort = request.args.get('sort', SORT_NAME)
+    if sort not in SORT_FIELDS:
+        raise BadRequest('Sort must be one of %s' % ', '.join(SORT_FIELDS))
+    descending = request.args.get('order') == 'desc'
+    page = _requested_page()
+    cursor = request.args.get('cursor')
+    if not cursor and (page - 1) * PAGE_SIZE > MAX_LISTING_OFFSET:
+        # Send deep pages to the last page reached by offset, its next links
+        # carry on with cursors
+        args = request.args.to_dict()
+        args['page'] = MAX_LISTING_OFFSET // PAGE_SIZE + 1
+        return redirect('{}?{}'.format(quote(request.script_root + request.path),
+                                       urlencode(sorted(args.items()))))
+    try:
+        listing = _fs.list_page(filter_key=filter_key, sort=sort, descending=descending,
+                                page_size=PAGE_SIZE,
+                                offset=0 if cursor else (page - 1) * PAGE_SIZE,
+                                cursor=cursor, show_hidden=show_hidden)
+    except ValueError:
+        raise BadRequest('Malformed cursor %s' % cursor)
     return render_template('folder_list.html', source=source, filter_key=filter_key,
-                           properties=_fs.supported_properties, folders=folders,
-                           files=files, show_hidden=show_hidden)
+                           properties=_fs.supported_properties, keys=listing.keys,
+                           next_cursor=listing.next_cursor, page=page,
+                           sort=sort, descending=descending, show_hidden=show_hidden)
 
 def _add_index(source, encoded_filepath, analyse_sub_folders):
     _fs, filter_key = _get_fs_and_key(source, encoded_filepath)
     filter_key = filter_key if filter_key else SourceKey('')
     if not _fs.key_exists(filter_key):
         raise NotFound('Folder %s not found' % encoded_filepath)
-    _index = SourceIndex(source, datetime.now(), filter_key.value)
-    _index.put()
-    for source_key in _fs.list_files(filter_key=filter_key, recurse=analyse_sub_folders):
-        # get the full key and byte sequence properties
-        full_source_key = _fs.get_key(source_key.value)
-        _bs, bs_props = _fs.get_byte_sequence_properties(full_source_key)
-
-        key = Key(_index, source_key.value, source_key.size,
-                  dateutil.parser.parse(source_key.last_modified), byte_sequence=_bs)
-        key.put()
-        _add_key_properties(key, full_source_key.properties)
-        _add_byte_sequence_properties(_bs, bs_props)
-    return list_reports()
-
-def _add_key_properties(key, properties):
-    for prop_name in properties:
-        db_prop = Property.putdate(prop_name)
-        db_prop_val = PropertyValue.putdate(properties[prop_name])
-        KeyProperty.putdate(key, db_prop, db_prop_val)
-
-def _add_byte_sequence_properties(byte_sequence, properties):
-    for format_tool_release in properties:
-        logging.debug("ByteSequence property from tool: %s", format_tool_release)
-        for prop_name in properties[format_tool_release]:
-            db_prop = Property.putdate(prop_name)
-            db_prop_val = PropertyValue.putdate(properties[format_tool_release][prop_name])
-            ByteSequenceProperty.putdate(byte_sequence, format_tool_release, db_prop, db_prop_val)
+    job = JOBS.submit(source, filter_key.value, analyse_sub_folders)
+    logging.info("Queued indexing job %d for %s", job.id, filter_key.value)
+    if _request_wants_json():
+        return APP.response_class(response=dumps(_job_to_dict(job)), status=202,
+                                  mimetype=JSON_MIME)
+    return redirect('/reports/', 303)
+
+def _job_to_dict(job):
+    return {'job_id': job.id, 'report_id': job.source_index_id, 'status': job.status,
+            'control': job.control, 'message': job.message}
 
 def _file_details(source, encoded_filepath):
     _fs, _key = _get_fs_and_key(source, encoded_filepath, is_folder=False)
@@ -349,10 +645,44 @@ def _get_key_properties(source, encoded_filepath):
         raise NotFound('File %s not found' % encoded_filepath)
     return key, _fs.get_key_properties(key)
 
+def _get_report(report_id):
+    source_index = SourceIndex.by_id(report_id)
+    if source_index is None:
+        raise NotFound('Report %s not found' % report_id)
+    return source_index
+
+def _get_disagreements(source_index, prop_name):
+    if prop_name not in DISAGREEMENT_PROPERTIES:
+        raise NotFound('No disagreements for property %s' % prop_name)
+    return cached_disagreement_matrix(source_index, prop_name)
+
+def _get_groups(source_index, prop_name):
+    if prop_name not in DISAGREEMENT_PROPERTIES:
+        raise NotFound('No group breakdown for property %s' % prop_name)
+    try:
+        release_id = int(request.args['release']) if request.args.get('release') else None
+    except ValueError:
+        raise BadRequest('Release must be a number')
+    return cached_group_breakdown(source_index, prop_name, release_id)
+
+def _requested_page():
+    try:
+        return max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        raise BadRequest('Page must be a number')
+
+def _get_diff(old_id, new_id):
+    old_index, new_index = SourceIndex.by_id(old_id), SourceIndex.by_id(new_id)
+    if old_index is None or new_index is None:
+        raise NotFound('Report %s not found' % (new_id if old_index else old_id))
+    try:
+        return IndexDiff(old_index, new_index)
+    except ValueError:
+        raise BadRequest('Reports %s and %s are of different sources' % (old_id, new_id))
+
 def _get_fs_and_key(source, encoded_filepath, is_folder=True):
     try:
-        _fs = AS3Bucket(source) \
-            if source.scheme == SCHEMES['AS3'] else FileSystem(source)
+        _fs = source_file_system(source)
     except ValueError:
         logging.warning('Could not find source %s.', source.name)
         raise NotFound('Could not find source {}'.format(source.name))
@@ -367,9 +697,22 @@ def _download_item(source, encoded_filepath):
     _fs, key = _get_fs_and_key(source, encoded_filepath, is_folder=False)
     if not _fs.key_exists(key):
         raise NotFound('File %s not found' % encoded_filepath)
-    temp_file, _ = _fs.get_path_and_byte_seq(key)
+    key = _fs.get_key(key.value)
     mime_type = MimeTypes().guess_type(key.value)[0]
-    response = make_response(send_file(temp_file, mimetype=mime_type))
+    start, stop = 0, key.size
+    byte_range = request.range.range_for_length(key.size) if request.range else None
+    if byte_range is not None:
+        start, stop = byte_range
+    elif request.range and len(request.range.ranges) == 1:
+        raise RequestedRangeNotSatisfiable(length=key.size)
+    # Multiple ranges aren't supported so they get the whole file
+    response = APP.response_class(stream_with_context(_fs.stream_key(key, start, stop)),
+                                  mimetype=mime_type, direct_passthrough=True)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.content_length = stop - start
+    if byte_range is not None:
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, stop, key.size)
     response.headers["Content-Disposition"] = \
         "attachment; " \
         "filename*=UTF-8''{quoted_filename}".format(
@@ -378,16 +721,15 @@ def _download_item(source, encoded_filepath):
     return response
 
 def _request_wants_json():
-    best = request.accept_mimetypes \
-        .best_match([JSON_MIME, PDF_MIME])
-    return best == JSON_MIME and \
-        request.accept_mimetypes[best] > \
-        request.accept_mimetypes[PDF_MIME]
+    return _request_wants(JSON_MIME)
 
 def _request_wants_xml():
+    return _request_wants(XML_MIME)
+
+def _request_wants(mime_type):
     best = request.accept_mimetypes \
-        .best_match([XML_MIME, PDF_MIME])
-    return best == XML_MIME and \
+        .best_match([mime_type, PDF_MIME])
+    return best == mime_type and \
         request.accept_mimetypes[best] > \
         request.accept_mimetypes[PDF_MIME]
 
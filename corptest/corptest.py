@@ -16,6 +16,7 @@ Initialisation module for package, kicks of the flask app.
 """
 import logging
 import sys
+import threading
 __version__ = '0.2.0'
 __python_magic_version__ = '0.4.13'
 __opf_fido_version__ = '1.3.5'
@@ -36,58 +37,66 @@ logging.basicConfig(filename=APP.config['LOG_FILE'], level=logging.DEBUG,
 logging.info("Started JISC RDSS Format Identification app.")
 
 from .model_sources import SCHEMES, get_property_from_bs # pylint: disable-msg=C0413
+from .model_sources import Source, FormatTool, FormatToolRelease # pylint: disable-msg=C0413
 from .model_properties import init_db # pylint: disable-msg=C0413
 APP.jinja_env.globals.update(get_property_from_bs=get_property_from_bs) # pylint: disable-msg=E1101
 
 logging.debug("Configured logging.")
-logging.info("Initialising database.")
-init_db()
 
-if not APP.config['IS_FIDO']:
-    logging.warning("Python %r doesn't allow for inline FIDO support.", sys.version_info)
-else:
-    logging.info("Python %r enables inline FIDO support.", sys.version_info)
+_INIT_LOCK = threading.Lock()
+_INITIALISED = []
 
-from .model_sources import Source, FormatTool, FormatToolRelease # pylint: disable-msg=C0413
-from .format_tools import get_format_tool_instance # pylint: disable-msg=C0413
-from .sources import AS3Bucket, FileSystem # pylint: disable-msg=C0413
-
-BUCKET_LIST = APP.config.get('BUCKETS', {})
-logging.info("Loading config BUCKETS to the bucket table")
-for _bucket in BUCKET_LIST:
-    logging.debug("Checking bucket: %s", _bucket)
-    if not Source.by_location(_bucket['location']):
-        _source = Source(AS3Bucket.NAMESPACE, _bucket['name'], _bucket['description'],
-                         SCHEMES['AS3'], _bucket['location'])
-        logging.debug("Adding bucket source: %s", _source)
-        Source.add(_source)
-    else:
-        _source = Source.by_location(_bucket['location'])
-        logging.debug("FOUND bucket source: %s", _source)
-
-FOLDER_LIST = APP.config.get('FOLDERS', {})
-logging.info("Loading config FOLDERS the file_system table")
-for _folder in FOLDER_LIST:
-    logging.debug("Checking folder: %s", _folder)
-    if not Source.by_location(_folder['location']):
-        _source = Source(FileSystem.NAMESPACE, _folder['name'], _folder['description'],
-                         SCHEMES['FILE'], _folder['location'])
-        logging.debug("Adding folder source: %s", _source)
-        Source.add(_source)
+def init_app():
+    """Create the database tables, load the configured sources and tools and
+    probe the tools for their versions. Importing the package does none of
+    this so workers and command line tools start quickly, the web app calls
+    this before its first request. Safe to call more than once."""
+    with _INIT_LOCK:
+        if _INITIALISED:
+            return
+        logging.info("Initialising database.")
+        init_db()
+
+        if not APP.config['IS_FIDO']:
+            logging.warning("Python %r doesn't allow for inline FIDO support.", sys.version_info)
+        else:
+            logging.info("Python %r enables inline FIDO support.", sys.version_info)
+
+        from .format_tools import get_format_tool_instance
+        from .sources import AS3Bucket, FileSystem
+
+        logging.info("Loading config BUCKETS to the bucket table")
+        for bucket in APP.config.get('BUCKETS', {}):
+            _load_source(bucket, AS3Bucket.NAMESPACE, SCHEMES['AS3'])
+
+        logging.info("Loading config FOLDERS the file_system table")
+        for folder in APP.config.get('FOLDERS', {}):
+            _load_source(folder, FileSystem.NAMESPACE, SCHEMES['FILE'])
+
+        logging.debug("Loading config TOOLS to the format_tools table")
+        for tool in APP.config.get('TOOLS', {}):
+            logging.debug("Registering tool: %s, from tool list.", tool)
+            FormatTool.putdate(tool['namespace'], tool['name'], tool['description'],
+                               tool['reference'])
+
+        logging.debug("Setting all tools unavailable")
+        FormatToolRelease.all_unavailable()
+        for format_tool in FormatTool.all():
+            get_format_tool_instance(format_tool)
+        _INITIALISED.append(True)
+
+def _load_source(config, namespace, scheme):
+    logging.debug("Checking source: %s", config)
+    source = Source.by_location(config['location'])
+    if not source:
+        source = Source(namespace, config['name'], config['description'], scheme,
+                        config['location'])
+        logging.debug("Adding source: %s", source)
+        Source.add(source)
     else:
-        _source = Source.by_location(_folder['location'])
-        logging.debug("FOUND folder source: %s", _source)
-
-TOOL_LIST = APP.config.get('TOOLS', {})
-logging.debug("Loading config TOOLS to the format_tools table")
-for _tool in TOOL_LIST:
-    logging.debug("Registering tool: %s, from tool list.", _tool)
-    FormatTool.putdate(_tool['namespace'], _tool['name'], _tool['description'], _tool['reference'])
-
-logging.debug("Setting all tools unavailable")
-FormatToolRelease.all_unavailable()
-for _tool in FormatTool.all():
-    get_format_tool_instance(_tool)
+        logging.debug("FOUND source: %s", source)
+
+APP.before_first_request(init_app)
 
 # Import the application routes
 logging.info("Setting up application routes")
@@ -15,8 +15,10 @@ from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 from .corptest import APP
+from .metrics import track_queries
 
 ENGINE = create_engine(APP.config['SQL_URL'], convert_unicode=True)
+track_queries(ENGINE)
 DB_SESSION = scoped_session(sessionmaker(autocommit=False,
                                          autoflush=False,
                                          bind=ENGINE))
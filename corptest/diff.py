@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""
+Set based differences between two SourceIndexes of the same Source.
+
+Keys are matched on path using the (source_index_id, path) unique index so
+each change type is a single join in the database rather than a comparison of
+two full reports in Python:
+  - added: paths in the new index that aren't in the old one;
+  - removed: paths in the old index that aren't in the new one; and
+  - modified: paths in both where the size, last modified time or byte
+    sequence differ.
+Format drift summarises modified keys whose MIME or PUID changed, grouped by
+tool release and old and new value.
+"""
+import collections
+from json import dumps
+
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import aliased
+
+from .database import DB_SESSION
+from .model_sources import ByteSequence, FormatTool, FormatToolRelease, Key
+from .model_properties import ByteSequenceProperty, Property, PropertyValue
+from .utilities import check_param_not_none, timestamp_fmt
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+CHANGE_TYPES = (ADDED, REMOVED, MODIFIED)
+DRIFT_PROPERTIES = ('MIME', 'PUID')
+DIFF_BATCH_SIZE = 1000
+
+DiffEntry = collections.namedtuple('DiffEntry', ['change', 'path', 'old_size', 'new_size',
+                                                 'old_modified', 'new_modified',
+                                                 'old_sha1', 'new_sha1'])
+DriftEntry = collections.namedtuple('DriftEntry', ['tool', 'version', 'prop_name',
+                                                   'old_value', 'new_value', 'count', 'size'])
+
+_OLD = aliased(Key, name='old_key')
+_NEW = aliased(Key, name='new_key')
+_OLD_BS = aliased(ByteSequence, name='old_bs')
+_NEW_BS = aliased(ByteSequence, name='new_bs')
+
+class IndexDiff(object):
+    """The differences between an old and a new SourceIndex of one Source."""
+    def __init__(self, old_index, new_index):
+        check_param_not_none(old_index, "old_index")
+        check_param_not_none(new_index, "new_index")
+        if old_index.source_id != new_index.source_id:
+            raise ValueError("Can only diff indexes of the same source.")
+        self.__old_index = old_index
+        self.__new_index = new_index
+
+    @property
+    def old_index(self):
+        """Return the old SourceIndex."""
+        return self.__old_index
+
+    @property
+    def new_index(self):
+        """Return the new SourceIndex."""
+        return self.__new_index
+
+    def _query(self, change):
+        """Return the query for DiffEntry column values of a change type,
+        ordered by path."""
+        # pylint: disable-msg=C0121
+        if change not in CHANGE_TYPES:
+            raise ValueError("Unknown change type {}.".format(change))
+        old_join = and_(_OLD.source_index_id == self.__old_index.id, _OLD.path == _NEW.path)
+        if change == REMOVED:
+            new_join = and_(_NEW.source_index_id == self.__new_index.id,
+                            _NEW.path == _OLD.path)
+            return DB_SESSION.query(_OLD.path, _OLD.size, _OLD.last_modified, _OLD_BS.sha1).\
+                select_from(_OLD).\
+                outerjoin(_NEW, new_join).\
+                outerjoin(_OLD_BS, _OLD_BS.id == _OLD.byte_sequence_id).\
+                filter(_OLD.source_index_id == self.__old_index.id).\
+                filter(_NEW.id == None).\
+                order_by(_OLD.path)
+        if change == ADDED:
+            return DB_SESSION.query(_NEW.path, _NEW.size, _NEW.last_modified, _NEW_BS.sha1).\
+                select_from(_NEW).\
+                outerjoin(_OLD, old_join).\
+                outerjoin(_NEW_BS, _NEW_BS.id == _NEW.byte_sequence_id).\
+                filter(_NEW.source_index_id == self.__new_index.id).\
+                filter(_OLD.id == None).\
+                order_by(_NEW.path)
+        return DB_SESSION.query(_NEW.path, _OLD.size, _NEW.size,
+                                _OLD.last_modified, _NEW.last_modified,
+                                _OLD_BS.sha1, _NEW_BS.sha1).\
+            select_from(_NEW).\
+            join(_OLD, old_join).\
+            outerjoin(_OLD_BS, _OLD_BS.id == _OLD.byte_sequence_id).\
+            outerjoin(_NEW_BS, _NEW_BS.id == _NEW.byte_sequence_id).\
+            filter(_NEW.source_index_id == self.__new_index.id).\
+            filter(or_(_OLD.size != _NEW.size,
+                       _OLD.last_modified != _NEW.last_modified,
+                       func.coalesce(_OLD.byte_sequence_id, -1) != \
+                       func.coalesce(_NEW.byte_sequence_id, -1))).\
+            order_by(_NEW.path)
+
+    @staticmethod
+    def _entry(change, row):
+        if change == ADDED:
+            path, size, modified, sha1 = row
+            return DiffEntry(change, path, None, size, None, modified, None, sha1)
+        if change == REMOVED:
+            path, size, modified, sha1 = row
+            return DiffEntry(change, path, size, None, modified, None, sha1, None)
+        return DiffEntry(change, *row)
+
+    def counts(self):
+        """Return an ordered dict of change type to a (count, bytes) tuple,
+        bytes are from the new index except for removed keys."""
+        ret_val = collections.OrderedDict()
+        for change in CHANGE_TYPES:
+            size_column = _OLD.size if change == REMOVED else _NEW.size
+            subquery = self._query(change).order_by(None).\
+                with_entities(size_column.label('size')).subquery()
+            count, size = DB_SESSION.query(func.count(), func.sum(subquery.c.size)).one()
+            ret_val[change] = (count, size if size else 0)
+        return ret_val
+
+    def changes(self, change, offset=0, limit=None):
+        """Return a page of DiffEntry tuples of a change type in path order."""
+        query = self._query(change).offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return [self._entry(change, row) for row in query]
+
+    def iter_changes(self, batch_size=DIFF_BATCH_SIZE):
+        """Generator of all DiffEntry tuples, added, removed then modified, each
+        in path order. Results are read in batches of batch_size using keyset
+        pagination on path so memory use doesn't grow with the index size."""
+        for change in CHANGE_TYPES:
+            path_column = _OLD.path if change == REMOVED else _NEW.path
+            last_path = None
+            while True:
+                query = self._query(change)
+                if last_path is not None:
+                    query = query.filter(path_column > last_path)
+                batch = query.limit(batch_size).all()
+                if not batch:
+                    break
+                for row in batch:
+                    yield self._entry(change, row)
+                last_path = batch[-1][0]
+
+    def format_drift(self, prop_names=DRIFT_PROPERTIES):
+        """Return a list of DriftEntry tuples, one per tool release, property and
+        old / new value pair that changed for keys in both indexes, most common
+        first."""
+        old_prop = aliased(ByteSequenceProperty, name='old_prop')
+        new_prop = aliased(ByteSequenceProperty, name='new_prop')
+        old_val = aliased(PropertyValue, name='old_val')
+        new_val = aliased(PropertyValue, name='new_val')
+        count = func.count(_NEW.id)
+        query = DB_SESSION.query(FormatTool.namespace, FormatToolRelease.version,
+                                 Property.name, old_val.value, new_val.value,
+                                 count, func.sum(_NEW.size)).\
+            select_from(_NEW).\
+            join(_OLD, and_(_OLD.source_index_id == self.__old_index.id,
+                            _OLD.path == _NEW.path)).\
+            join(old_prop, old_prop.byte_sequence_id == _OLD.byte_sequence_id).\
+            join(new_prop, and_(new_prop.byte_sequence_id == _NEW.byte_sequence_id,
+                                new_prop.format_tool_release_id == \
+                                old_prop.format_tool_release_id,
+                                new_prop.prop_id == old_prop.prop_id)).\
+            join(Property, Property.id == new_prop.prop_id).\
+            join(old_val, old_val.id == old_prop.prop_val_id).\
+            join(new_val, new_val.id == new_prop.prop_val_id).\
+            join(FormatToolRelease, FormatToolRelease.id == new_prop.format_tool_release_id).\
+            join(FormatTool, FormatTool.id == FormatToolRelease.format_tool_id).\
+            filter(_NEW.source_index_id == self.__new_index.id).\
+            filter(_OLD.byte_sequence_id != _NEW.byte_sequence_id).\
+            filter(old_prop.prop_val_id != new_prop.prop_val_id).\
+            filter(Property.name.in_(prop_names)).\
+            group_by(FormatTool.namespace, FormatToolRelease.version, Property.name,
+                     old_val.value, new_val.value).\
+            order_by(count.desc())
+        return [DriftEntry(*row) for row in query]
+
+def entry_to_dict(entry):
+    """Flattens a DiffEntry to a dictionary for reporting."""
+    ret_val = collections.OrderedDict()
+    ret_val['Change'] = entry.change
+    ret_val['Path'] = entry.path
+    ret_val['Old size'] = entry.old_size
+    ret_val['New size'] = entry.new_size
+    ret_val['Old last modified'] = timestamp_fmt(entry.old_modified) \
+        if entry.old_modified else None
+    ret_val['New last modified'] = timestamp_fmt(entry.new_modified) \
+        if entry.new_modified else None
+    ret_val['Old SHA1'] = entry.old_sha1
+    ret_val['New SHA1'] = entry.new_sha1
+    return ret_val
+
+def ndjson_diff_generator(index_diff, batch_size=DIFF_BATCH_SIZE):
+    """Generator that yields newline delimited JSON for a diff, one object per
+    changed key, see entry_to_dict."""
+    for entry in index_diff.iter_changes(batch_size):
+        yield dumps(entry_to_dict(entry)) + '\n'
+
+def json_diff_generator(index_diff, batch_size=DIFF_BATCH_SIZE):
+    """Generator that yields the JSON serialisation of a diff in chunks, a
+    header with the index ids and change counts then one chunk per change."""
+    counts = collections.OrderedDict((change, {'Count': count, 'Size': size})
+                                     for change, (count, size) in index_diff.counts().items())
+    yield '{{"Old": {}, "New": {}, "Counts": {}, "Changes": ['.format(
+        index_diff.old_index.id, index_diff.new_index.id, dumps(counts))
+    separator = ''
+    for entry in index_diff.iter_changes(batch_size):
+        yield separator + dumps(entry_to_dict(entry))
+        separator = ', '
+    yield ']}'
@@ -13,18 +13,24 @@
 import collections
 import os.path
 import subprocess
-
-import magic
-from fido import fido
-
+import threading
 
 from .corptest import APP, __opf_fido_version__, __python_magic_version__
-from .formats import MagicType, MimeType, PronomId
+from .formats import MagicType, MimeType, PronomId, fido_instance
 from .model_sources import FormatToolRelease
 from .utilities import check_param_not_none
 
-MIME_IDENT = magic.Magic(mime=True)
-MAGIC_IDENT = magic.Magic()
+_MAGIC_LOCK = threading.Lock()
+_MAGIC_IDENTS = {}
+
+def magic_identifier(mime=False):
+    """Return the shared libmagic identifier for MIME types or magic strings,
+    python-magic is imported and libmagic loaded on first use."""
+    with _MAGIC_LOCK:
+        if mime not in _MAGIC_IDENTS:
+            import magic
+            _MAGIC_IDENTS[mime] = magic.Magic(mime=mime)
+    return _MAGIC_IDENTS[mime]
 
 class FineFreeFile(object):
     """The Fine Free File Command encapsulated"""
@@ -185,7 +191,6 @@ class DROID(object):
 
 class FIDO(object):
     """FIDO encapsulated"""
-    FIDO = fido.Fido(quiet=True, nocontainer=True)
     __executions__ = {
     }
     __version = __opf_fido_version__ if APP.config['IS_FIDO'] else None
@@ -249,14 +254,15 @@ class FIDO(object):
         retval = []
         size = os.stat(path).st_size
         fp_to_id = open(path, 'rb')
-        bofbuffer, eofbuffer, _ = cls.FIDO.get_buffers(fp_to_id, size, seekable=True)
-        matches = cls.FIDO.match_formats(bofbuffer, eofbuffer)
+        fido = fido_instance()
+        bofbuffer, eofbuffer, _ = fido.get_buffers(fp_to_id, size, seekable=True)
+        matches = fido.match_formats(bofbuffer, eofbuffer)
         for (sig, sig_name) in matches:
             mime = sig.find('mime')
             mime_text = ""
             if mime is not None:
                 mime_text = mime.text
-            pronom_id = PronomId(cls.FIDO.get_puid(sig), sig_name, mime_text)
+            pronom_id = PronomId(fido.get_puid(sig), sig_name, mime_text)
             retval.append(pronom_id)
         return retval
 
@@ -310,10 +316,10 @@ class PythonMagic(object):
         if not self.version:
             return None
         metadata = {}
-        mime_string = MIME_IDENT.from_file(path)
+        mime_string = magic_identifier(mime=True).from_file(path)
         mime_type = MimeType.from_mime_string(mime_string)
         metadata['MIME'] = mime_type.get_short_string()
-        magic_string = MAGIC_IDENT.from_file(path)
+        magic_string = magic_identifier().from_file(path)
         magic_type = MagicType.from_magic_string(magic_string)
         metadata['MAGIC'] = magic_type
         return metadata
@@ -11,6 +11,19 @@
 #
 """Classes for modelling format information"""
 import collections
+import threading
+
+_FIDO_LOCK = threading.Lock()
+_FIDO = []
+
+def fido_instance():
+    """Return the Fido identifier shared by the process, the fido package is
+    imported and its signatures loaded on first use."""
+    with _FIDO_LOCK:
+        if not _FIDO:
+            from fido import fido
+            _FIDO.append(fido.Fido(quiet=True, nocontainer=True))
+    return _FIDO[0]
 
 class MagicType(object):
     """Class to model a "magic" type, returned from libmagic or the file
@@ -61,8 +74,6 @@ class MagicType(object):
 
 class PronomId(object):
     """Models PRONOM unique identifiers, or PUIDs and their attributes"""
-    from fido import fido
-    FIDO = fido.Fido(quiet=True, nocontainer=True)
     PUIDS = collections.defaultdict(dict)
 
     def __init__(self, puid, sig_name, mime):
@@ -113,14 +124,15 @@ class PronomId(object):
         cls.PUIDS = collections.defaultdict(dict)
         pron_id = PronomId.get_default()
         cls.PUIDS.update({pron_id.puid : pron_id})
-        for form in cls.FIDO.formats:
-            puid = cls.FIDO.get_puid(form)
+        fido = fido_instance()
+        for form in fido.formats:
+            puid = fido.get_puid(form)
             mime = form.find('mime')
             mime_text = None
             if not mime is None:
                 mime_text = mime.text
             sig_name_text = None
-            for sig in cls.FIDO.get_signatures(form):
+            for sig in fido.get_signatures(form):
                 sig_name = sig.find('name')
                 if not sig_name is None:
                     sig_name_text = sig_name.text
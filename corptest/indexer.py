@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""
+Background indexing of sources.
+
+Indexing requests are recorded as rows in the job table and processed by a
+pool of worker threads, so queued jobs survive a restart. Each process's
+workers share an id recorded on the jobs they run and refresh a heartbeat on
+them, a running job whose heartbeat goes stale was interrupted and is queued
+again. Jobs with a live heartbeat belong to another process and are left alone.
+
+Running jobs record a checkpoint, the last key listed, before each batch.
+Files are listed in a stable order so a requeued or resumed job lists from
+its checkpoint and skips the few keys committed after it, found using the
+unique (source_index_id, path) constraint on keys.
+"""
+import atexit
+from datetime import datetime
+import logging
+import os
+import socket
+import threading
+import uuid
+try:
+    from queue import Full, Queue
+except ImportError:
+    from Queue import Full, Queue
+
+import dateutil.parser
+from sqlalchemy.exc import SQLAlchemyError
+
+from .corptest import APP
+from .database import DB_SESSION
+from .metrics import METRICS
+from .model_sources import Job, Key, SourceIndex, _add_all
+from .model_properties import ByteSequenceProperty, KeyProperty, Property, PropertyValue
+from .progress import IndexProgress, PROGRESS, tracking
+from .sources import SourceKey, source_file_system
+from .utilities import check_param_not_none, KeyGrouper
+
+KEY_GROUPER = KeyGrouper(APP.config.get('KEY_GROUP_DEPTH'), APP.config.get('KEY_GROUP_REGEX'))
+INDEX_BATCH_SIZE = APP.config.get('INDEX_BATCH_SIZE')
+INDEX_LIST_AHEAD = APP.config.get('INDEX_LIST_AHEAD')
+# Put on the listed key queue when the listing ends
+_END_OF_LISTING = object()
+
+def index_source(source_index, recurse=False, progress=None, check=None,
+                 batch_size=INDEX_BATCH_SIZE, start_after=None):
+    """Lists the files beneath the root key of source_index, adding a Key with
+    its byte sequence and tool properties for each, then marks it complete.
+    Keys that can't be read or identified are logged and counted as errors
+    in progress rather than failing the whole index.
+
+    If check is given it's called with the value of the last key listed, or
+    None, before every batch of batch_size keys. If it returns a value, e.g.
+    a pause or cancel request, indexing stops and that value is returned
+    leaving the index incomplete. Otherwise None is returned.
+
+    To resume an index pass the last checkpoint as start_after, listing
+    carries on after it and keys committed since the checkpoint are skipped."""
+    check_param_not_none(source_index, "source_index")
+    progress = progress if progress is not None else IndexProgress(source_index.id)
+    _fs = source_file_system(source_index.source)
+    filter_key = SourceKey(source_index.root_key)
+    # Index what's there now, not what the browser cached
+    _fs.invalidate_listings(filter_key)
+    resuming = source_index.key_count > 0
+    if resuming:
+        logging.info("Resuming index %d after key %s", source_index.id, start_after)
+    # Keys are listed once, on a separate thread that runs ahead of the
+    # processing loop so they're counted and the ETA known sooner
+    listed, stop_listing = Queue(INDEX_LIST_AHEAD), threading.Event()
+    lister = threading.Thread(target=_list_keys, name='lister-{}'.format(source_index.id),
+                              args=(_fs, filter_key, recurse, start_after, progress,
+                                    listed, stop_listing))
+    lister.daemon = True
+    lister.start()
+    last_value = None
+    try:
+        with tracking(progress):
+            for count, source_key in enumerate(iter(listed.get, _END_OF_LISTING)):
+                if isinstance(source_key, Exception):
+                    raise source_key
+                if check is not None and count % batch_size == 0:
+                    request = check(last_value)
+                    if request:
+                        return request
+                last_value = source_key.value
+                if resuming and Key.exists(source_index.id, source_key.value):
+                    progress.key_processed(0)
+                    continue
+                try:
+                    _index_key(_fs, source_index, source_key, progress)
+                except SQLAlchemyError:
+                    raise
+                except Exception: # pylint: disable-msg=W0703
+                    logging.exception("Failed to index key %s", source_key.value)
+                    DB_SESSION.rollback()
+                    progress.error()
+    finally:
+        stop_listing.set()
+        lister.join()
+    source_index.complete()
+    return None
+
+def _index_key(_fs, source_index, source_key, progress):
+    # get the full key and byte sequence properties
+    full_source_key = _fs.get_key(source_key.value)
+    _bs, bs_props = _fs.get_byte_sequence_properties(full_source_key)
+
+    # The tool results go first and the Key, with its own properties, is
+    # committed last in one transaction as the record that its path is done,
+    # a resumed index skips the paths of committed keys
+    add_byte_sequence_properties(_bs, bs_props)
+    key = Key(source_index, source_key.value, source_key.size,
+              dateutil.parser.parse(source_key.last_modified), byte_sequence=_bs,
+              group=KEY_GROUPER.group(source_key.value))
+    _add_all([key] + key_properties(key, full_source_key.properties))
+    progress.key_processed(int(source_key.size) if source_key.size else 0,
+                           ['{} {}'.format(release.format_tool.name, release.version)
+                            for release in bs_props])
+
+def _list_keys(_fs, filter_key, recurse, start_after, progress, listed, stop):
+    """Listing thread target, counts the keys to be indexed and puts them on
+    the bounded listed queue, followed by the end of listing marker or the
+    exception that stopped it. Returns early if stop is set."""
+    def _put(item):
+        while not stop.is_set():
+            try:
+                listed.put(item, timeout=0.5)
+                return True
+            except Full:
+                pass
+        return False
+    try:
+        for source_key in _fs.list_files(filter_key=filter_key, recurse=recurse,
+                                         start_after=start_after):
+            progress.key_listed()
+            if not _put(source_key):
+                return
+        progress.listing_complete = True
+        _put(_END_OF_LISTING)
+    except Exception as excep: # pylint: disable-msg=W0703
+        _put(excep)
+    finally:
+        DB_SESSION.remove()
+
+def key_properties(key, properties):
+    """Returns KeyProperty instances for the source properties, e.g. S3 ETags,
+    of a new key that hasn't been added, to be added along with it."""
+    return [KeyProperty(key, Property.putdate(prop_name),
+                        PropertyValue.putdate(properties[prop_name]))
+            for prop_name in properties]
+
+def add_byte_sequence_properties(byte_sequence, properties):
+    """Store the per tool release properties of a byte sequence."""
+    for format_tool_release in properties:
+        logging.debug("ByteSequence property from tool: %s", format_tool_release)
+        for prop_name in properties[format_tool_release]:
+            db_prop = Property.putdate(prop_name)
+            db_prop_val = PropertyValue.putdate(properties[format_tool_release][prop_name])
+            ByteSequenceProperty.putdate(byte_sequence, format_tool_release, db_prop, db_prop_val)
+
+class JobQueue(object):
+    """Runs queued indexing jobs on a pool of daemon worker threads. Workers
+    are woken when a job is submitted and otherwise poll the job table every
+    poll_interval seconds, picking up jobs queued by other processes.
+
+    Running jobs get a heartbeat every heartbeat_interval seconds, jobs whose
+    heartbeat is more than heartbeat_timeout seconds old are requeued."""
+    def __init__(self, workers=1, poll_interval=5.0, heartbeat_interval=30.0,
+                 heartbeat_timeout=120.0):
+        if workers < 1:
+            raise ValueError("Argument workers must be one or more.")
+        if heartbeat_timeout <= heartbeat_interval:
+            raise ValueError("Argument heartbeat_timeout must be more than heartbeat_interval.")
+        self.__workers = workers
+        self.__poll_interval = poll_interval
+        self.__heartbeat_interval = heartbeat_interval
+        self.__heartbeat_timeout = heartbeat_timeout
+        self.__wakeup = threading.Condition()
+        self.__lock = threading.Lock()
+        self.__stopping = threading.Event()
+        self.__stop_beating = threading.Event()
+        self.__registered = False
+        self.__threads = []
+        self.__heart = None
+        self.__worker_id = None
+
+    @property
+    def workers(self):
+        """Return the number of worker threads."""
+        return self.__workers
+
+    @property
+    def worker_id(self):
+        """Return the id recorded on jobs run by this queue, set on start."""
+        return self.__worker_id
+
+    @property
+    def is_started(self):
+        """Return True once the worker threads have been started."""
+        return bool(self.__threads)
+
+    def start(self):
+        """Requeue interrupted jobs and start the worker and heartbeat threads,
+        only the first call has any effect."""
+        with self.__lock:
+            if self.__threads:
+                return
+            if self.__worker_id is None:
+                # Taken on start rather than import so forked processes differ
+                self.__worker_id = '{}:{}:{}'.format(socket.gethostname()[:40], os.getpid(),
+                                                     uuid.uuid4().hex[:8])
+            self._requeue_stale()
+            if not self.__registered:
+                # Let idle workers release their connections before exit
+                atexit.register(self.stop, self.__poll_interval)
+                self.__registered = True
+            self.__heart = threading.Thread(target=self._beat, name='indexer-heartbeat')
+            self.__heart.daemon = True
+            self.__heart.start()
+            for worker in range(self.__workers):
+                thread = threading.Thread(target=self._work, name='indexer-{}'.format(worker))
+                thread.daemon = True
+                thread.start()
+                self.__threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Ask the worker threads to exit once their current job is done and
+        wait up to timeout seconds for them."""
+        with self.__lock:
+            self.__stopping.set()
+            with self.__wakeup:
+                self.__wakeup.notify_all()
+            for thread in self.__threads:
+                thread.join(timeout)
+            # Keep the heartbeat going until the workers have finished
+            self.__stop_beating.set()
+            if self.__heart is not None:
+                self.__heart.join(timeout)
+            self.__threads, self.__heart = [], None
+            self.__stopping.clear()
+            self.__stop_beating.clear()
+
+    def submit(self, source, root_key='', recurse=False):
+        """Create a SourceIndex for source and a queued Job to fill it,
+        returning the Job. The workers are started if they haven't been."""
+        check_param_not_none(source, "source")
+        source_index = SourceIndex(source, datetime.now(), root_key)
+        source_index.put()
+        job = Job(source_index, recurse)
+        job.put()
+        self.start()
+        self.wake()
+        return job
+
+    def wake(self):
+        """Wake an idle worker to look for queued jobs, e.g. after a resume."""
+        with self.__wakeup:
+            self.__wakeup.notify()
+
+    def _work(self):
+        """Worker thread target, runs jobs until the queue is stopped."""
+        while not self.__stopping.is_set():
+            try:
+                job_id = self._claim_next()
+                if job_id is None:
+                    with self.__wakeup:
+                        if not self.__stopping.is_set():
+                            self.__wakeup.wait(self.__poll_interval)
+                    continue
+                self.run(job_id, self.__worker_id)
+            except Exception: # pylint: disable-msg=W0703
+                logging.exception("Indexing worker error")
+            finally:
+                DB_SESSION.remove()
+
+    def _beat(self):
+        """Heartbeat thread target, keeps this queue's running jobs alive
+        between their batches, which can be slow for large keys."""
+        while not self.__stop_beating.wait(self.__heartbeat_interval):
+            try:
+                Job.heartbeat(self.__worker_id)
+            except Exception: # pylint: disable-msg=W0703
+                logging.exception("Indexing heartbeat error")
+            finally:
+                DB_SESSION.remove()
+
+    def _requeue_stale(self):
+        requeued = Job.requeue_stale(self.__heartbeat_timeout)
+        if requeued:
+            logging.info("Requeued %d interrupted indexing jobs", requeued)
+
+    def _claim_next(self):
+        # Pick up jobs whose worker died since start up as well
+        self._requeue_stale()
+        for job in Job.by_status(Job.QUEUED):
+            if Job.claim(job.id, self.__worker_id):
+                return job.id
+        return None
+
+    @staticmethod
+    def run(job_id, worker_id=None):
+        """Run the claimed job with id job_id until it finishes or is paused or
+        cancelled, recording the outcome. Jobs that were paused or interrupted
+        carry on from their last checkpoint. A paused job returns here so its
+        worker can pick up the next queued job, as does one that's no longer
+        running under worker_id, e.g. after being requeued as stale."""
+        job = Job.by_id(job_id)
+        logging.info("Running indexing job %d for index %d", job.id, job.source_index_id)
+        progress = IndexProgress(job.source_index_id, PROGRESS,
+                                 APP.config.get('PROGRESS_FLUSH_INTERVAL'),
+                                 APP.config.get('PROGRESS_WINDOW'))
+        progress.flush()
+        try:
+            request = index_source(job.source_index, job.recurse, progress,
+                                   check=lambda last: Job.acknowledge_control(job_id, last,
+                                                                              worker_id),
+                                   start_after=job.checkpoint)
+            if request == Job.LOST:
+                logging.warning("Indexing job %d is no longer run by worker %s", job_id,
+                                worker_id)
+                return
+            if request == Job.PAUSE:
+                logging.info("Paused indexing job %d", job_id)
+            elif request == Job.CANCEL:
+                logging.info("Cancelling indexing job %d", job_id)
+                job.source_index.complete(partial=True)
+                job.finish(Job.CANCELLED)
+            else:
+                job.finish(Job.COMPLETED)
+        except Exception as excep: # pylint: disable-msg=W0703
+            logging.exception("Indexing job %d failed", job_id)
+            DB_SESSION.rollback()
+            job.finish(Job.FAILED, str(excep))
+        progress.flush(job.status)
+
+JOBS = JobQueue(APP.config.get('INDEX_WORKERS'), APP.config.get('JOB_POLL_INTERVAL'),
+                APP.config.get('JOB_HEARTBEAT_INTERVAL'), APP.config.get('JOB_HEARTBEAT_TIMEOUT'))
+
+def _job_queue_depth():
+    counts = Job.count_by_status()
+    return dict(((status,), counts.get(status, 0))
+                for status in (Job.QUEUED, Job.RUNNING, Job.PAUSED))
+
+METRICS.gauge('corptest_jobs', 'Indexing jobs waiting, running or paused.', _job_queue_depth,
+              ('status',))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""
+Application metrics in the Prometheus text exposition format.
+
+Counters and histograms are sharded by thread: each thread only ever writes
+to its own shard, a plain dictionary, so recording a value takes no lock. A
+scrape sums the shards, taking the registry lock only to walk the list of
+shards and fold those of finished threads into a retired total. Gauges are
+callbacks evaluated at scrape time.
+
+Database queries are counted per thread by SQLAlchemy cursor events so the
+web app can report the queries made while handling each request.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+class MetricsRegistry(object):
+    """Registry of named metrics whose values are held in per thread shards."""
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__metrics = []
+        self.__shards = []
+        self.__retired = {}
+
+    def counter(self, name, documentation, labelnames=()):
+        """Register and return a Counter."""
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """Register and return a Histogram."""
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback, labelnames=()):
+        """Register a Gauge whose value is returned by callback at scrape time,
+        either a number or, for labelled gauges, a dictionary of label value
+        tuples to numbers."""
+        return self._register(Gauge(self, name, documentation, callback, labelnames))
+
+    def _register(self, metric):
+        with self.__lock:
+            if any(existing.name == metric.name for existing in self.__metrics):
+                raise ValueError("Metric {} is already registered.".format(metric.name))
+            self.__metrics.append(metric)
+        return metric
+
+    def shard(self):
+        """Return the calling thread's shard, creating it on first use."""
+        shard = getattr(self.__local, 'shard', None)
+        if shard is None:
+            shard = {}
+            self.__local.shard = shard
+            with self.__lock:
+                self.__shards.append((threading.current_thread(), shard))
+        return shard
+
+    def collect(self):
+        """Return a dictionary of (metric name, label values) to the summed
+        value across all threads. Shards of finished threads are folded into
+        the retired totals so thread churn doesn't grow the registry."""
+        with self.__lock:
+            live = []
+            for thread, shard in self.__shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    _merge(self.__retired, shard)
+            self.__shards = live
+            totals = {}
+            _merge(totals, self.__retired)
+            for _, shard in live:
+                # Copying a dict holds the GIL throughout so the owning thread
+                # can't resize it mid copy
+                _merge(totals, dict(shard))
+        return totals
+
+    def exposition(self):
+        """Return all metrics in the Prometheus text format."""
+        totals = self.collect()
+        lines = []
+        with self.__lock:
+            metrics = list(self.__metrics)
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples(totals))
+        return '\n'.join(lines) + '\n'
+
+class _Metric(object):
+    """Base class of the registered metrics."""
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames):
+        self._registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labelvalues):
+        labelvalues = tuple(str(value) for value in labelvalues)
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError("Metric {} expects labels {}.".format(self.name, self.labelnames))
+        return (self.name, labelvalues)
+
+    def _labels(self, labelvalues, extra=()):
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, _escape(value))
+                              for name, value in pairs) + '}'
+
+    def _own(self, totals):
+        return sorted((labelvalues, value) for (name, labelvalues), value in totals.items()
+                      if name == self.name)
+
+class Counter(_Metric):
+    """Monotonically increasing total."""
+    kind = COUNTER
+
+    def inc(self, labelvalues=(), amount=1):
+        """Add amount to the counter for the label values."""
+        shard = self._registry.shard()
+        key = self._key(labelvalues)
+        shard[key] = shard.get(key, 0) + amount
+
+    def samples(self, totals):
+        """Return the exposition lines for the counter, an unlabelled counter
+        is reported as zero until it's incremented."""
+        samples = self._own(totals)
+        if not samples and not self.labelnames:
+            samples = [((), 0)]
+        return ['{}{} {}'.format(self.name, self._labels(labelvalues), _format(value))
+                for labelvalues, value in samples]
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets."""
+    kind = HISTOGRAM
+
+    def __init__(self, registry, name, documentation, labelnames, buckets):
+        super(Histogram, self).__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labelvalues=()):
+        """Record value for the label values."""
+        shard = self._registry.shard()
+        key = self._key(labelvalues)
+        # Bucket counts, then the sum and count of observations
+        counts = shard.get(key)
+        if counts is None:
+            counts = [0] * (len(self.buckets) + 3)
+            shard[key] = counts
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def time(self, labelvalues=()):
+        """Context manager that observes the seconds spent inside it."""
+        return _Timer(self, labelvalues)
+
+    def samples(self, totals):
+        """Return the exposition lines for the histogram, with cumulative
+        bucket counts."""
+        lines = []
+        for labelvalues, counts in self._own(totals):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format(bound)
+                lines.append('{}_bucket{} {}'.format(self.name,
+                                                     self._labels(labelvalues, [('le', le)]),
+                                                     cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self._labels(labelvalues),
+                                              _format(counts[-2])))
+            lines.append('{}_count{} {}'.format(self.name, self._labels(labelvalues),
+                                                counts[-1]))
+        return lines
+
+class Gauge(_Metric):
+    """Current value read from a callback at scrape time."""
+    kind = GAUGE
+
+    def __init__(self, registry, name, documentation, callback, labelnames):
+        super(Gauge, self).__init__(registry, name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self, totals):
+        """Return the exposition lines for the gauge, a failing callback is
+        logged and reported as no samples."""
+        try:
+            value = self.callback()
+        except Exception: # pylint: disable-msg=W0703
+            logging.exception("Failed to read gauge %s", self.name)
+            return []
+        values = value.items() if isinstance(value, dict) else [((), value)]
+        return ['{}{} {}'.format(self.name, self._labels(labelvalues), _format(value))
+                for labelvalues, value in sorted(values)]
+
+class _Timer(object):
+    """Observes the elapsed seconds of a with block on a histogram."""
+    def __init__(self, histogram, labelvalues):
+        self.__histogram = histogram
+        self.__labelvalues = labelvalues
+        self.__start = None
+
+    def __enter__(self):
+        self.__start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.__histogram.observe(time.time() - self.__start, self.__labelvalues)
+
+def _merge(totals, shard):
+    for key, value in shard.items():
+        if isinstance(value, list):
+            current = totals.get(key)
+            totals[key] = list(value) if current is None else \
+                [left + right for left, right in zip(current, value)]
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+METRICS = MetricsRegistry()
+
+DB_QUERIES = METRICS.counter('corptest_db_queries_total',
+                             'Database queries executed.')
+DB_QUERY_SECONDS = METRICS.counter('corptest_db_query_seconds_total',
+                                   'Seconds spent executing database queries.')
+
+_QUERIES = threading.local()
+
+def track_queries(engine):
+    """Count the queries executed on engine, and the time they take, both in
+    total and for the current thread."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):# pylint: disable-msg=W0612,R0913,W0613
+        context._query_start = time.time()# pylint: disable-msg=W0212
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):# pylint: disable-msg=W0612,R0913,W0613
+        elapsed = time.time() - context._query_start# pylint: disable-msg=W0212
+        DB_QUERIES.inc()
+        DB_QUERY_SECONDS.inc(amount=elapsed)
+        _QUERIES.count = getattr(_QUERIES, 'count', 0) + 1
+        _QUERIES.seconds = getattr(_QUERIES, 'seconds', 0.0) + elapsed
+
+def reset_query_stats():
+    """Start counting the current thread's queries from zero."""
+    _QUERIES.count = 0
+    _QUERIES.seconds = 0.0
+
+def query_stats():
+    """Return a (count, seconds) tuple of the queries made by the current
+    thread since reset_query_stats() was called."""
+    return getattr(_QUERIES, 'count', 0), getattr(_QUERIES, 'seconds', 0.0)
@@ -433,12 +433,18 @@ class ByteSequenceProperty(BASE):
         return ByteSequenceProperty.query.filter(ByteSequenceProperty.byte_sequence_id == id).all()
 
     @staticmethod
-    def by_key_and_byte_sequence_id(byte_sequence_id, prop_id):# pylint: disable-msg=W0622,C0103
-        """Query for ByteSequenceProperty with matching id."""
+    def by_key_and_byte_sequence_id(byte_sequence_id, prop_id,
+                                    format_tool_release_id=None):# pylint: disable-msg=W0622,C0103
+        """Query for ByteSequenceProperty with matching id, optionally reported by
+        a particular format tool release."""
         check_param_not_none(id, "id")
-        return ByteSequenceProperty.query.filter(ByteSequenceProperty.prop_id == prop_id,
-                                                 ByteSequenceProperty.byte_sequence_id \
-                                                 == byte_sequence_id).first()
+        query = ByteSequenceProperty.query.filter(ByteSequenceProperty.prop_id == prop_id,
+                                                  ByteSequenceProperty.byte_sequence_id \
+                                                  == byte_sequence_id)
+        if format_tool_release_id is not None:
+            query = query.filter(ByteSequenceProperty.format_tool_release_id == \
+                                 format_tool_release_id)
+        return query.first()
 
     @staticmethod
     def get_properties_for_index(source_index_id):
@@ -476,12 +482,58 @@ class ByteSequenceProperty(BASE):
     @classmethod
     def putdate(cls, byte_sequence, format_tool, prop, prop_val):
         """Create or update the ByteSequenceProperty."""
-        ret_val = cls.by_key_and_byte_sequence_id(byte_sequence.id, prop.id)
+        ret_val = cls.by_key_and_byte_sequence_id(byte_sequence.id, prop.id, format_tool.id)
         if ret_val is None:
             ret_val = ByteSequenceProperty(byte_sequence, format_tool, prop, prop_val)
             ret_val.put()
         return ret_val
 
+# Columns added to tables after they were first created, create_all() won't
+# add them to an existing database. Each is (table, column, column definition,
+# statement to backfill existing rows or None).
+ADDED_COLUMNS = [
+    # Indexes built before completion was recorded were complete when stored
+    ('source_index', 'completed', 'DATETIME',
+     'UPDATE source_index SET completed = timestamp WHERE completed IS NULL'),
+    # SQLite can only add a NOT NULL column with a default
+    ('source_index', 'partial', 'BOOLEAN NOT NULL DEFAULT 0', None),
+    ('job', 'control', 'VARCHAR(20)', None),
+    ('job', 'checkpoint', 'VARCHAR(2048)', None),
+    ('job', 'worker_id', 'VARCHAR(64)', None),
+    ('job', 'heartbeat_at', 'DATETIME', None),
+    # Existing keys have no group, group_breakdown() treats NULL as ''
+    ('key', 'key_group', 'VARCHAR(2048)', None),
+]
+# Indexes on those columns as (table, CREATE INDEX IF NOT EXISTS statement)
+ADDED_INDEXES = [
+    ('key', 'CREATE INDEX IF NOT EXISTS ix_key_index_group ON key (source_index_id, key_group)'),
+]
+
 def init_db():
     """Initialise the database."""
     BASE.metadata.create_all(bind=ENGINE)
+    upgrade_db()
+
+def upgrade_db(bind=ENGINE):
+    """Add the ADDED_COLUMNS and ADDED_INDEXES missing from existing tables of
+    the database at bind, backfilling the columns. Safe to call repeatedly."""
+    with bind.begin() as conn:
+        tables = {}
+        def _columns(table):
+            if table not in tables:
+                tables[table] = [row[1] for row in
+                                 conn.execute('PRAGMA table_info("{}")'.format(table))]
+            return tables[table]
+        for table, column, definition, backfill in ADDED_COLUMNS:
+            columns = _columns(table)
+            # Missing tables are created complete by create_all()
+            if not columns or column in columns:
+                continue
+            logging.info("Adding column %s to table %s", column, table)
+            conn.execute('ALTER TABLE "{}" ADD COLUMN {} {}'.format(table, column, definition))
+            columns.append(column)
+            if backfill:
+                conn.execute(backfill)
+        for table, statement in ADDED_INDEXES:
+            if _columns(table):
+                conn.execute(statement)
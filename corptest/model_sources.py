@@ -10,13 +10,13 @@
 # about the terms of this license.
 #
 """SQL Alchemy database model classes."""
-from datetime import datetime
+from datetime import datetime, timedelta
 import errno
 import logging
 import os.path
 
 from sqlalchemy import and_, Column, DateTime, Integer, String, ForeignKey
-from sqlalchemy import UniqueConstraint, Boolean, func
+from sqlalchemy import UniqueConstraint, Boolean, Index, Text, func, or_
 from sqlalchemy.orm import relationship
 
 from .database import BASE, DB_SESSION
@@ -139,6 +139,8 @@ class SourceIndex(BASE):
     source_id = Column(Integer, ForeignKey('source.id'), nullable=False)# pylint: disable-msg=C0103
     root_key = Column(String(2048), nullable=False)
     timestamp = Column(DateTime, nullable=False)
+    completed = Column(DateTime)
+    partial = Column(Boolean, nullable=False, default=False)
     source = relationship("Source")
     keys = relationship("Key")
     __table_args__ = (UniqueConstraint('source_id', 'timestamp', name='uix_source_date'),)
@@ -148,6 +150,7 @@ class SourceIndex(BASE):
         self.source = source
         self.timestamp = timestamp if timestamp else datetime.now()
         self.root_key = '' if not root_key else root_key
+        self.partial = False
 
     @property
     def iso_timestamp(self):
@@ -159,6 +162,29 @@ class SourceIndex(BASE):
         """ Return the ISO formatted String of the SourceIndex's timestamp. """
         return timestamp_fmt(self.timestamp)
 
+    @property
+    def is_complete(self):
+        """Returns True once all of the index's keys have been added."""
+        return self.completed is not None
+
+    def complete(self, completed=None, partial=False):
+        """Record that indexing has finished, partial is True if it stopped
+        before all of the keys were added."""
+        self.completed = completed if completed else datetime.now()
+        self.partial = partial
+        DB_SESSION.commit()
+
+    @property
+    def version_tag(self):
+        """Returns a String that changes whenever the index's content changes,
+        the completion time for complete indexes or the number of keys and
+        highest key id for indexes that are still being built."""
+        if self.is_complete:
+            return self.completed.strftime('%Y%m%d%H%M%S%f')
+        count, max_id = DB_SESSION.query(func.count(Key.id), func.max(Key.id)).\
+            filter(Key.source_index_id == self.id).one()
+        return 'partial-{}-{}'.format(count, max_id if max_id else 0)
+
     @property
     def key_count(self):
         """Return all the keys in the index."""
@@ -223,6 +249,13 @@ class SourceIndex(BASE):
             raise ValueError("id argument can not be null")
         return SourceIndex.query.filter(SourceIndex.id == id).first()
 
+    @staticmethod
+    def by_source(source):
+        """Query for all SourceIndexes of a Source, oldest first."""
+        check_param_not_none(source, "source")
+        return SourceIndex.query.filter(SourceIndex.source_id == source.id).\
+            order_by(SourceIndex.timestamp).all()
+
     @staticmethod
     def add(source_index):
         """Add a SourceIndex instance to the table."""
@@ -238,12 +271,15 @@ class Key(BASE):
     path = Column(String(2048), nullable=False)
     size = Column(Integer, nullable=False)
     last_modified = Column(DateTime, nullable=False)
+    group = Column('key_group', String(2048))
 
     source_index = relationship("SourceIndex")
     byte_sequence = relationship("ByteSequence")
-    __table_args__ = (UniqueConstraint('source_index_id', 'path', name='uix_source_path'),)
+    __table_args__ = (UniqueConstraint('source_index_id', 'path', name='uix_source_path'),
+                      Index('ix_key_index_group', 'source_index_id', 'key_group'))
 
-    def __init__(self, source_index, path, size=0, last_modified=None, byte_sequence=None):
+    def __init__(self, source_index, path, size=0, last_modified=None, byte_sequence=None,
+                 group=None):
         check_param_not_none(source_index, "source_index")
         check_param_not_none(path, "path")
         if size is None:
@@ -257,6 +293,7 @@ class Key(BASE):
         self.size = size
         self.last_modified = last_modified
         self.byte_sequence = byte_sequence
+        self.group = group
 
     @property
     def name(self):
@@ -325,12 +362,258 @@ class Key(BASE):
         check_param_not_none(id, "id")
         return Key.query.filter(Key.source_index_id == id).all()
 
+    @staticmethod
+    def exists(source_index_id, path):
+        """Returns True if the index with id source_index_id has a key for path."""
+        return DB_SESSION.query(Key.query.filter(Key.source_index_id == source_index_id,
+                                                 Key.path == path).exists()).scalar()
+
     @staticmethod
     def add(data_node):
         """Add a DataNode instance to the table."""
         check_param_not_none(data_node, "data_node")
         _add(data_node)
 
+class IndexAggregate(BASE):
+    """Cached aggregate analysis results for a SourceIndex, stored as JSON and
+    tagged with the index version they were computed from."""
+    __tablename__ = 'index_aggregate'
+
+    id = Column(Integer, primary_key=True)# pylint: disable-msg=C0103
+    source_index_id = Column(Integer, ForeignKey('source_index.id'), nullable=False)
+    name = Column(String(100), nullable=False)
+    version_tag = Column(String(50), nullable=False)
+    value = Column(Text, nullable=False)
+
+    source_index = relationship("SourceIndex")
+    __table_args__ = (UniqueConstraint('source_index_id', 'name', name='uix_index_aggregate'),)
+
+    def __init__(self, source_index, name, version_tag, value):
+        check_param_not_none(source_index, "source_index")
+        check_param_not_none(name, "name")
+        check_param_not_none(version_tag, "version_tag")
+        check_param_not_none(value, "value")
+        self.source_index = source_index
+        self.name = name
+        self.version_tag = version_tag
+        self.value = value
+
+    @staticmethod
+    def by_index_and_name(source_index, name):
+        """Query for the named aggregate of a SourceIndex."""
+        check_param_not_none(source_index, "source_index")
+        check_param_not_none(name, "name")
+        return IndexAggregate.query.filter(IndexAggregate.source_index_id == source_index.id,
+                                           IndexAggregate.name == name).first()
+
+    @staticmethod
+    def putdate(source_index, name, version_tag, value):
+        """Add or update the named aggregate of a SourceIndex."""
+        ret_val = IndexAggregate.by_index_and_name(source_index, name)
+        if ret_val is None:
+            ret_val = IndexAggregate(source_index, name, version_tag, value)
+            DB_SESSION.add(ret_val)
+        else:
+            ret_val.version_tag = version_tag
+            ret_val.value = value
+        DB_SESSION.commit()
+        return ret_val
+
+class Job(BASE):
+    """A background indexing job that fills a SourceIndex with keys."""
+    __tablename__ = 'job'
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    PAUSED = 'paused'
+    COMPLETED = 'completed'
+    CANCELLED = 'cancelled'
+    FAILED = 'failed'
+    # Requests to a running job, honoured between batches
+    PAUSE = 'pause'
+    CANCEL = 'cancel'
+    # Returned to a worker whose running Job has been requeued or taken over
+    LOST = 'lost'
+
+    id = Column(Integer, primary_key=True)# pylint: disable-msg=C0103
+    source_index_id = Column(Integer, ForeignKey('source_index.id'), nullable=False)
+    recurse = Column(Boolean, nullable=False)
+    status = Column(String(20), nullable=False, index=True)
+    created = Column(DateTime, nullable=False)
+    started = Column(DateTime)
+    finished = Column(DateTime)
+    message = Column(String(1024))
+    control = Column(String(20))
+    # Value of the last key listed before the most recent batch, every key
+    # listed up to and including it has been committed
+    checkpoint = Column(String(2048))
+    # The worker running the Job and when it last reported the Job alive,
+    # Jobs whose heartbeat goes stale are queued again
+    worker_id = Column(String(64))
+    heartbeat_at = Column(DateTime)
+
+    source_index = relationship("SourceIndex")
+
+    def __init__(self, source_index, recurse=False):
+        check_param_not_none(source_index, "source_index")
+        self.source_index = source_index
+        self.recurse = bool(recurse)
+        self.status = self.QUEUED
+        self.created = datetime.now()
+
+    @property
+    def is_active(self):
+        """Returns True if the job is queued or running."""
+        return self.status in (self.QUEUED, self.RUNNING)
+
+    def finish(self, status, message=None):
+        """Record that the job has finished with status and an optional message."""
+        self.status = status
+        self.control = None
+        self.finished = datetime.now()
+        self.message = message[:1024] if message else None
+        DB_SESSION.commit()
+
+    def pause(self):
+        """Pause a queued job or ask a running one to pause before its next
+        batch. Returns False if the job can't be paused."""
+        return self._transition((self.QUEUED, {Job.status: self.PAUSED}),
+                                (self.RUNNING, {Job.control: self.PAUSE},
+                                 or_(Job.control == None, Job.control == self.PAUSE)))
+
+    def resume(self):
+        """Queue a paused job again, or withdraw a pause request that a
+        running job hasn't acted on yet. Returns False if the job isn't paused."""
+        return self._transition((self.PAUSED, {Job.status: self.QUEUED}),
+                                (self.RUNNING, {Job.control: None}, Job.control == self.PAUSE))
+
+    def cancel(self):
+        """Cancel a queued or paused job, marking its index partial, or ask a
+        running one to stop before its next batch. Returns False if the job
+        has already finished."""
+        cancelled = {Job.status: self.CANCELLED, Job.control: None,
+                     Job.finished: datetime.now()}
+        if not self._transition((self.QUEUED, cancelled), (self.PAUSED, cancelled),
+                                (self.RUNNING, {Job.control: self.CANCEL})):
+            return False
+        if self.status == self.CANCELLED:
+            self.source_index.complete(partial=True)
+        return True
+
+    def _transition(self, *transitions):
+        """Apply the first of the (status, values, criteria...) transitions
+        whose status matches, as a conditional update so concurrent changes by
+        a worker aren't overwritten. As a worker can move the job on between
+        attempts the list is tried again if nothing matched."""
+        # pylint: disable-msg=C0121
+        for _ in range(3):
+            for transition in transitions:
+                status, values, criteria = transition[0], transition[1], transition[2:]
+                updated = Job.query.filter(Job.id == self.id, Job.status == status, *criteria).\
+                    update(values, synchronize_session=False)
+                DB_SESSION.commit()
+                if updated == 1:
+                    return True
+            if not Job.query.filter(Job.id == self.id,
+                                    Job.status.in_((self.QUEUED, self.RUNNING,
+                                                    self.PAUSED))).count():
+                return False
+        return False
+
+    def put(self):
+        """Add the Job to the database."""
+        _add(self)
+
+    @staticmethod
+    def all():
+        """Convenience method, returns all of the Job instances."""
+        return Job.query.order_by(Job.id).all()
+
+    @staticmethod
+    def by_id(id):# pylint: disable-msg=W0622,C0103
+        """Query for Job with matching id."""
+        check_param_not_none(id, "id")
+        return Job.query.filter(Job.id == id).first()
+
+    @staticmethod
+    def by_status(status):
+        """Query for Jobs with a status, oldest first."""
+        check_param_not_none(status, "status")
+        return Job.query.filter(Job.status == status).order_by(Job.id).all()
+
+    @staticmethod
+    def count_by_status():
+        """Returns a dictionary of status to the number of Jobs with it."""
+        return dict(DB_SESSION.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+
+    @staticmethod
+    def claim(id, worker_id=None):# pylint: disable-msg=W0622,C0103
+        """Atomically move a queued Job to running, owned by worker_id, returns
+        False if another worker got there first."""
+        now = datetime.now()
+        claimed = Job.query.filter(Job.id == id, Job.status == Job.QUEUED).\
+            update({Job.status: Job.RUNNING, Job.started: now,
+                    Job.worker_id: worker_id, Job.heartbeat_at: now},
+                   synchronize_session=False)
+        DB_SESSION.commit()
+        return claimed == 1
+
+    @staticmethod
+    def control_for(id):# pylint: disable-msg=W0622,C0103
+        """Return the pending control request, PAUSE or CANCEL, for the Job
+        with matching id or None. Reads the column directly so the result isn't
+        stale in a long running session."""
+        return DB_SESSION.query(Job.control).filter(Job.id == id).scalar()
+
+    @staticmethod
+    def acknowledge_control(id, checkpoint=None, worker_id=None):# pylint: disable-msg=W0622,C0103
+        """Called by the worker running the Job with matching id between
+        batches, refreshing its heartbeat and recording checkpoint if given.
+        If worker_id is given and the Job is no longer running under it LOST
+        is returned and nothing is recorded. A pause request moves the Job
+        to paused and returns PAUSE, a cancel request returns CANCEL, otherwise
+        None is returned."""
+        values = {Job.heartbeat_at: datetime.now()}
+        if checkpoint is not None:
+            values[Job.checkpoint] = checkpoint
+        owned = Job.query.filter(Job.id == id)
+        if worker_id is not None:
+            owned = owned.filter(Job.status == Job.RUNNING, Job.worker_id == worker_id)
+        if owned.update(values, synchronize_session=False) != 1:
+            DB_SESSION.commit()
+            return Job.LOST
+        paused = Job.query.filter(Job.id == id, Job.status == Job.RUNNING,
+                                  Job.control == Job.PAUSE).\
+            update({Job.status: Job.PAUSED, Job.control: None}, synchronize_session=False)
+        DB_SESSION.commit()
+        if paused == 1:
+            return Job.PAUSE
+        return Job.CANCEL if Job.control_for(id) == Job.CANCEL else None
+
+    @staticmethod
+    def heartbeat(worker_id):
+        """Refresh the heartbeat of the running Jobs owned by worker_id,
+        returns the number of Jobs updated."""
+        check_param_not_none(worker_id, "worker_id")
+        updated = Job.query.filter(Job.status == Job.RUNNING, Job.worker_id == worker_id).\
+            update({Job.heartbeat_at: datetime.now()}, synchronize_session=False)
+        DB_SESSION.commit()
+        return updated
+
+    @staticmethod
+    def requeue_stale(timeout):
+        """Move running Jobs whose heartbeat is more than timeout seconds old
+        back to the queue, their worker was interrupted and they'll resume from
+        their checkpoints. Jobs with a live heartbeat, perhaps run by another
+        process, are left alone. Returns the number of requeued Jobs."""
+        # pylint: disable-msg=C0121
+        cutoff = datetime.now() - timedelta(seconds=timeout)
+        requeued = Job.query.filter(Job.status == Job.RUNNING,
+                                    or_(Job.heartbeat_at == None, Job.heartbeat_at < cutoff)).\
+            update({Job.status: Job.QUEUED, Job.worker_id: None}, synchronize_session=False)
+        DB_SESSION.commit()
+        return requeued
+
 class ByteSequence(BASE):
     """Key attributes for all byte sequences, i.e. arbitary blobs of data."""
     __tablename__ = 'byte_sequence'
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+""" PDF documents for reports, kept apart so fpdf is only imported when a PDF
+is generated. """
+from fpdf import FPDF
+
+class PDF(FPDF): # pragma: no cover
+    """PDF report generator with header and footer."""
+    def header(self):
+        # Logo
+        # self.image('logo_pb.png', 10, 8, 33)
+        # Arial bold 15
+        self.set_font('Arial', 'B', 15)
+        # Move to the right
+        self.cell(60)
+        # Title
+        self.cell(80, 10, 'JISC Format Report', 1, 0, 'C')
+        # Line break
+        self.ln(20)
+
+    def cell_pair_line(self, key, value):
+        """ Gen a standard PDF report line."""
+        self.cell(50, 10, str(key) + ': ')
+        self.cell(40, 10, str(value))
+        self.ln(5)
+
+    # Page footer
+    def footer(self):
+        # Position at 1.5 cm from bottom
+        self.set_y(-15)
+        # Arial italic 8
+        self.set_font('Arial', 'I', 8)
+        # Page number
+        self.cell(0, 10, 'Page ' + str(self.page_no()) + '/{nb}', 0, 0, 'C')
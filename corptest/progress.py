@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""
+Live progress of running indexes.
+
+Each indexing job owns an IndexProgress whose counters are plain attributes
+updated without locking from the indexing loop. Every flush_interval seconds
+the counters are copied to a snapshot dictionary and published to the shared
+PROGRESS registry, which is what the web app reads. Throughput is measured
+over a rolling window of published snapshots.
+
+Code that doesn't know which index it's working for, e.g. hashing and
+downloading in sources.py, records against the progress tracked for the
+current thread via record_hashed() and record_downloaded().
+"""
+import collections
+from contextlib import contextmanager
+import threading
+import time
+
+MEGABYTE = 1024 * 1024
+
+_LOCAL = threading.local()
+
+class IndexProgress(object):
+    """In memory progress counters for a single running index."""
+    def __init__(self, source_index_id, registry=None, flush_interval=2.0, window=60.0):
+        self.source_index_id = source_index_id
+        self.listed = 0
+        self.listing_complete = False
+        self.processed = 0
+        self.processed_bytes = 0
+        self.hashed_bytes = 0
+        self.downloaded_bytes = 0
+        self.errors = 0
+        self.identified = collections.Counter()
+        self.__registry = registry if registry is not None else PROGRESS
+        self.__flush_interval = flush_interval
+        self.__window = window
+        self.__started = time.time()
+        self.__next_flush = self.__started
+        self.__samples = collections.deque()
+
+    def key_listed(self):
+        """Count a key found by listing the source, this doesn't flush so
+        listing can run on a different thread to processing."""
+        self.listed += 1
+
+    def key_processed(self, size, tool_names=()):
+        """Count a key that has been hashed, identified and stored, along with
+        the names of the tools that identified it."""
+        self.processed += 1
+        self.processed_bytes += size if size else 0
+        for tool_name in tool_names:
+            self.identified[tool_name] += 1
+        self._maybe_flush()
+
+    def error(self):
+        """Count a key that couldn't be processed."""
+        self.errors += 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.time() >= self.__next_flush:
+            self.flush()
+
+    def flush(self, status='running'):
+        """Publish a snapshot of the counters to the registry."""
+        now = time.time()
+        self.__next_flush = now + self.__flush_interval
+        self.__samples.append((now, self.processed, self.processed_bytes))
+        while len(self.__samples) > 2 and now - self.__samples[0][0] > self.__window:
+            self.__samples.popleft()
+        self.__registry.publish(self.source_index_id, self.snapshot(status, now))
+
+    def snapshot(self, status='running', now=None):
+        """Return a dictionary of the counters, rolling files and MB per second
+        and the estimated seconds remaining, which is None until the listing
+        is complete and some keys have been processed."""
+        now = now if now else time.time()
+        files_per_sec, bytes_per_sec = 0.0, 0.0
+        if len(self.__samples) > 1:
+            (first_time, first_files, first_bytes) = self.__samples[0]
+            (last_time, last_files, last_bytes) = self.__samples[-1]
+            elapsed = last_time - first_time
+            if elapsed > 0:
+                files_per_sec = (last_files - first_files) / elapsed
+                bytes_per_sec = (last_bytes - first_bytes) / elapsed
+        eta = None
+        if self.listing_complete and files_per_sec > 0:
+            eta = int(round(max(self.listed - self.processed, 0) / files_per_sec))
+        return {
+            'report_id': self.source_index_id,
+            'status': status,
+            'listed': self.listed,
+            'listing_complete': self.listing_complete,
+            'processed': self.processed,
+            'processed_bytes': self.processed_bytes,
+            'hashed_bytes': self.hashed_bytes,
+            'downloaded_bytes': self.downloaded_bytes,
+            'errors': self.errors,
+            'identified': dict(self.identified),
+            'files_per_sec': round(files_per_sec, 2),
+            'mb_per_sec': round(bytes_per_sec / MEGABYTE, 2),
+            'eta_seconds': eta,
+            'elapsed_seconds': int(now - self.__started),
+            'updated': now
+        }
+
+class ProgressRegistry(object):
+    """Thread safe store of the latest progress snapshot for each index."""
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__snapshots = {}
+
+    def publish(self, source_index_id, snapshot):
+        """Replace the snapshot held for an index."""
+        with self.__lock:
+            self.__snapshots[source_index_id] = snapshot
+
+    def get(self, source_index_id):
+        """Return the latest snapshot for an index or None."""
+        with self.__lock:
+            return self.__snapshots.get(source_index_id)
+
+    def all(self):
+        """Return a dictionary of index id to latest snapshot."""
+        with self.__lock:
+            return dict(self.__snapshots)
+
+    def remove(self, source_index_id):
+        """Forget the snapshot for an index."""
+        with self.__lock:
+            self.__snapshots.pop(source_index_id, None)
+
+PROGRESS = ProgressRegistry()
+
+@contextmanager
+def tracking(progress):
+    """Context manager that makes progress the current thread's tracker."""
+    previous = getattr(_LOCAL, 'progress', None)
+    _LOCAL.progress = progress
+    try:
+        yield progress
+    finally:
+        _LOCAL.progress = previous
+
+def current_progress():
+    """Return the IndexProgress tracked for this thread, or None."""
+    return getattr(_LOCAL, 'progress', None)
+
+def record_hashed(size):
+    """Count bytes hashed against the current thread's index, if any."""
+    progress = current_progress()
+    if progress is not None:
+        progress.hashed_bytes += size
+
+def record_downloaded(size):
+    """Count bytes downloaded against the current thread's index, if any."""
+    progress = current_progress()
+    if progress is not None:
+        progress.downloaded_bytes += size
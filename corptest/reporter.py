@@ -9,41 +9,24 @@
 # License, Version 3. See the text file "COPYING" for further details
 # about the terms of this license.
 #
-""" Reporting as PDF. """
+""" Reporting as PDF and streamed serialisations of report data. """
 import collections
-from fpdf import FPDF
-
-class PDF(FPDF): # pragma: no cover
-    """PDF report generator with header and footer."""
-    def header(self):
-        # Logo
-        # self.image('logo_pb.png', 10, 8, 33)
-        # Arial bold 15
-        self.set_font('Arial', 'B', 15)
-        # Move to the right
-        self.cell(60)
-        # Title
-        self.cell(80, 10, 'JISC Format Report', 1, 0, 'C')
-        # Line break
-        self.ln(20)
-
-    def cell_pair_line(self, key, value):
-        """ Gen a standard PDF report line."""
-        self.cell(50, 10, str(key) + ': ')
-        self.cell(40, 10, str(value))
-        self.ln(5)
-
-    # Page footer
-    def footer(self):
-        # Position at 1.5 cm from bottom
-        self.set_y(-15)
-        # Arial italic 8
-        self.set_font('Arial', 'I', 8)
-        # Page number
-        self.cell(0, 10, 'Page ' + str(self.page_no()) + '/{nb}', 0, 0, 'C')
+import csv
+import io
+from json import dumps
+import sys
+from xml.sax.saxutils import XMLGenerator
+
+from .database import DB_SESSION
+from .model_sources import ByteSequence, FormatTool, FormatToolRelease, Key
+from .model_properties import ByteSequenceProperty, Property, PropertyValue
+
+REPORT_BATCH_SIZE = 1000
+FLAT_REPORT_FIELDS = ['Path', 'Size', 'SHA1', 'Byte sequence size']
 
 def item_pdf_report(key, report_path): # pragma: no cover
     """Generates a PDF report for an item."""
+    from .pdf import PDF
     pdf = PDF()
     pdf.add_page()
     pdf.set_font('Arial', '', 12)
@@ -61,6 +44,7 @@ def item_pdf_report(key, report_path): # pragma: no cover
 
 def pdf_report(report, report_path): # pragma: no cover
     """Generates a PDF report for an item."""
+    from .pdf import PDF
     pdf = PDF()
     pdf.add_page()
     pdf.set_font('Arial', '', 12)
@@ -131,3 +115,229 @@ def props_to_dict(properties):
     for prop in properties:
         ret_val[prop.qualified_name] = prop.prop_val.value
     return ret_val
+
+def iter_report_rows(report, batch_size=REPORT_BATCH_SIZE):
+    """Generator that yields a (path, size, sha1, bs_size, properties) tuple for
+    every key in a report, in key id order. Keys are read in batches of
+    batch_size using keyset pagination and only column values are loaded, so
+    memory use is bounded by the batch size rather than the size of the index.
+    The sha1 and bs_size are None for keys without a byte sequence."""
+    last_id = 0
+    while True:
+        batch = DB_SESSION.query(Key.id, Key.path, Key.size, Key.byte_sequence_id,
+                                 ByteSequence.sha1, ByteSequence.size).\
+                                 outerjoin(ByteSequence).\
+                                 filter(Key.source_index_id == report.id).\
+                                 filter(Key.id > last_id).\
+                                 order_by(Key.id).limit(batch_size).all()
+        if not batch:
+            return
+        properties = _properties_for_byte_sequences(set([row[3] for row in batch
+                                                         if row[3] is not None]))
+        for _, path, size, bs_id, sha1, bs_size in batch:
+            yield path, size, sha1, bs_size, properties.get(bs_id, [])
+        last_id = batch[-1][0]
+
+def _properties_for_byte_sequences(bs_ids):
+    """Returns a dict of byte sequence id to a list of (qualified name, value)
+    tuples for the byte sequences with ids in bs_ids, fetched in one query."""
+    ret_val = collections.defaultdict(list)
+    if not bs_ids:
+        return ret_val
+    query = DB_SESSION.query(ByteSequenceProperty.byte_sequence_id, FormatTool.namespace,
+                             Property.name, PropertyValue.value).\
+                             join(ByteSequenceProperty.format_tool_release).\
+                             join(FormatToolRelease.format_tool).\
+                             join(ByteSequenceProperty.prop).\
+                             join(ByteSequenceProperty.prop_val).\
+                             filter(ByteSequenceProperty.byte_sequence_id.in_(bs_ids)).\
+                             order_by(ByteSequenceProperty.id)
+    for bs_id, namespace, name, value in query:
+        ret_val[bs_id].append((':'.join([namespace, name]), value))
+    return ret_val
+
+def row_to_dict(row):
+    """Flattens a row from iter_report_rows to the same dictionary layout as
+    key_to_dict."""
+    path, size, sha1, bs_size, properties = row
+    ret_val = collections.OrderedDict()
+    ret_val['Path'] = path
+    ret_val['Size'] = size
+    if sha1 is None:
+        ret_val['Byte sequence'] = None
+    else:
+        byte_sequence = collections.OrderedDict()
+        byte_sequence['SHA1'] = sha1
+        byte_sequence['Size'] = bs_size
+        byte_sequence['Properties'] = collections.OrderedDict(properties)
+        ret_val['Byte sequence'] = byte_sequence
+    return ret_val
+
+def json_report_generator(report, batch_size=REPORT_BATCH_SIZE):
+    """Generator that yields the JSON serialisation of report_to_dict(report)
+    in chunks, one per key after a header chunk. The header is yielded before
+    the database is queried for keys so the first byte goes out straight away."""
+    yield '{{"Source": {}, "Root": {}, "Keys": ['.format(dumps(report.source.name),
+                                                        dumps(report.root_key + '/'))
+    separator = ''
+    for row in iter_report_rows(report, batch_size):
+        yield separator + dumps(row_to_dict(row))
+        separator = ', '
+    yield ']}'
+
+class XmlReportWriter(object):
+    """Incremental writer for XML reports, output accumulates in an internal
+    buffer that callers drain after each element so that documents of any
+    size can be streamed. The schema is stable, every element is written in
+    document order so consumers can parse it with a streaming (SAX / iterparse)
+    parser:
+
+        <report source="Source name" root="root/key/">
+          <key path="root/key/file.txt" size="1024"
+               lastModified="2017-01-01 12:00:00">
+            <byteSequence sha1="...40 hex chars..." size="1024">
+              <property name="tool.namespace:MIME">text/plain</property>
+              ...
+            </byteSequence>
+          </key>
+          ...
+        </report>
+
+    The lastModified attribute only appears in single file reports, whose
+    document element is the key element itself. The byteSequence element is
+    omitted for keys that have not been downloaded and characterised.
+    """
+    def __init__(self):
+        self.__buffer = io.BytesIO()
+        self.__xml = XMLGenerator(self.__buffer, 'utf-8')
+        self.__xml.startDocument()
+
+    def drain(self):
+        """Return the bytes written since the last drain and clear the buffer."""
+        ret_val = self.__buffer.getvalue()
+        self.__buffer.seek(0)
+        self.__buffer.truncate()
+        return ret_val
+
+    def start_report(self, source_name, root):
+        """Open the report document element."""
+        self.__xml.startElement('report', collections.OrderedDict([('source', source_name),
+                                                                   ('root', root)]))
+
+    def end_report(self):
+        """Close the report document element and the document."""
+        self.__xml.endElement('report')
+        self.end_document()
+
+    def end_document(self):
+        """Close the document."""
+        self.__xml.endDocument()
+
+    def key(self, path, size, sha1, bs_size, properties, last_modified=None):
+        """Write a complete key element, properties is a list of (qualified name,
+        value) tuples."""
+        attrs = collections.OrderedDict([('path', path), ('size', str(size))])
+        if last_modified is not None:
+            attrs['lastModified'] = str(last_modified)
+        self.__xml.startElement('key', attrs)
+        if sha1 is not None:
+            self.__xml.startElement('byteSequence',
+                                    collections.OrderedDict([('sha1', sha1),
+                                                             ('size', str(bs_size))]))
+            for name, value in properties:
+                self.__xml.startElement('property', {'name': name})
+                self.__xml.characters(u'{}'.format(value))
+                self.__xml.endElement('property')
+            self.__xml.endElement('byteSequence')
+        self.__xml.endElement('key')
+
+def xml_report_generator(report, batch_size=REPORT_BATCH_SIZE):
+    """Generator that yields an XML serialisation of report, in the schema
+    documented by XmlReportWriter, one chunk per key."""
+    writer = XmlReportWriter()
+    writer.start_report(report.source.name, report.root_key + '/')
+    yield writer.drain()
+    for row in iter_report_rows(report, batch_size):
+        writer.key(*row)
+        yield writer.drain()
+    writer.end_report()
+    yield writer.drain()
+
+def xml_file_report(source_key):
+    """Returns the XML serialisation of a single SourceKey with its byte
+    sequence, the document element is a key element."""
+    writer = XmlReportWriter()
+    byte_sequence = source_key.byte_sequence
+    properties = [(prop.qualified_name, prop.prop_val.value)
+                  for prop in byte_sequence.properties] if byte_sequence else []
+    writer.key(source_key.value, source_key.size,
+               byte_sequence.sha1 if byte_sequence else None,
+               byte_sequence.size if byte_sequence else None,
+               properties, source_key.last_modified)
+    writer.end_document()
+    return writer.drain()
+
+def property_names_for_index(report):
+    """Returns the sorted list of qualified property names, one for each tool
+    and property pair, recorded against the byte sequences of a report's keys."""
+    query = DB_SESSION.query(FormatTool.namespace, Property.name).\
+        select_from(ByteSequenceProperty).\
+        join(ByteSequenceProperty.format_tool_release).\
+        join(FormatToolRelease.format_tool).\
+        join(ByteSequenceProperty.prop).\
+        join(Key, Key.byte_sequence_id == ByteSequenceProperty.byte_sequence_id).\
+        filter(Key.source_index_id == report.id).\
+        group_by(FormatTool.namespace, Property.name)
+    return sorted(':'.join([namespace, name]) for namespace, name in query)
+
+def row_to_flat_dict(row):
+    """Flattens a row from iter_report_rows to a single level dictionary, keyed
+    by FLAT_REPORT_FIELDS and the qualified property names of the row."""
+    path, size, sha1, bs_size, properties = row
+    ret_val = collections.OrderedDict(zip(FLAT_REPORT_FIELDS, [path, size, sha1, bs_size]))
+    ret_val.update(properties)
+    return ret_val
+
+def ndjson_report_generator(report, batch_size=REPORT_BATCH_SIZE):
+    """Generator that yields newline delimited JSON for a report, one flat
+    JSON object per key, see row_to_flat_dict."""
+    for row in iter_report_rows(report, batch_size):
+        yield dumps(row_to_flat_dict(row)) + '\n'
+
+class _ChunkWriter(object):
+    """File like target for csv.writer that collects written rows until drained."""
+    def __init__(self):
+        self.__chunks = []
+
+    def write(self, chunk):
+        """Append a chunk."""
+        self.__chunks.append(chunk)
+
+    def drain(self):
+        """Return the chunks written since the last drain as a single string."""
+        ret_val = ''.join(self.__chunks)
+        del self.__chunks[:]
+        return ret_val
+
+def _csv_cell(value):
+    """Python 2's csv module only handles byte strings."""
+    if value is None:
+        return ''
+    if sys.version_info < (3, 0) and isinstance(value, unicode): # pylint: disable-msg=E0602
+        return value.encode('utf-8')
+    return value
+
+def csv_report_generator(report, batch_size=REPORT_BATCH_SIZE):
+    """Generator that yields a CSV serialisation of a report, a header row then
+    one row per key with FLAT_REPORT_FIELDS followed by a column per tool
+    property pair from property_names_for_index."""
+    prop_names = property_names_for_index(report)
+    chunks = _ChunkWriter()
+    writer = csv.writer(chunks)
+    writer.writerow([_csv_cell(field) for field in FLAT_REPORT_FIELDS + prop_names])
+    yield chunks.drain()
+    for path, size, sha1, bs_size, properties in iter_report_rows(report, batch_size):
+        values = dict(properties)
+        writer.writerow([_csv_cell(cell) for cell in [path, size, sha1, bs_size] +
+                         [values.get(name) for name in prop_names]])
+        yield chunks.drain()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""
+Columnar, memory mappable snapshots of SourceIndex contents.
+
+A snapshot is a directory holding one NumPy .npy file per column, plus a
+dictionaries.npz file of the (small) string dictionaries that the code columns
+refer to and a manifest.json describing the lot. Rows are sorted by key path.
+
+Columns:
+  - key_ids.npy: Key.id (int64);
+  - sizes.npy: key size in bytes (int64);
+  - mtimes.npy: key last modified (datetime64[s]);
+  - byte_sequence_ids.npy: ByteSequence.id or -1 if not known (int64);
+  - path_offsets.npy / path_data.npy: UTF-8 encoded paths, concatenated with
+    row i held in path_data[path_offsets[i]:path_offsets[i+1]];
+  - folder_codes.npy / extension_codes.npy: codes into the folders and
+    extensions dictionaries (int32); and
+  - tool_<release_id>_<property>.npy: per tool MIME / PUID codes into the values
+    dictionary (int32), -1 where the tool gave no result.
+"""
+from argparse import ArgumentParser, RawTextHelpFormatter
+import json
+import logging
+import os.path
+import sys
+
+import numpy as np
+
+from .const import EPILOG
+from .corptest import APP, __version__
+from .database import DB_SESSION
+from .model_sources import Key, SourceIndex
+from .model_properties import ByteSequenceProperty, Property, PropertyValue, init_db
+from .utilities import check_param_not_none, create_dirs, Extension
+
+RDSS_ROOT = APP.config.get('RDSS_ROOT')
+SNAPSHOT_ROOT = os.path.join(RDSS_ROOT, 'snapshots')
+SNAPSHOT_PROPERTIES = ('MIME', 'PUID')
+BATCH_SIZE = 10000
+MANIFEST = 'manifest.json'
+DICTIONARIES = 'dictionaries.npz'
+NO_CODE = -1
+
+def snapshot_path(source_index_id, root=SNAPSHOT_ROOT):
+    """Returns the default snapshot directory for a SourceIndex id."""
+    return os.path.join(root, str(source_index_id))
+
+def tool_column_name(release_id, prop_name):
+    """Returns the column name for a tool release's property codes."""
+    return 'tool_{}_{}'.format(release_id, prop_name)
+
+class _Dictionary(object):
+    """Assigns dense integer codes to values in order of first appearance."""
+    def __init__(self):
+        self.__codes = {}
+        self.__values = []
+
+    def encode(self, value):
+        """Return the code for value, adding it to the dictionary if new."""
+        code = self.__codes.get(value)
+        if code is None:
+            code = len(self.__values)
+            self.__codes[value] = code
+            self.__values.append(value)
+        return code
+
+    @property
+    def values(self):
+        """Return the dictionary values as a NumPy unicode array."""
+        return np.array(self.__values, dtype='U') if self.__values \
+            else np.zeros(0, dtype='U1')
+
+def export_snapshot(source_index, dest=None):
+    """Writes a columnar snapshot of source_index to the dest directory,
+    defaulting to snapshot_path(source_index.id), and returns the path."""
+    check_param_not_none(source_index, "source_index")
+    dest = dest if dest else snapshot_path(source_index.id)
+    create_dirs(dest)
+    logging.info("Exporting snapshot of index %d to %s", source_index.id, dest)
+
+    key_ids, sizes, mtimes, bs_ids = [], [], [], []
+    path_offsets, path_chunks = [0], []
+    folders, extensions = _Dictionary(), _Dictionary()
+    folder_codes, extension_codes = [], []
+    query = DB_SESSION.query(Key.id, Key.path, Key.size, Key.last_modified,
+                             Key.byte_sequence_id).\
+                             filter(Key.source_index_id == source_index.id).\
+                             order_by(Key.path).yield_per(BATCH_SIZE)
+    for key_id, path, size, last_modified, bs_id in query:
+        key_ids.append(key_id)
+        sizes.append(size)
+        mtimes.append(last_modified)
+        bs_ids.append(bs_id if bs_id is not None else NO_CODE)
+        encoded = path.encode('utf-8')
+        path_chunks.append(encoded)
+        path_offsets.append(path_offsets[-1] + len(encoded))
+        folder_codes.append(folders.encode(path.rpartition('/')[0]))
+        extension_codes.append(extensions.encode(Extension.parse_from_file_name(path).lower()))
+
+    key_ids = np.array(key_ids, dtype=np.int64)
+    columns = {
+        'key_ids': key_ids,
+        'sizes': np.array(sizes, dtype=np.int64),
+        'mtimes': np.array(mtimes, dtype='datetime64[s]'),
+        'byte_sequence_ids': np.array(bs_ids, dtype=np.int64),
+        'path_offsets': np.array(path_offsets, dtype=np.int64),
+        'path_data': np.array(bytearray(b''.join(path_chunks)), dtype=np.uint8),
+        'folder_codes': np.array(folder_codes, dtype=np.int32),
+        'extension_codes': np.array(extension_codes, dtype=np.int32)
+    }
+    values = _Dictionary()
+    tools = _add_tool_columns(source_index, key_ids, values, columns)
+
+    for name, column in columns.items():
+        np.save(os.path.join(dest, name + '.npy'), column)
+    np.savez(os.path.join(dest, DICTIONARIES), folders=folders.values,
+             extensions=extensions.values, values=values.values)
+    manifest = {
+        'version': __version__,
+        'index_id': source_index.id,
+        'source': source_index.source.name,
+        'root': source_index.root_key,
+        'timestamp': source_index.iso_timestamp,
+        'rows': len(key_ids),
+        'columns': sorted(columns.keys()),
+        'tools': tools
+    }
+    with open(os.path.join(dest, MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    return dest
+
+def _add_tool_columns(source_index, key_ids, values, columns):
+    """Adds a code column per tool release and property to columns, fetching
+    all results for the index in a single query. Returns the tool manifest."""
+    order = np.argsort(key_ids)
+    sorted_ids = key_ids[order]
+    tools = {}
+    query = DB_SESSION.query(Key.id, ByteSequenceProperty.format_tool_release_id,
+                             Property.name, PropertyValue.value).\
+                             join(ByteSequenceProperty,
+                                  ByteSequenceProperty.byte_sequence_id == \
+                                  Key.byte_sequence_id).\
+                             join(Property).join(PropertyValue).\
+                             filter(Key.source_index_id == source_index.id).\
+                             filter(Property.name.in_(SNAPSHOT_PROPERTIES)).\
+                             yield_per(BATCH_SIZE)
+    for key_id, release_id, prop_name, value in query:
+        name = tool_column_name(release_id, prop_name)
+        column = columns.get(name)
+        if column is None:
+            column = np.full(len(key_ids), NO_CODE, dtype=np.int32)
+            columns[name] = column
+            tools.setdefault(str(release_id), []).append(prop_name)
+        column[order[np.searchsorted(sorted_ids, key_id)]] = values.encode(value)
+    return tools
+
+class Snapshot(object):
+    """A loaded snapshot, columns are memory mapped when mmap_mode is set so
+    that queries only page in the columns that they touch."""
+    def __init__(self, path, mmap_mode='r'):
+        check_param_not_none(path, "path")
+        with open(os.path.join(path, MANIFEST)) as manifest_file:
+            self.__manifest = json.load(manifest_file)
+        self.__path = path
+        self.__mmap_mode = mmap_mode
+        self.__columns = {}
+        with np.load(os.path.join(path, DICTIONARIES)) as dictionaries:
+            self.__dictionaries = dict((name, dictionaries[name])
+                                       for name in dictionaries.files)
+
+    @classmethod
+    def for_index(cls, source_index_id, root=SNAPSHOT_ROOT, mmap_mode='r'):
+        """Loads the snapshot for a SourceIndex id from the snapshot root."""
+        return cls(snapshot_path(source_index_id, root), mmap_mode)
+
+    @property
+    def manifest(self):
+        """Return the snapshot's manifest dictionary."""
+        return self.__manifest
+
+    @property
+    def row_count(self):
+        """Return the number of keys in the snapshot."""
+        return self.__manifest['rows']
+
+    def column(self, name):
+        """Return the named column, loading it on first use."""
+        if name not in self.__manifest['columns']:
+            raise ValueError("No column {} in snapshot {}.".format(name, self.__path))
+        if name not in self.__columns:
+            self.__columns[name] = np.load(os.path.join(self.__path, name + '.npy'),
+                                           mmap_mode=self.__mmap_mode)
+        return self.__columns[name]
+
+    def dictionary(self, name):
+        """Return the named string dictionary, folders, extensions or values."""
+        return self.__dictionaries[name]
+
+    @property
+    def sizes(self):
+        """Return the key sizes column."""
+        return self.column('sizes')
+
+    @property
+    def mtimes(self):
+        """Return the key last modified column."""
+        return self.column('mtimes')
+
+    def path(self, row):
+        """Decode and return the path of the key at row."""
+        offsets = self.column('path_offsets')
+        return self.column('path_data')[offsets[row]:offsets[row + 1]].tobytes().decode('utf-8')
+
+    def paths(self, mask=None):
+        """Generator of paths for all rows, or those selected by the boolean mask."""
+        rows = np.arange(self.row_count) if mask is None else np.flatnonzero(mask)
+        for row in rows:
+            yield self.path(row)
+
+    def tool_codes(self, release_id, prop_name):
+        """Return the code column for a tool release property, or None if the
+        tool gave no results for the property."""
+        name = tool_column_name(release_id, prop_name)
+        return self.column(name) if name in self.__manifest['columns'] else None
+
+    def code_for(self, dictionary, value):
+        """Return the code of value in the named dictionary, NO_CODE if absent."""
+        codes = np.flatnonzero(self.dictionary(dictionary) == value)
+        return int(codes[0]) if codes.size else NO_CODE
+
+    def mask_for_value(self, release_id, prop_name, value):
+        """Return a boolean row mask of keys where the tool reported value."""
+        codes = self.tool_codes(release_id, prop_name)
+        code = self.code_for('values', value)
+        if codes is None or code == NO_CODE:
+            return np.zeros(self.row_count, dtype=bool)
+        return codes == code
+
+    def distribution(self, codes, dictionary, mask=None):
+        """Return a list of (value, count, total size) tuples for a code column,
+        most common first, optionally restricted to rows selected by mask."""
+        sizes = self.sizes
+        if mask is not None:
+            codes, sizes = codes[mask], sizes[mask]
+        # Shift codes by one so that NO_CODE can be counted in bin 0
+        counts = np.bincount(codes + 1, minlength=len(self.dictionary(dictionary)) + 1)
+        totals = np.bincount(codes + 1, weights=sizes,
+                             minlength=len(self.dictionary(dictionary)) + 1)
+        values = [''] + list(self.dictionary(dictionary))
+        return [(values[code], int(counts[code]), int(totals[code]))
+                for code in np.argsort(-counts, kind='mergesort') if counts[code]]
+
+    def extension_distribution(self, mask=None):
+        """Return the (extension, count, size) distribution of the snapshot."""
+        return self.distribution(self.column('extension_codes'), 'extensions', mask)
+
+    def tool_distribution(self, release_id, prop_name, mask=None):
+        """Return the (value, count, size) distribution for a tool property."""
+        codes = self.tool_codes(release_id, prop_name)
+        if codes is None:
+            codes = np.full(self.row_count, NO_CODE, dtype=np.int32)
+        return self.distribution(codes, 'values', mask)
+
+DEFAULTS = {
+    'description': """JISC Research Data Shared Service (RDSS) Index Snapshots.
+Exports a SourceIndex to a memory mappable, columnar snapshot.""",
+    'epilog': EPILOG
+}
+
+def main(args=None): # pragma: no cover
+    """Main method entry point, exports the requested index snapshots."""
+    parser = ArgumentParser(description=DEFAULTS['description'],
+                            epilog=DEFAULTS['epilog'],
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('index_ids', type=int, nargs='+',
+                        help='ids of the SourceIndexes to export')
+    parser.add_argument('--dest', default=SNAPSHOT_ROOT,
+                        help='snapshot root directory, default: %(default)s')
+    args = parser.parse_args(args)
+    init_db()
+    for index_id in args.index_ids:
+        source_index = SourceIndex.by_id(index_id)
+        if source_index is None:
+            sys.stderr.write('No index with id {} found.\n'.format(index_id))
+            continue
+        dest = export_snapshot(source_index, snapshot_path(index_id, args.dest))
+        print('Exported index {} snapshot to {}'.format(index_id, dest))
+
+if __name__ == "__main__": # pragma: no cover
+    main()
@@ -13,8 +13,14 @@
 Classes that encapsulate different sources of data to be identified.
 """
 import abc
+import base64
+import bisect
+import calendar
 import collections
 from datetime import datetime
+import heapq
+import itertools
+import json
 import logging
 import os.path
 from os import access, R_OK, stat
@@ -25,25 +31,142 @@ except ImportError:
     from scandir import scandir as scandir
 
 import re
-import tempfile
+import threading
+import time
 
 from botocore import exceptions
-from boto3 import client, resource
 from tzlocal import get_localzone
 from werkzeug.exceptions import Forbidden, NotFound, Unauthorized
 
 from .corptest import APP
 from .blobstore import Sha1Lookup, BlobStore
+from .caches import TtlCache
 from .format_tools import FormatToolRelease, get_format_tool_instance
-from .model_sources import ByteSequence
+from .metrics import METRICS
+from .model_sources import ByteSequence, SCHEMES
 from .model_properties import Property, PropertyValue
-from .utilities import sha1_path, timestamp_fmt, Extension
+from .progress import record_downloaded, record_hashed
+from .utilities import check_param_not_none, sha1_path, timestamp_fmt, Extension
 
 RDSS_ROOT = APP.config.get('RDSS_ROOT')
 BLOB_STORE_ROOT = os.path.join(RDSS_ROOT, 'blobstore')
 
-Sha1Lookup.initialise()
-BLOBSTORE = BlobStore(BLOB_STORE_ROOT)
+BLOBSTORE = BlobStore(BLOB_STORE_ROOT, APP.config.get('BLOB_STORE_FAN_OUT'),
+                      APP.config.get('BLOB_STORE_QUOTA'))
+DOWNLOAD_CHUNK_SIZE = APP.config.get('DOWNLOAD_CHUNK_SIZE')
+# list_objects_v2 results shared by all AS3Bucket instances
+LISTING_CACHE = TtlCache(APP.config.get('S3_LISTING_CACHE_ENTRIES'),
+                         APP.config.get('S3_LISTING_CACHE_TTL'))
+
+S3_REQUESTS = METRICS.counter('corptest_s3_requests_total', 'S3 API calls by operation.',
+                              ('operation',))
+S3_BYTES = METRICS.counter('corptest_s3_downloaded_bytes_total', 'Bytes downloaded from S3.')
+TOOL_SECONDS = METRICS.histogram('corptest_tool_identify_seconds',
+                                 'Format identification latency by tool.', ('tool',))
+TOOL_ERRORS = METRICS.counter('corptest_tool_identify_errors_total',
+                              'Format identifications that raised an error by tool.', ('tool',))
+METRICS.gauge('corptest_blobstore_blobs', 'Blobs held in the BlobStore.',
+              lambda: BLOBSTORE.blob_count)
+METRICS.gauge('corptest_blobstore_bytes', 'Bytes held in the BlobStore.', lambda: BLOBSTORE.size)
+METRICS.gauge('corptest_blobstore_quota_bytes', 'BlobStore quota in bytes, 0 for no limit.',
+              lambda: BLOBSTORE.quota)
+
+SORT_NAME = 'name'
+SORT_SIZE = 'size'
+SORT_MODIFIED = 'modified'
+SORT_FIELDS = (SORT_NAME, SORT_SIZE, SORT_MODIFIED)
+DEFAULT_PAGE_SIZE = 100
+# Deepest offset a listing page can start at, later pages are reached using
+# cursors as offset pages in other than name order hold every earlier key
+MAX_LISTING_OFFSET = 10 * DEFAULT_PAGE_SIZE
+
+class ListingPage(collections.namedtuple('ListingPage', ['keys', 'next_cursor'])):
+    """A page of a sorted folder listing and the cursor for the next page, or
+    None if this is the last page."""
+    __slots__ = ()
+
+    @classmethod
+    def from_keys(cls, keys, page_size, sort):
+        """Create a page from up to page_size + 1 sorted keys, the extra key
+        only signals that there's a next page."""
+        if len(keys) > page_size:
+            keys = keys[:page_size]
+            return cls(keys, encode_cursor(raw_sort_key(keys[-1], sort)))
+        return cls(keys, None)
+
+class _Descending(object):
+    """Wraps a value so that it sorts in reverse order."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __le__(self, other):
+        return self.value >= other.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __ge__(self, other):
+        return self.value <= other.value
+
+def raw_sort_key(key, sort):
+    """Returns the (group, value, name) sort key of a listed key. Name order
+    is the order S3 lists keys in, with folders ending in a slash, for other
+    orders folders are listed before files."""
+    if sort == SORT_NAME:
+        return (0, key.name + ('/' if key.is_folder else ''), '')
+    if sort == SORT_SIZE:
+        value = key.size
+    elif sort == SORT_MODIFIED:
+        value = 0 if key.is_folder or not key.last_mod else \
+            calendar.timegm(key.last_mod.utctimetuple())
+    else:
+        raise ValueError("Unknown sort {}, must be one of {}.".format(sort, SORT_FIELDS))
+    return (0 if key.is_folder else 1, value, key.name)
+
+def sort_key_from_raw(raw, descending):
+    """Returns a comparable sort key from a raw sort key."""
+    group, value, name = raw
+    if descending:
+        return (group, _Descending(value), _Descending(name))
+    return (group, value, name)
+
+def listing_sort_key(sort, descending=False):
+    """Returns a function that gives the comparable sort key of a listed key."""
+    if sort not in SORT_FIELDS:
+        raise ValueError("Unknown sort {}, must be one of {}.".format(sort, SORT_FIELDS))
+    return lambda key: sort_key_from_raw(raw_sort_key(key, sort), descending)
+
+def check_listing_offset(offset):
+    """Raises a ValueError if offset isn't a listing page offset from zero to
+    MAX_LISTING_OFFSET."""
+    if offset < 0 or offset > MAX_LISTING_OFFSET:
+        raise ValueError("Listing offset {} must be from 0 to {}, use a cursor.".format(
+            offset, MAX_LISTING_OFFSET))
+
+def encode_cursor(raw):
+    """Encodes a raw sort key as an opaque, URL safe, cursor String."""
+    return base64.urlsafe_b64encode(json.dumps(list(raw)).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Decodes a cursor String to a raw sort key, raising a ValueError if it's
+    malformed."""
+    try:
+        group, value, name = json.loads(base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Malformed listing cursor {}.".format(cursor))
+    return (group, value, name)
 
 class SourceKey(object):
     """Simple class encapsulating a path and some basic properties common to most
@@ -228,10 +351,13 @@ class SourceBase(object):
         return
 
     @abc.abstractmethod
-    def list_files(self, filter_key=None, recurse=False, show_hidden=False): # pragma: no cover
+    def list_files(self, filter_key=None, recurse=False, show_hidden=False,
+                   start_after=None): # pragma: no cover
         """Generator that lists the keys for all files that are children of
         filter_key which is a SourceKey instance and must be a folder. The
-        method will recurse into children if recurse is True."""
+        method will recurse into children if recurse is True. Files are listed
+        in listing_order() and if start_after is the value of a file key only
+        the files listed after it are returned."""
         return
 
     @abc.abstractmethod # pragma: no cover
@@ -250,6 +376,65 @@ class SourceBase(object):
         """For a given key returns the ByteSequence and ByteSequenceProperty tuple."""
         return
 
+    @abc.abstractmethod # pragma: no cover
+    def stream_key(self, key, start=0, stop=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Generator of the bytes of file key, from offset start up to but not
+        including offset stop, or the end if stop is None, in chunks of at
+        most chunk_size bytes."""
+        return
+
+    def list_page(self, filter_key=None, sort=SORT_NAME, descending=False,
+                  page_size=DEFAULT_PAGE_SIZE, offset=0, cursor=None, show_hidden=False):
+        """Returns a ListingPage of the folders and files that are children of
+        filter_key, sorted by SORT_NAME, SORT_SIZE or SORT_MODIFIED. The page
+        starts after the key a cursor from a previous page points to or at
+        offset, which can't be more than MAX_LISTING_OFFSET. Only offset +
+        page_size keys are held in memory at once."""
+        check_listing_offset(offset)
+        sort_key = listing_sort_key(sort, descending)
+        keys = itertools.chain(self.list_folders(filter_key=filter_key, show_hidden=show_hidden),
+                               self.list_files(filter_key=filter_key, show_hidden=show_hidden))
+        if cursor:
+            after = sort_key_from_raw(decode_cursor(cursor), descending)
+            keys = (key for key in keys if sort_key(key) > after)
+        keys = heapq.nsmallest(offset + page_size + 1, keys, key=sort_key)[offset:]
+        return ListingPage.from_keys(keys, page_size, sort)
+
+    def invalidate_listings(self, filter_key=None):
+        """Forget any cached listings of filter_key and its sub-folders, or of
+        the whole source if filter_key is None. Sources that don't cache
+        listings have nothing to do."""
+        return 0
+
+    @staticmethod
+    def listing_order(value, is_folder=False):
+        """Returns a sort key for the order keys are listed in, the files in a
+        folder come before its sub-folders and each are sorted by name."""
+        parts = value.rstrip('/').split('/')
+        order = [(1, part) for part in parts[:-1]]
+        order.append((1 if is_folder else 0, parts[-1]))
+        return tuple(order)
+
+    @classmethod
+    def _listed_after(cls, key, start_after):
+        """Returns True if the file key is listed after the file key value
+        start_after, or start_after is None."""
+        return start_after is None or \
+            cls.listing_order(key.value) > cls.listing_order(start_after)
+
+    @classmethod
+    def _folder_start_after(cls, folder_key, start_after):
+        """Returns a (list, start_after) tuple for a sub-folder, list is False if
+        all of the folder's files are listed before start_after and start_after
+        is None if they're all listed after it."""
+        if start_after is None:
+            return True, None
+        folder_order = cls.listing_order(folder_key.value, True)
+        after_order = cls.listing_order(start_after)[:len(folder_order)]
+        if folder_order == after_order:
+            return True, start_after
+        return folder_order > after_order, None
+
     @staticmethod
     def _validate_key_and_return_prefix(filter_key):
         prefix = ''
@@ -286,8 +471,14 @@ class SourceBase(object):
             tool = get_format_tool_instance(tool_release.format_tool)
             logging.debug("Checking %s", tool.format_tool_release.format_tool.name)
             if tool.version:
-                logging.debug("Invoking %s", tool.format_tool_release.format_tool.name)
-                metadata = tool.identify(path)
+                tool_name = tool.format_tool_release.format_tool.name
+                logging.debug("Invoking %s", tool_name)
+                try:
+                    with TOOL_SECONDS.time((tool_name,)):
+                        metadata = tool.identify(path)
+                except Exception:
+                    TOOL_ERRORS.inc((tool_name,))
+                    raise
                 if metadata:
                     props[tool_release] = metadata
         return props
@@ -297,6 +488,8 @@ class AS3Bucket(SourceBase):
     NAMESPACE = 'com.amazon.s3'
     FOLDER_REGEX = re.compile('.*/$')
     S3_RESOURCE = None
+    S3_CLIENT = None
+    __S3_LOCK = threading.Lock()
     ETAG = 'ETag'
     CONT_TYPE = 'ContentType'
     CONT_ENC = 'ContentEncoding'
@@ -325,7 +518,7 @@ class AS3Bucket(SourceBase):
 
     def key_exists(self, key):
         key = key if key else SourceKey('/')
-        s3_client = client('s3')
+        s3_client = AS3Bucket.s3_client()
         if key.is_folder:
             prefix = super(AS3Bucket, self)._validate_key_and_return_prefix(key)
             if prefix and not prefix.endswith('/'):
@@ -336,6 +529,9 @@ class AS3Bucket(SourceBase):
                 if not result.get('Contents'):
                     return False
         else:
+            listed = self._cached_file_exists(key)
+            if listed is not None:
+                return listed
             try:
                 s3_client.head_object(Bucket=self.bucket.location, Key=key.value)
             except exceptions.ClientError as boto_client_excep:
@@ -372,15 +568,10 @@ class AS3Bucket(SourceBase):
                 yield SourceKey(obj_summary.key, False)
 
     def list_folders(self, filter_key=None, recurse=False, show_hidden=False):
-        prefix = super(AS3Bucket, self)._validate_key_and_return_prefix(filter_key)
-        logging.debug('Prefix calculated: %s.', prefix)
-        if prefix and not prefix.endswith('/'):
-            prefix += '/'
+        prefix = self._folder_prefix(filter_key)
         logging.debug('Adjusted prefix is: %s.', prefix)
-        result = AS3Bucket._list_objects(bucket=self.bucket.location,
-                                         prefix=prefix)
-        if result.get('CommonPrefixes'):
-            for common_prefix in result.get('CommonPrefixes'):
+        for result in self._list_object_pages(bucket=self.bucket.location, prefix=prefix):
+            for common_prefix in result.get('CommonPrefixes', []):
                 key = SourceKey(common_prefix.get('Prefix'))
                 if not key.is_hidden or show_hidden:
                     yield key
@@ -389,46 +580,142 @@ class AS3Bucket(SourceBase):
                                                      show_hidden=show_hidden):
                             yield res
 
-    def list_files(self, filter_key=None, recurse=False, show_hidden=False):
+    def list_files(self, filter_key=None, recurse=False, show_hidden=False,
+                   start_after=None):
+        prefix = self._folder_prefix(filter_key)
+        folders = []
+        for result in self._list_object_pages(bucket=self.bucket.location, prefix=prefix):
+            for obj_summary in result.get('Contents', []):
+                key = self._key_from_summary(obj_summary)
+                if (not key.is_hidden or show_hidden) and self._listed_after(key, start_after):
+                    yield key
+            if recurse:
+                folders.extend(SourceKey(common_prefix.get('Prefix'))
+                               for common_prefix in result.get('CommonPrefixes', []))
+        # S3 lists prefixes in byte order including the trailing slash, so
+        # a-b/ comes before a/, recurse in listing_order() for resuming
+        for key in sorted(folders, key=lambda folder: self.listing_order(folder.value, True)):
+            do_list, folder_start_after = self._folder_start_after(key, start_after)
+            if do_list and ((not key.is_hidden) or show_hidden):
+                for res in self.list_files(filter_key=key, recurse=True,
+                                           show_hidden=show_hidden,
+                                           start_after=folder_start_after):
+                    yield res
+
+    def list_page(self, filter_key=None, sort=SORT_NAME, descending=False,
+                  page_size=DEFAULT_PAGE_SIZE, offset=0, cursor=None, show_hidden=False):
+        """Ascending name order is S3's own order so those pages are read
+        directly using StartAfter and MaxKeys, other orders are computed from
+        the full listing by SourceBase."""
+        if sort != SORT_NAME or descending or offset:
+            return super(AS3Bucket, self).list_page(filter_key, sort, descending, page_size,
+                                                    offset, cursor, show_hidden)
+        prefix = self._folder_prefix(filter_key)
+        after = decode_cursor(cursor) if cursor else None
+        start_after = None
+        if after is not None:
+            # Start after everything beneath a folder, not the folder itself,
+            # S3 still rolls later keys beneath it into the folder's prefix
+            start_after = prefix + after[1] + (u'\uffff' if after[1].endswith('/') else '')
+        sort_key = listing_sort_key(sort, descending)
+        keys = []
+        for result in self._list_object_pages(bucket=self.bucket.location, prefix=prefix,
+                                              start_after=start_after, max_keys=page_size + 1):
+            page = [SourceKey(common_prefix.get('Prefix'))
+                    for common_prefix in result.get('CommonPrefixes', [])]
+            page.extend(self._key_from_summary(obj_summary)
+                        for obj_summary in result.get('Contents', []))
+            for key in sorted(page, key=sort_key):
+                if (key.is_hidden and not show_hidden) or \
+                        (after is not None and sort_key(key) <= sort_key_from_raw(after, False)):
+                    continue
+                keys.append(key)
+            if len(keys) > page_size:
+                break
+        return ListingPage.from_keys(keys, page_size, sort)
+
+    def invalidate_listings(self, filter_key=None):
+        """Remove the cached listings of filter_key's prefix and every prefix
+        beneath it, returning the number of listings removed."""
+        prefix = self._folder_prefix(filter_key)
+        bucket = self.bucket.location
+        return LISTING_CACHE.invalidate_where(
+            lambda cache_key: cache_key[0] == bucket and cache_key[1].startswith(prefix))
+
+    def _cached_file_exists(self, key):
+        """Answer whether a file key exists from a cached, complete listing of
+        its folder, returns None if there isn't one."""
+        prefix = key.value[:key.value.rfind('/') + 1]
+        result = LISTING_CACHE.peek(AS3Bucket._listing_cache_key(self.bucket.location, prefix))
+        if result is None or result.get('IsTruncated'):
+            return None
+        return any(obj_summary.get('Key') == key.value
+                   for obj_summary in result.get('Contents', []))
+
+    def _folder_prefix(self, filter_key):
         prefix = super(AS3Bucket, self)._validate_key_and_return_prefix(filter_key)
         if prefix and not prefix.endswith('/'):
             prefix += '/'
-        result = AS3Bucket._list_objects(bucket=self.bucket.location,
-                                         prefix=prefix)
-        if result.get('Contents'):
-            for obj_summary in result.get('Contents'):
-                key = SourceKey(obj_summary.get('Key'), False, obj_summary.get('Size'),
-                                obj_summary.get('LastModified'))
-                if not key.is_hidden or show_hidden:
-                    key.add_property(self.__PROPERTIES[self.ETAG],
-                                     self._etag_from_result(obj_summary))
-                    yield key
-        if recurse:
-            if result.get('CommonPrefixes'):
-                for common_prefix in result.get('CommonPrefixes'):
-                    key = SourceKey(common_prefix.get('Prefix'))
-                    if (not key.is_hidden) or show_hidden:
-                        for res in self.list_files(filter_key=key, recurse=True,
-                                                   show_hidden=show_hidden):
-                            yield res
+        return prefix
+
+    def _key_from_summary(self, obj_summary):
+        key = SourceKey(obj_summary.get('Key'), False, obj_summary.get('Size'),
+                        obj_summary.get('LastModified'))
+        key.add_property(self.__PROPERTIES[self.ETAG], self._etag_from_result(obj_summary))
+        return key
 
     def get_byte_sequence_properties(self, key):
         if not key or key.is_folder:
             raise ValueError("Argument key must be a file key.")
         logging.debug("Obtaining meta for key: %s, value: %s", key, key.value)
         path, _bs = self.get_path_and_byte_seq(key)
-        props = collections.defaultdict()
-        if _bs.size > 0:
-            props = super(AS3Bucket, self)._format_properties_from_path(path)
+        try:
+            props = collections.defaultdict()
+            if _bs.size > 0:
+                props = super(AS3Bucket, self)._format_properties_from_path(path)
+        finally:
+            BLOBSTORE.unpin(_bs.sha1)
         return _bs, props
 
     @staticmethod
-    def _list_objects(bucket='', prefix='/', delimeter='/'):
-        s3_client = client('s3')
+    def _list_object_pages(bucket='', prefix='/', delimeter='/', start_after=None,
+                           max_keys=None):
+        """Generator of list_objects_v2 results, following continuation
+        tokens until the listing is complete."""
+        token = None
+        while True:
+            result = AS3Bucket._list_objects(bucket, prefix, delimeter, start_after,
+                                             token, max_keys)
+            yield result
+            token = result.get('NextContinuationToken')
+            if not result.get('IsTruncated') or not token:
+                return
+
+    @staticmethod
+    def _listing_cache_key(bucket, prefix, delimeter='/', start_after=None,
+                           continuation_token=None, max_keys=None):
+        # StartAfter is ignored by S3 once there's a continuation token
+        return (bucket, prefix, delimeter, None if continuation_token else start_after,
+                continuation_token, max_keys)
+
+    @staticmethod
+    def _list_objects(bucket='', prefix='/', delimeter='/', start_after=None,
+                      continuation_token=None, max_keys=None):
+        cache_key = AS3Bucket._listing_cache_key(bucket, prefix, delimeter, start_after,
+                                                 continuation_token, max_keys)
+        result = LISTING_CACHE.get(cache_key)
+        if result is not None:
+            return result
+        s3_client = AS3Bucket.s3_client()
+        kwargs = {'Bucket': bucket, 'Prefix': prefix, 'Delimiter': delimeter}
+        if continuation_token:
+            kwargs['ContinuationToken'] = continuation_token
+        elif start_after:
+            kwargs['StartAfter'] = start_after
+        if max_keys:
+            kwargs['MaxKeys'] = max_keys
         try:
-            result = s3_client.list_objects_v2(Bucket=bucket,
-                                               Prefix=prefix,
-                                               Delimiter=delimeter)
+            result = s3_client.list_objects_v2(**kwargs)
         except exceptions.ClientError as boto_client_excep:
             # If a client error is thrown, then check that it was a 404 error.
             # If it was a 404 error, then the bucket does not exist.
@@ -445,11 +732,67 @@ class AS3Bucket(SourceBase):
             # If a boto-authentication exception is thrown then log it here
             logging.exception("No S3 credentials found in user home directory.")
             raise Unauthorized("Unauthorized in Source._list_objects")
+        LISTING_CACHE.put(cache_key, result)
         return result
 
     def _get_object_result(self, key_value):
-        s3_client = client('s3')
-        return s3_client.get_object(Bucket=self.bucket.location, Key=key_value)
+        # Only the metadata is wanted so don't open the object's body
+        s3_client = AS3Bucket.s3_client()
+        return s3_client.head_object(Bucket=self.bucket.location, Key=key_value)
+
+    def stream_key(self, key, start=0, stop=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Streams from the BlobStore if it has a copy, otherwise streams from
+        S3 using a ranged GET for partial reads. The BlobStore is filled in
+        the background, from the streamed bytes if the whole object was read
+        or else by a separate download."""
+        if not key or key.is_folder:
+            raise ValueError("Argument key must be a file key.")
+        etag = key.properties.get(self.ETAG)
+        sha1 = Sha1Lookup.get_sha1(etag) if etag else None
+        if sha1:
+            BLOBSTORE.pin(sha1)
+        try:
+            blob_path = BLOBSTORE.lookup(sha1)
+            if blob_path is not None:
+                logging.debug('SHA1 %s is cached in local BlobStore, streaming from it', sha1)
+                for chunk in stream_path(blob_path, start, stop, chunk_size):
+                    yield chunk
+                return
+        finally:
+            if sha1:
+                BLOBSTORE.unpin(sha1)
+        bucket = self.bucket.location
+        kwargs = {'Bucket': bucket, 'Key': key.value}
+        whole = start == 0 and (stop is None or stop == key.size)
+        if not whole:
+            kwargs['Range'] = 'bytes={}-{}'.format(start, '' if stop is None else stop - 1)
+        body = AS3Bucket.s3_client().get_object(**kwargs)['Body']
+        if not whole or BLOB_FILLER.is_filling(bucket, key.value):
+            BLOB_FILLER.fill(bucket, key.value, etag)
+            try:
+                for chunk in _read_chunks(body, chunk_size=chunk_size):
+                    record_downloaded(len(chunk))
+                    S3_BYTES.inc(amount=len(chunk))
+                    yield chunk
+            finally:
+                body.close()
+            return
+        # Write the whole object to the BlobStore as it's streamed
+        writer = BLOBSTORE.writer()
+        complete = False
+        try:
+            for chunk in _read_chunks(body, chunk_size=chunk_size):
+                record_downloaded(len(chunk))
+                S3_BYTES.inc(amount=len(chunk))
+                writer.write(chunk)
+                yield chunk
+            complete = True
+        finally:
+            body.close()
+            if complete:
+                BLOB_FILLER.fill(bucket, key.value, etag, writer)
+            else:
+                writer.abort()
 
     def get_key_properties(self, key):
         if key.is_folder:
@@ -474,7 +817,11 @@ class AS3Bucket(SourceBase):
         return props
 
     def get_path_and_byte_seq(self, key, sha1=None):
-        """Creates a temp file copy of a file from the specified image."""
+        """Returns the path of a BlobStore copy of the object and its
+        ByteSequence, downloading it from S3 if the BlobStore doesn't have a
+        copy, e.g. because it's been evicted. The blob is pinned against
+        eviction, callers must BLOBSTORE.unpin(byte_seq.sha1) once they're done
+        with the path."""
         if not key or key.is_folder:
             # File keys only please
             raise ValueError("Argument key must be a file key.")
@@ -483,35 +830,68 @@ class AS3Bucket(SourceBase):
             etag = self.get_key_properties(key)[self.ETAG]
         if sha1 is None:
             sha1 = Sha1Lookup.get_sha1(etag)
-        # Check if we know the SHA1, if we do and the Blobstore has a copy use that
-        if sha1 and BLOBSTORE.has_copy(sha1):
-            logging.info('SHA1 %s is cached in local BlobStore, using as temp', sha1)
-        else:
-            # No locally cached version so retrieve from S3 to a temp file
-            logging.info("No locally cached copy so downloading from S3.")
-            s3_client = client('s3')
-            with tempfile.NamedTemporaryFile(delete=False) as temp:
-                s3_client.download_fileobj(self.bucket.location, key.value, temp)
-                sha1 = sha1_path(temp.name)
-                BLOBSTORE.add_file(temp.name, sha1)
-        byte_seq = ByteSequence.by_sha1(sha1)
-        file_path = BLOBSTORE.get_blob_path(sha1)
-        if byte_seq is None:
-            byte_seq = ByteSequence(sha1, os.path.getsize(file_path))
-            byte_seq.put()
+        if sha1:
+            BLOBSTORE.pin(sha1)
+        try:
+            # Check if we know the SHA1, if we do and the Blobstore has a copy use that
+            if BLOBSTORE.lookup(sha1) is not None:
+                logging.info('SHA1 %s is cached in local BlobStore, using as temp', sha1)
+            else:
+                # No locally cached version so retrieve from S3 to a temp file
+                logging.info("No locally cached copy so downloading from S3.")
+                sha1 = self._download_to_blobstore(key, etag, sha1)
+            byte_seq = ByteSequence.by_sha1(sha1)
+            file_path = BLOBSTORE.get_blob_path(sha1)
+            if byte_seq is None:
+                byte_seq = ByteSequence(sha1, os.path.getsize(file_path))
+                byte_seq.put()
+        except Exception:
+            if sha1:
+                BLOBSTORE.unpin(sha1)
+            raise
         return file_path, byte_seq
 
+    def _download_to_blobstore(self, key, etag, sha1):
+        """Downloads the object straight into the BlobStore, hashing it as it's
+        written, and returns its SHA1. The downloaded blob is pinned before it's
+        added and the expected, pinned, sha1 unpinned once it has been."""
+        s3_client = AS3Bucket.s3_client()
+        with BLOBSTORE.writer(pin=True) as writer:
+            s3_client.download_fileobj(self.bucket.location, key.value, writer)
+        record_downloaded(writer.size)
+        S3_BYTES.inc(amount=writer.size)
+        record_hashed(writer.size)
+        if sha1:
+            BLOBSTORE.unpin(sha1)
+        if etag:
+            Sha1Lookup.add(etag, writer.sha1)
+        return writer.sha1
+
+    @classmethod
+    def s3_client(cls):
+        """Return the S3 client shared by the process, boto3 clients are
+        thread safe and expensive to create."""
+        if cls.S3_CLIENT is None:
+            with cls.__S3_LOCK:
+                if cls.S3_CLIENT is None:
+                    from boto3 import client
+                    s3_client = client('s3')
+                    s3_client.meta.events.register('before-call.s3', _count_s3_request)
+                    cls.S3_CLIENT = s3_client
+        return cls.S3_CLIENT
+
     @classmethod
     def validate_bucket(cls, bucket_name):
         """Retrieve the bucket named bucket_name from the passed s3_resource and
         validate it could be found (no 404) before returning the bucket.
         """
         if not cls.S3_RESOURCE:
+            from boto3 import resource
             cls.S3_RESOURCE = resource('s3')
         exists = True
 
         try:
-            cls.S3_RESOURCE.meta.client.head_bucket(Bucket=bucket_name)
+            cls.s3_client().head_bucket(Bucket=bucket_name)
         except exceptions.ClientError as boto_client_excep:
             # If a client error is thrown, then check that it was a 404 error.
             # If it was a 404 error, then the bucket does not exist.
@@ -594,39 +974,91 @@ class FileSystem(SourceBase):
         return self._yield_keys(prefix, list_files=False, recurse=recurse,
                                 show_hidden=show_hidden)
 
-    def list_files(self, filter_key=None, recurse=False, show_hidden=False):
+    def list_files(self, filter_key=None, recurse=False, show_hidden=False,
+                   start_after=None):
         prefix = super(FileSystem, self)._validate_key_and_return_prefix(filter_key)
         return self._yield_keys(prefix, list_folders=False, recurse=recurse,
-                                show_hidden=show_hidden)
-
-    def _yield_keys(self, prefix='', list_files=True, list_folders=True, recurse=False,
-                    show_hidden=False):
-        """Generator that yields a list of file and or folder keys from a root
-        directory."""
+                                show_hidden=show_hidden, start_after=start_after)
+
+    def list_page(self, filter_key=None, sort=SORT_NAME, descending=False,
+                  page_size=DEFAULT_PAGE_SIZE, offset=0, cursor=None, show_hidden=False):
+        """Name order pages are cut from the folder's sorted entry names and
+        only the page's files are stat-ed, so a page costs one scan of the
+        folder, not a stat of every file. Size and modified order need every
+        file stat-ed and are computed from the full listing by SourceBase."""
+        if sort != SORT_NAME:
+            return super(FileSystem, self).list_page(filter_key, sort, descending, page_size,
+                                                     offset, cursor, show_hidden)
+        check_listing_offset(offset)
+        after = decode_cursor(cursor)[1] if cursor else None
+        if cursor and not isinstance(after, type(u'')):
+            raise ValueError("Malformed listing cursor {}.".format(cursor))
+        prefix = super(FileSystem, self)._validate_key_and_return_prefix(filter_key)
+        files, folders = self._scan_folder(prefix, show_hidden)
+        # Folders sort by name with a trailing slash, see raw_sort_key()
+        entries = sorted([(entry.name, entry, False) for entry in files] +
+                         [(entry.name + '/', entry, True) for entry in folders],
+                         key=lambda entry: entry[0])
+        names = [name for name, _, _ in entries]
+        if descending:
+            end = bisect.bisect_left(names, after) if cursor else len(entries) - offset
+            window = entries[max(end - page_size - 1, 0):max(end, 0)][::-1]
+        else:
+            start = bisect.bisect_right(names, after) if cursor else offset
+            window = entries[start:start + page_size + 1]
+        keys = [SourceKey(os.path.join(prefix, entry.name)) if is_folder else
+                self._file_key(prefix, entry) for _, entry, is_folder in window]
+        return ListingPage.from_keys(keys, page_size, sort)
+
+    def _scan_folder(self, prefix, show_hidden=False):
+        """Returns lists of the file and folder DirEntries in the folder prefix."""
         path = os.path.join(self.file_system.location, prefix)
         if not os.access(path, os.R_OK):
             logging.warning("File system access to %s not allowed", path)
             raise Forbidden(description='File system access to {}'.format(path) +\
                                         ' is not allowed for this account.')
-        for entry in scandir(os.path.join(self.file_system.location, prefix)):
+        files, folders = [], []
+        for entry in scandir(path):
             if entry.name.startswith('.') and not show_hidden:
                 continue
-            if list_files and entry.is_file(follow_symlinks=False):
-                key = SourceKey(os.path.join(prefix, entry.name), False,
-                                int(entry.stat().st_size),
-                                datetime.fromtimestamp(entry.stat().st_mtime,
-                                                       self.TIME_ZONE))
-                yield key
-
-            if entry.is_dir(follow_symlinks=False):
-                if list_folders:
-                    yield SourceKey(os.path.join(prefix, entry.name))
-                if recurse:
-                    for child in self._yield_keys(prefix=os.path.join(prefix, entry.name),
-                                                  list_files=list_files,
-                                                  list_folders=list_folders,
-                                                  recurse=True):
-                        yield child
+            if entry.is_file(follow_symlinks=False):
+                files.append(entry)
+            elif entry.is_dir(follow_symlinks=False):
+                folders.append(entry)
+        return files, folders
+
+    def _file_key(self, prefix, entry):
+        """Returns the SourceKey of the file DirEntry entry in folder prefix."""
+        result = entry.stat()
+        return SourceKey(os.path.join(prefix, entry.name), False, int(result.st_size),
+                         datetime.fromtimestamp(result.st_mtime, self.TIME_ZONE))
+
+    def _yield_keys(self, prefix='', list_files=True, list_folders=True, recurse=False,
+                    show_hidden=False, start_after=None):
+        """Generator that yields a list of file and or folder keys from a root
+        directory, in listing_order(). If start_after is a file key value only
+        files listed after it are yielded."""
+        files, folders = self._scan_folder(prefix, show_hidden)
+        if list_files:
+            for entry in sorted(files, key=lambda entry: entry.name):
+                key = self._file_key(prefix, entry)
+                if self._listed_after(key, start_after):
+                    yield key
+        for entry in sorted(folders, key=lambda entry: entry.name):
+            folder_key = SourceKey(os.path.join(prefix, entry.name))
+            if list_folders:
+                yield folder_key
+            if recurse:
+                do_list, folder_start_after = self._folder_start_after(folder_key, start_after)
+                if not do_list:
+                    continue
+                for child in self._yield_keys(prefix=os.path.join(prefix, entry.name),
+                                              list_files=list_files,
+                                              list_folders=list_folders,
+                                              recurse=True,
+                                              show_hidden=show_hidden,
+                                              start_after=folder_start_after):
+                    yield child
 
     def get_byte_sequence_properties(self, key):
         if not key or key.is_folder:
@@ -664,16 +1096,178 @@ class FileSystem(SourceBase):
         if not key or key.is_folder:
             raise ValueError("Argument key must be a file key.")
         file_path = os.path.join(self.file_system.location, key.value)
-        sha1 = sha1_path(file_path) if os.access(file_path, R_OK) else ByteSequence.EMPTY_SHA1
+        sha1 = ByteSequence.EMPTY_SHA1
+        if os.access(file_path, R_OK):
+            sha1 = sha1_path(file_path)
+            record_hashed(os.path.getsize(file_path))
         byte_seq = ByteSequence.by_sha1(sha1)
         if byte_seq is None:
             byte_seq = ByteSequence(sha1, os.path.getsize(file_path))
             byte_seq.put()
         return file_path, byte_seq
 
+    def stream_key(self, key, start=0, stop=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        if not key or key.is_folder:
+            raise ValueError("Argument key must be a file key.")
+        return stream_path(os.path.join(self.file_system.location, key.value), start, stop,
+                           chunk_size)
+
     def __rep__(self): # pragma: no cover
         ret_val = []
         ret_val.append("corptest.sources.FileSystem : [FileSystemSource=")
         ret_val.append(str(self.file_system))
         ret_val.append("]")
         return "".join(ret_val)
+
+def _count_s3_request(model, **_):
+    """botocore before-call handler that counts S3 API calls."""
+    S3_REQUESTS.inc((model.name,))
+
+def stream_path(path, start=0, stop=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Generator of the bytes of the file at path from offset start up to but
+    not including offset stop, or the end of the file if stop is None."""
+    with open(path, 'rb') as source:
+        source.seek(start)
+        for chunk in _read_chunks(source, None if stop is None else stop - start, chunk_size):
+            yield chunk
+
+def _read_chunks(source, length=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Generator of chunks of at most chunk_size bytes read from the file like
+    source, stopping after length bytes or at the end of source."""
+    while length is None or length > 0:
+        chunk = source.read(chunk_size if length is None else min(chunk_size, length))
+        if not chunk:
+            return
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
+
+class BlobFiller(object):
+    """Copies S3 objects into a BlobStore on background threads so requests
+    never wait for them, only one copy of each object runs at a time."""
+    def __init__(self, blobstore):
+        check_param_not_none(blobstore, "blobstore")
+        self.__blobstore = blobstore
+        self.__lock = threading.Lock()
+        self.__filling = set()
+
+    def is_filling(self, bucket, key_value):
+        """Return True if the object is currently being copied."""
+        with self.__lock:
+            return (bucket, key_value) in self.__filling
+
+    def fill(self, bucket, key_value, etag=None, writer=None):
+        """Start a background thread that adds the object to the BlobStore and
+        records its SHA1 against etag. If writer is given it's a BlobWriter
+        holding a complete download of the object that's committed, rather
+        than downloading it again. Returns False if the object is already being
+        copied."""
+        with self.__lock:
+            if (bucket, key_value) in self.__filling:
+                if writer is not None:
+                    writer.abort()
+                return False
+            self.__filling.add((bucket, key_value))
+        thread = threading.Thread(target=self._fill, args=(bucket, key_value, etag, writer))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _fill(self, bucket, key_value, etag, writer):
+        """Thread target, downloads the object if needed and adds it to the
+        BlobStore."""
+        try:
+            if writer is None:
+                with self.__blobstore.writer() as writer:
+                    AS3Bucket.s3_client().download_fileobj(bucket, key_value, writer)
+                S3_BYTES.inc(amount=writer.size)
+            else:
+                writer.commit()
+            if etag:
+                Sha1Lookup.add(etag, writer.sha1)
+            logging.info("Added %s from bucket %s to the BlobStore as %s", key_value, bucket,
+                         writer.sha1)
+        except Exception: # pylint: disable-msg=W0703
+            logging.exception("Failed to add %s from bucket %s to the BlobStore", key_value,
+                              bucket)
+            if writer is not None:
+                writer.abort()
+        finally:
+            with self.__lock:
+                self.__filling.discard((bucket, key_value))
+
+BLOB_FILLER = BlobFiller(BLOBSTORE)
+
+class SourceDetails(collections.namedtuple('SourceDetails', ['id', 'namespace', 'name',
+                                                               'description', 'scheme',
+                                                               'location'])):
+    """Copy of a Source's columns that doesn't belong to a database session,
+    so handles built from it can be shared between requests and threads."""
+    __slots__ = ()
+
+    @classmethod
+    def from_source(cls, source):
+        """Create the details of a Source."""
+        return cls(source.id, source.namespace, source.name, source.description,
+                   source.scheme, source.location)
+
+    @property
+    def fingerprint(self):
+        """Returns the configuration a source handle depends upon."""
+        return (self.namespace, self.scheme, self.location)
+
+class SourceRegistry(object):
+    """Per process pool of validated AS3Bucket and FileSystem handles keyed by
+    Source id. Construction validates the source, for a bucket that's an S3
+    round trip, so handles are reused until refresh_interval seconds have
+    passed or the Source's scheme or location changes."""
+    def __init__(self, refresh_interval):
+        if refresh_interval is None or refresh_interval < 0:
+            raise ValueError("Argument refresh_interval must be zero or greater.")
+        self.__refresh_interval = refresh_interval
+        self.__lock = threading.Lock()
+        self.__handles = {}
+
+    def get(self, source):
+        """Returns the AS3Bucket or FileSystem for source, raising ValueError
+        if it can't be found. Unsaved sources aren't pooled."""
+        if not source:
+            raise ValueError("Argument source can not be None.")
+        details = SourceDetails.from_source(source)
+        if details.id is None:
+            return self._create(details)
+        now = time.time()
+        with self.__lock:
+            entry = self.__handles.get(details.id)
+        if entry is not None and entry[0] == details.fingerprint and now < entry[1]:
+            return entry[2]
+        try:
+            handle = self._create(details)
+        except ValueError:
+            self.invalidate(details.id)
+            raise
+        with self.__lock:
+            self.__handles[details.id] = (details.fingerprint, now + self.__refresh_interval,
+                                          handle)
+        return handle
+
+    def invalidate(self, source_id=None):
+        """Forget the handle for source_id, or all handles if it's None."""
+        with self.__lock:
+            if source_id is None:
+                self.__handles.clear()
+            else:
+                self.__handles.pop(source_id, None)
+
+    def __len__(self):
+        return len(self.__handles)
+
+    @staticmethod
+    def _create(details):
+        return AS3Bucket(details) if details.scheme == SCHEMES['AS3'] else FileSystem(details)
+
+SOURCES = SourceRegistry(APP.config.get('SOURCE_REFRESH_INTERVAL'))
+
+def source_file_system(source):
+    """Returns the pooled AS3Bucket or FileSystem for a Source."""
+    return SOURCES.get(source)
@@ -15,7 +15,8 @@ import errno
 import hashlib
 import json
 import os.path
-import requests
+import re
+import shutil
 
 class ObjectJsonEncoder(json.JSONEncoder):
     """ Object JSON serialiser. """
@@ -114,6 +115,74 @@ def _hash_copy_file(src, dest, hasher, blocksize=65536):
         buf = src.read(blocksize)
     return hasher.hexdigest()
 
+# Linux ioctl that makes a copy on write clone of a file, a reflink, on file
+# systems that support one such as Btrfs and XFS
+FICLONE = 0x40049409
+# copy_file_range and sendfile errors that mean the method isn't supported for
+# the pair of files, rather than that copying failed
+_UNSUPPORTED_COPY = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                     errno.EBADF)
+
+def copy_file(src_path, dest_path, blocksize=65536):
+    """Copies the file at src_path to dest_path without reading it into Python
+    where the platform allows, trying a reflink, copy_file_range and sendfile in
+    turn before falling back to a buffered copy. Returns the name of the method
+    that copied the file.
+    """
+    with open(src_path, 'rb') as src:
+        with open(dest_path, 'wb') as dest:
+            if _reflink(src, dest):
+                return 'reflink'
+            size = os.fstat(src.fileno()).st_size
+            for name, method in (('copy_file_range', _copy_file_range), ('sendfile', _sendfile)):
+                try:
+                    if method(src.fileno(), dest.fileno(), size):
+                        return name
+                except OSError as excep:
+                    if excep.errno not in _UNSUPPORTED_COPY:
+                        raise
+                # Start again from the beginning with the next method
+                src.seek(0)
+                dest.seek(0)
+                dest.truncate()
+            shutil.copyfileobj(src, dest, blocksize)
+            return 'copy'
+
+def _reflink(src, dest):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+def _copy_file_range(src_fd, dest_fd, size):
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is None:
+        return False
+    copied = 0
+    while copied < size:
+        count = copy_file_range(src_fd, dest_fd, size - copied)
+        if count == 0:
+            return False
+        copied += count
+    return True
+
+def _sendfile(src_fd, dest_fd, size):
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is None:
+        return False
+    offset = 0
+    while offset < size:
+        count = sendfile(dest_fd, src_fd, offset, size - offset)
+        if count == 0:
+            return False
+        offset += count
+    return True
+
 def mapped_dict_from_element(root, parent_tags, tag_dict):
     """ Recursively parses an XML structure and maps tag names / tag values to the
     equivalent database field names. This info is stacked up in a dictionary that
@@ -166,6 +235,7 @@ def timestamp_fmt(timestamp, show_millis=False):
 
 def fill_file_from_response(source_url, temp_file):
     """HTTP get from source_url and writes the resoponse to temp_file"""
+    import requests
     # Grab the contents of the Amazon S3 bucket
     session = requests.Session()
     response = session.get(url=source_url)
@@ -207,3 +277,34 @@ class Extension(object):
     def parse_from_file_name(file_name):
         """Parses a string extension from a file name. """
         return os.path.splitext(file_name)[1][1:]
+
+class KeyGrouper(object):
+    """Assigns key paths to groups, e.g. the dataset or institution prefix of
+    a bucket. If a regex is given the group is its first capture group, or the
+    whole match if it has no groups, and the empty string if it doesn't match.
+    Otherwise the group is the first depth folders of the path.
+    """
+    def __init__(self, depth=1, regex=None):
+        if depth is None or depth < 0:
+            raise ValueError("Argument depth must be zero or greater.")
+        self.__depth = depth
+        self.__regex = re.compile(regex) if regex else None
+
+    @property
+    def depth(self):
+        """Return the number of leading folders used to group paths."""
+        return self.__depth
+
+    @property
+    def regex(self):
+        """Return the compiled regex used to group paths, or None."""
+        return self.__regex
+
+    def group(self, path):
+        """Return the group String for a key path."""
+        if self.__regex is not None:
+            match = self.__regex.search(path)
+            if match is None:
+                return ''
+            return match.group(1) if self.__regex.groups else match.group(0)
+        return '/'.join(path.split('/')[:-1][:self.__depth])
@@ -37,7 +37,6 @@ INSTALL_REQUIRES = [
     'boto3 == 1.4.4',
     'Flask-Negotiate == 0.1.0',
     'tzlocal == 1.4',
-    'dicttoxml == 1.7.4',
     'fpdf == 1.7.2',
 ]
 
@@ -49,6 +48,10 @@ TEST_REQUIRES = [
     'pytest',
 ]
 
+EXTRAS_REQUIRE = {
+    'zstd': ['zstandard'],
+}
+
 setup(name='jiscrdss-fmtsniff',
       version=find_version('__version__', 'corptest', 'corptest.py'),
       description='JISC Research Data Shared Service : Format identification toolset.',
@@ -68,6 +71,7 @@ setup(name='jiscrdss-fmtsniff',
       install_requires=INSTALL_REQUIRES,
       setup_requires=SETUP_REQUIRES,
       tests_require=TEST_REQUIRES,
+      extras_require=EXTRAS_REQUIRE,
       packages=['corptest'],
       package_data={
           'corptest': ['*.*', 'conf/*.*'],
@@ -0,0 +1,6 @@
+""" Tests for the corptest package. """
+from corptest import init_app
+
+# Importing the package no longer creates the database and loads the configured
+# sources and tools, the tests expect both
+init_app()
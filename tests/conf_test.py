@@ -5,7 +5,8 @@ import pytest
 from corptest import APP
 from corptest.database import BASE, ENGINE
 
-from corptest.model_sources import DB_SESSION
+from corptest.model_sources import DB_SESSION, IndexAggregate, Job, Key
+from corptest.model_properties import ByteSequenceProperty, KeyProperty
 from corptest.model_properties import init_db
 @pytest.fixture(scope='session')
 def app(request):
@@ -42,3 +43,20 @@ def session(db, request):
         BASE.commit
 
     return DB_SESSION
+
+def delete_test_rows(source, indexes, byte_sequences):
+    """Remove a test's rows, other tests count all keys and byte sequences."""
+    for index in indexes:
+        key_ids = DB_SESSION.query(Key.id).filter(Key.source_index_id == index.id)
+        KeyProperty.query.filter(KeyProperty.key_id.in_(key_ids.subquery())).\
+            delete(synchronize_session=False)
+        Key.query.filter(Key.source_index_id == index.id).delete()
+        Job.query.filter(Job.source_index_id == index.id).delete()
+        IndexAggregate.query.filter(IndexAggregate.source_index_id == index.id).delete()
+        DB_SESSION.delete(index)
+    for byte_seq in byte_sequences:
+        ByteSequenceProperty.query.filter(
+            ByteSequenceProperty.byte_sequence_id == byte_seq.id).delete()
+        DB_SESSION.delete(byte_seq)
+    DB_SESSION.delete(source)
+    DB_SESSION.commit()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+""" Tests for the index aggregates in aggregates.py. """
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from corptest.aggregates import cached_disagreement_matrix, disagreement_matrix
+from corptest.aggregates import keys_for_cell, size_statistics, size_distribution
+from corptest.aggregates import cached_size_distribution, cached_group_breakdown
+from corptest.aggregates import group_breakdown
+from corptest.model_sources import SCHEMES, Source, SourceIndex, Key, ByteSequence
+from corptest.model_sources import FormatToolRelease, IndexAggregate
+from corptest.model_properties import ByteSequenceProperty, Property, PropertyValue
+from corptest.utilities import KeyGrouper
+
+from tests.const import TEST_DESCRIPTION
+from tests.conf_test import db, session, app# pylint: disable-msg=W0611
+from tests.conf_test import delete_test_rows
+
+def _byte_sequence(char, size, results, prop_name='PUID'):
+    byte_seq = ByteSequence(char * 40, size)
+    byte_seq.put()
+    for release, value in results:
+        ByteSequenceProperty.putdate(byte_seq, release, Property.putdate(prop_name),
+                                     PropertyValue.putdate(value))
+    return byte_seq
+
+def test_disagreement_matrix(session):# pylint: disable-msg=W0621, W0613
+    """Test the cross tabulation of two tools' results, its caching and drill down."""
+    release_a, release_b = FormatToolRelease.all()[:2]
+    source = Source("aggregate.test", "Aggregate Test", TEST_DESCRIPTION,
+                    SCHEMES['FILE'], '/aggregate')
+    agreed = _byte_sequence('d', 10, [(release_a, 'fmt/1'), (release_b, 'fmt/1')])
+    disagreed = _byte_sequence('e', 20, [(release_a, 'fmt/1'), (release_b, 'fmt/2')])
+    single = _byte_sequence('f', 30, [(release_a, 'fmt/3')])
+    index = SourceIndex(source, datetime.now())
+    index.put()
+    Key(index, 'a.txt', 10, byte_sequence=agreed).put()
+    Key(index, 'b.txt', 10, byte_sequence=agreed).put()
+    Key(index, 'c.txt', 20, byte_sequence=disagreed).put()
+    Key(index, 'd.txt', 30, byte_sequence=single).put()
+    try:
+        matrix = disagreement_matrix(index, 'PUID')
+        assert matrix['property'] == 'PUID'
+        assert len(matrix['pairs']) == 1
+        pair = matrix['pairs'][0]
+        assert pair['releases'] == sorted([release_a.id, release_b.id])
+        assert pair['agreed'] == [2, 20]
+        assert pair['disagreed'] == [1, 20]
+        assert [cell['count'] for cell in pair['cells']] == [2, 1]
+        assert str(release_a.id) in matrix['tools']
+        assert disagreement_matrix(index, 'MIME')['pairs'] == []
+
+        cell = pair['cells'][1]
+        keys = keys_for_cell(index, 'PUID', pair['releases'][0], pair['releases'][1],
+                             cell['a_value_id'], cell['b_value_id']).all()
+        assert [key.path for key in keys] == ['c.txt']
+
+        assert cached_disagreement_matrix(index, 'PUID') == matrix
+        assert IndexAggregate.by_index_and_name(index, 'disagreements_PUID') is None
+        index.complete()
+        assert cached_disagreement_matrix(index, 'PUID') == matrix
+        aggregate = IndexAggregate.by_index_and_name(index, 'disagreements_PUID')
+        assert aggregate.version_tag == index.version_tag
+        assert cached_disagreement_matrix(index, 'PUID') == matrix
+    finally:
+        delete_test_rows(source, [index], [agreed, disagreed, single])
+
+def test_size_statistics():
+    """Test the statistics and power of two histogram of an array of sizes."""
+    statistics = size_statistics(np.array([0, 1, 2, 3, 4, 1000], dtype=np.int64))
+    assert statistics['count'] == 6
+    assert statistics['total'] == 1010
+    assert (statistics['min'], statistics['max']) == (0, 1000)
+    assert statistics['percentiles']['50'] == 2.5
+    histogram = statistics['histogram']
+    assert histogram[0] == [0, 0, 1, 0]
+    assert histogram[1] == [1, 1, 1, 1]
+    assert histogram[2] == [2, 3, 2, 5]
+    assert histogram[3] == [4, 7, 1, 4]
+    assert histogram[-1] == [512, 1023, 1, 1000]
+    assert sum(bucket[2] for bucket in histogram) == 6
+    assert size_statistics(np.zeros(0, dtype=np.int64))['count'] == 0
+
+def test_size_distribution(session):# pylint: disable-msg=W0621, W0613
+    """Test the size distribution of an index overall and by format."""
+    release = FormatToolRelease.all()[0]
+    source = Source("sizes.test", "Sizes Test", TEST_DESCRIPTION, SCHEMES['FILE'], '/sizes')
+    small = _byte_sequence('1', 10, [(release, 'fmt/10')], 'MIME')
+    large = _byte_sequence('2', 1000, [(release, 'fmt/11')], 'MIME')
+    index = SourceIndex(source, datetime.now())
+    index.put()
+    Key(index, 'a.txt', 10, byte_sequence=small).put()
+    Key(index, 'b.txt', 10, byte_sequence=small).put()
+    Key(index, 'c.bin', 1000, byte_sequence=large).put()
+    Key(index, 'd.unknown', 5).put()
+    try:
+        distribution = size_distribution(index)
+        assert distribution['overall']['count'] == 4
+        assert distribution['overall']['total'] == 1025
+        assert [(entry['value'], entry['statistics']['count'], entry['statistics']['total'])
+                for entry in distribution['formats']] == [('fmt/10', 2, 20), ('fmt/11', 1, 1000)]
+        index.complete()
+        assert cached_size_distribution(index) == distribution
+    finally:
+        delete_test_rows(source, [index], [small, large])
+
+def test_key_grouper():
+    """Test grouping paths by folder depth and by regex."""
+    assert KeyGrouper().group('doi/dataset/file.txt') == 'doi'
+    assert KeyGrouper(2).group('doi/dataset/file.txt') == 'doi/dataset'
+    assert KeyGrouper(2).group('file.txt') == ''
+    assert KeyGrouper(regex=r'^[^/]+/([^/]+)/').group('doi/dataset/file.txt') == 'dataset'
+    assert KeyGrouper(regex=r'^\d+').group('10/file.txt') == '10'
+    assert KeyGrouper(regex=r'^\d+').group('file.txt') == ''
+    with pytest.raises(ValueError):
+        KeyGrouper(-1)
+
+def test_group_breakdown(session):# pylint: disable-msg=W0621, W0613
+    """Test the per group counts, sizes and format mix of an index."""
+    release = FormatToolRelease.all()[0]
+    grouper = KeyGrouper()
+    source = Source("groups.test", "Groups Test", TEST_DESCRIPTION, SCHEMES['FILE'], '/groups')
+    text = _byte_sequence('3', 10, [(release, 'fmt/20')])
+    image = _byte_sequence('4', 100, [(release, 'fmt/21')])
+    index = SourceIndex(source, datetime.now())
+    index.put()
+    for path, byte_seq in [('one/a.txt', text), ('one/b.txt', text), ('one/c.png', image),
+                           ('two/a.png', image), ('top.txt', text)]:
+        Key(index, path, byte_seq.size, byte_sequence=byte_seq, group=grouper.group(path)).put()
+    # Keys indexed without a group join the '' group
+    Key(index, 'loose.txt', text.size, byte_sequence=text).put()
+    try:
+        breakdown = group_breakdown(index)
+        assert breakdown['release'] == release.id
+        groups = dict((group['group'], group) for group in breakdown['groups'])
+        assert [group['group'] for group in breakdown['groups']] == ['one', 'two', '']
+        assert (groups['one']['count'], groups['one']['size']) == (3, 120)
+        assert groups['one']['formats'] == [['fmt/20', 2, 20], ['fmt/21', 1, 100]]
+        assert (groups['']['count'], groups['']['size']) == (2, 20)
+        assert groups['']['formats'] == [['fmt/20', 2, 20]]
+        assert group_breakdown(index, 'MIME')['release'] is None
+        index.complete()
+        assert cached_group_breakdown(index) == breakdown
+    finally:
+        delete_test_rows(source, [index], [text, image])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+""" Tests for the classes in artefacts.py. """
+import shutil
+import tempfile
+import time
+
+from corptest.artefacts import ArtefactStore
+from corptest.model_sources import SCHEMES, Source, SourceIndex
+
+from tests.const import THIS_DIR, TEST_DESCRIPTION
+from tests.conf_test import db, session, app# pylint: disable-msg=W0611
+
+def _write_artefact(source_index, path):
+    """Test artefact generator, writes 10 bytes."""
+    with open(path, 'w') as artefact:
+        artefact.write('{:010d}'.format(source_index.id))
+
+def _wait_for(store, source_index, ext):
+    """Poll for a background generated artefact."""
+    for _ in range(100):
+        path = store.get(source_index, ext)
+        if path is not None and not store.is_generating(source_index, ext):
+            return path
+        time.sleep(0.05)
+    return None
+
+def _complete_index():
+    source = Source.by_namespace_and_name("artefact.test", "Artefact Test")
+    if not source:
+        source = Source("artefact.test", "Artefact Test", TEST_DESCRIPTION,
+                        SCHEMES['FILE'], THIS_DIR)
+    source_index = SourceIndex(source)
+    source_index.put()
+    source_index.complete()
+    return source_index
+
+def test_generate_and_evict(session):# pylint: disable-msg=W0621, W0613
+    """Test background generation, versioning and quota eviction."""
+    root = tempfile.mkdtemp()
+    try:
+        store = ArtefactStore(root, 15)
+        first = _complete_index()
+        assert store.get_or_generate(first, 'txt', _write_artefact) is None
+        first_path = _wait_for(store, first, 'txt')
+        assert first_path is not None
+        assert store.get_or_generate(first, 'txt', _write_artefact) == first_path
+        # Changing the index version means the old artefact is stale
+        first.complete()
+        assert store.get(first, 'txt') is None
+        assert _wait_for(store, first, 'txt') is None
+        store.get_or_generate(first, 'txt', _write_artefact)
+        assert _wait_for(store, first, 'txt') is not None
+        assert store.size == 10
+        # A second artefact pushes the store over quota, evicting the first
+        second = _complete_index()
+        store.get_or_generate(second, 'txt', _write_artefact)
+        assert _wait_for(store, second, 'txt') is not None
+        assert store.get(first, 'txt') is None
+        assert store.size == 10
+    finally:
+        shutil.rmtree(root)
@@ -9,12 +9,16 @@
 # License, Version 3. See the text file "COPYING" for further details
 # about the terms of this license.
 """ Tests for the classes in blobstore.py. """
+import hashlib
 import os.path
 import shutil
+import sqlite3
 import tempfile
+import threading
+import time
 import unittest
 
-from corptest.blobstore import BlobStore
+from corptest.blobstore import BlobIndex, BlobManifest, BlobStore
 from corptest.model_sources import ByteSequence
 from tests.const import THIS_DIR, NOT_EMPTY_SHA1
 
@@ -122,6 +126,60 @@ class BlobStoreTestCase(unittest.TestCase):
         assert self.blobstore.blob_count == prev_count
         assert self.blobstore.size == prev_size
 
+    def test_manifest(self):
+        """ Test that a store's manifest is loaded by a new store on the same root. """
+        self.populate_and_assert_blobstore()
+        reopened = BlobStore(self.tmp_store)
+        assert reopened.blob_count == self.blobstore.blob_count
+        assert reopened.size == self.blobstore.size
+        assert reopened.get_blob(NOT_EMPTY_SHA1) == self.blobstore.get_blob(NOT_EMPTY_SHA1)
+        self.assertTrue(reopened.wait_for_reconcile(10))
+        assert reopened.blob_count == self.blobstore.blob_count
+
+    def test_reconcile(self):
+        """ Test that reconcile records new blob files and drops deleted ones. """
+        self.populate_and_assert_blobstore()
+        os.remove(self.blobstore.get_blob_path(NOT_EMPTY_SHA1))
+        sha1 = 'ab' * 20
+        with open(self.blobstore.get_blob_path(sha1), 'wb') as blob:
+            blob.write(b'abc')
+        self.assertEqual(self.blobstore.reconcile(), (1, 1))
+        self.assertIsNone(self.blobstore.get_blob(NOT_EMPTY_SHA1))
+        self.assertEqual(self.blobstore.get_blob(sha1).size, 3)
+        self.assertEqual(self.blobstore.size, 3)
+
+    def test_writer(self):
+        """ Test that written bytes are hashed and committed as a blob. """
+        with self.blobstore.writer() as writer:
+            writer.write(b'abc')
+            writer.write(b'def')
+        sha1 = hashlib.sha1(b'abcdef').hexdigest()
+        self.assertEqual((writer.sha1, writer.size), (sha1, 6))
+        self.assertEqual(self.blobstore.get_blob(sha1).size, 6)
+        with open(self.blobstore.get_blob_path(sha1), 'rb') as blob:
+            self.assertEqual(blob.read(), b'abcdef')
+        # A duplicate is discarded, a failed write leaves nothing behind
+        with self.blobstore.writer() as writer:
+            writer.write(b'abcdef')
+        with self.assertRaises(ValueError):
+            with self.blobstore.writer() as writer:
+                writer.write(b'ghi')
+                raise ValueError()
+        self.assertEqual(os.listdir(self.blobstore.blob_root), [sha1])
+        self.assertEqual(self.blobstore.blob_count, 1)
+
+    def test_stale_temps(self):
+        """ Test that reconcile removes abandoned temporary files. """
+        writer = self.blobstore.writer()
+        writer.write(b'abc')
+        stale = os.path.join(self.blobstore.blob_root, 'stale.tmp')
+        open(stale, 'wb').close()
+        old = time.time() - BlobStore.STALE_TEMP_SECONDS - 1
+        os.utime(stale, (old, old))
+        self.blobstore.reconcile()
+        self.assertFalse(os.path.exists(stale))
+        self.assertEqual(writer.commit().sha1, hashlib.sha1(b'abc').hexdigest())
+
     def store_file(self, filename):
         """Convenience method for storing files."""
         path = os.path.join(THIS_DIR, filename)
@@ -140,5 +198,189 @@ class BlobStoreTestCase(unittest.TestCase):
         assert self.blobstore.size > 0, \
         'BlobStore should have size > 0'
 
+class FanOutBlobStoreTestCase(unittest.TestCase):
+    """ Test cases for BlobStores with a fan out directory layout. """
+    def setUp(self):
+        """ Sets up a fan out BlobStore in a temp directory. """
+        self.tmp_store = tempfile.mkdtemp()
+        self.blobstore = BlobStore(self.tmp_store, 2)
+
+    def test_bad_fan_out(self):
+        """ Test that out of range fan outs are rejected. """
+        with self.assertRaises(ValueError):
+            BlobStore(self.tmp_store, -1)
+        with self.assertRaises(ValueError):
+            BlobStore(self.tmp_store, 5)
+
+    def test_layout(self):
+        """ Test that added blobs are stored in the fan out layout. """
+        byte_seq = self.blobstore.add_file(os.path.join(THIS_DIR, 'notempty'))
+        path = os.path.join(self.blobstore.blob_root, NOT_EMPTY_SHA1[:2],
+                            NOT_EMPTY_SHA1[2:4], NOT_EMPTY_SHA1)
+        self.assertEqual(self.blobstore.get_blob_path(byte_seq.sha1), path)
+        self.assertTrue(os.path.isfile(path))
+        self.assertTrue(self.blobstore.hash_check())
+
+    def test_migrate(self):
+        """ Test that flat layout blobs are found and migrated. """
+        flat_store = BlobStore(self.tmp_store)
+        flat_store.add_file(os.path.join(THIS_DIR, 'notempty'))
+        flat_store.add_file(os.path.join(THIS_DIR, 'empty'))
+        flat_path = os.path.join(self.blobstore.blob_root, NOT_EMPTY_SHA1)
+        self.assertEqual(self.blobstore.get_blob_path(NOT_EMPTY_SHA1), flat_path)
+        self.assertTrue(self.blobstore.has_copy(NOT_EMPTY_SHA1))
+        self.assertTrue(self.blobstore.wait_for_reconcile(10))
+        # A directory made for a blob that's being added is left alone
+        adding_dir = os.path.join(self.blobstore.blob_root, 'ff', 'ee')
+        os.makedirs(adding_dir)
+        self.assertEqual(self.blobstore.migrate(2), 2)
+        self.assertTrue(os.path.isdir(adding_dir))
+        shutil.rmtree(os.path.dirname(adding_dir))
+        self.assertFalse(os.path.exists(flat_path))
+        self.assertEqual(self.blobstore.get_blob_path(NOT_EMPTY_SHA1),
+                         self.blobstore.layout_path(NOT_EMPTY_SHA1))
+        self.assertEqual(self.blobstore.reconcile(), (0, 0))
+        self.assertEqual(self.blobstore.blob_count, 2)
+        # And back again, removing the emptied directories
+        self.assertEqual(flat_store.migrate(2), 2)
+        self.assertEqual(sorted(os.listdir(flat_store.blob_root)),
+                         sorted([NOT_EMPTY_SHA1, ByteSequence.EMPTY_SHA1]))
+
+    def tearDown(self):
+        """ Remove the BlobStore's temp directory. """
+        shutil.rmtree(self.tmp_store)
+
+class QuotaBlobStoreTestCase(unittest.TestCase):
+    """ Test cases for BlobStores with a quota. """
+    def setUp(self):
+        """ Sets up a 100 byte BlobStore in a temp directory. """
+        self.tmp_store = tempfile.mkdtemp()
+        self.blobstore = BlobStore(self.tmp_store, 1, 100)
+
+    def add_blob(self, content):
+        """ Add a blob of content to the store, returns its SHA1. """
+        path = os.path.join(self.tmp_store, 'source')
+        with open(path, 'wb') as source:
+            source.write(content)
+        return self.blobstore.add_file(path).sha1
+
+    def test_bad_quota(self):
+        """ Test that a negative quota is rejected. """
+        with self.assertRaises(ValueError):
+            BlobStore(self.tmp_store, 0, -1)
+
+    def test_lru_eviction(self):
+        """ Test that least recently used blobs are evicted first. """
+        first = self.add_blob(b'a' * 40)
+        second = self.add_blob(b'b' * 40)
+        self.assertIsNotNone(self.blobstore.lookup(first))
+        third = self.add_blob(b'c' * 40)
+        self.assertLessEqual(self.blobstore.size, 90)
+        self.assertTrue(self.blobstore.has_copy(first))
+        self.assertFalse(self.blobstore.has_copy(second))
+        self.assertIsNone(self.blobstore.get_blob(second))
+        self.assertTrue(self.blobstore.has_copy(third))
+        self.assertEqual([sha1 for sha1, _ in self.blobstore.manifest.least_recent()],
+                         [first, third])
+
+    def test_pinning(self):
+        """ Test that pinned blobs aren't evicted. """
+        first = self.add_blob(b'a' * 40)
+        self.blobstore.pin(first)
+        self.blobstore.pin(first)
+        self.add_blob(b'b' * 40)
+        self.add_blob(b'c' * 40)
+        self.assertTrue(self.blobstore.has_copy(first))
+        self.blobstore.unpin(first)
+        self.assertTrue(self.blobstore.is_pinned(first))
+        self.blobstore.unpin(first)
+        self.assertFalse(self.blobstore.is_pinned(first))
+        self.add_blob(b'd' * 40)
+        self.assertFalse(self.blobstore.has_copy(first))
+
+    def test_hit_rate(self):
+        """ Test that lookup hits and misses are counted. """
+        self.assertIsNone(self.blobstore.hit_rate)
+        sha1 = self.add_blob(b'a')
+        self.assertEqual(self.blobstore.lookup(sha1), self.blobstore.get_blob_path(sha1))
+        self.assertIsNone(self.blobstore.lookup(None))
+        self.assertIsNone(self.blobstore.lookup(NOT_EMPTY_SHA1))
+        self.assertEqual((self.blobstore.hits, self.blobstore.misses), (1, 2))
+        self.assertAlmostEqual(self.blobstore.hit_rate, 1.0 / 3)
+
+    def test_old_manifest(self):
+        """ Test that manifests without access times are upgraded. """
+        path = os.path.join(self.tmp_store, 'old.sqlite')
+        conn = sqlite3.connect(path)
+        with conn:
+            conn.execute('CREATE TABLE blob (sha1 BLOB PRIMARY KEY, size INTEGER NOT NULL) ' +
+                         'WITHOUT ROWID')
+        conn.close()
+        manifest = BlobManifest(path)
+        manifest.add(NOT_EMPTY_SHA1, 1, 1.0)
+        manifest.add(ByteSequence.EMPTY_SHA1, 0, 0.0)
+        self.assertEqual(list(manifest.least_recent()),
+                         [(ByteSequence.EMPTY_SHA1, 0), (NOT_EMPTY_SHA1, 1)])
+
+    def tearDown(self):
+        """ Remove the BlobStore's temp directory. """
+        shutil.rmtree(self.tmp_store)
+
+class BlobIndexTestCase(unittest.TestCase):
+    """ Test cases for the BlobIndex class. """
+    def test_add_and_merge(self):
+        """ Test lookups before and after added blobs are merged into the arrays. """
+        index = BlobIndex()
+        index.MERGE_THRESHOLD = 3
+        # Trailing null bytes are stripped by NumPy's fixed width strings
+        sha1s = ['ff' * 20, '01' * 19 + '00', ByteSequence.EMPTY_SHA1, '10' * 20]
+        for size, sha1 in enumerate(sha1s):
+            index.add(sha1, size + 1)
+        index.add(sha1s[0], 100)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.total_size, 10)
+        for size, sha1 in enumerate(sha1s):
+            self.assertEqual(index.get_size(sha1), size + 1)
+        self.assertNotIn('01' * 20, index)
+        self.assertEqual(sorted(index), sorted(sha1s))
+
+    def test_remove(self):
+        """ Test removing blobs from the arrays and the added dictionary. """
+        index = BlobIndex()
+        index.MERGE_THRESHOLD = 2
+        for size, sha1 in enumerate(['aa' * 20, 'bb' * 20, 'cc' * 20]):
+            index.add(sha1, size + 1)
+        index.remove('aa' * 20)
+        index.remove('cc' * 20)
+        index.remove('dd' * 20)
+        self.assertEqual((len(index), index.total_size), (1, 2))
+        self.assertEqual(list(index), ['bb' * 20])
+        index.add('aa' * 20, 5)
+        self.assertEqual(index.get_size('aa' * 20), 5)
+        self.assertEqual((len(index), index.total_size), (2, 7))
+
+    def test_lookup_during_merge(self):
+        """ Test that lookups without a lock always find indexed blobs while
+        others are added and merged. """
+        index = BlobIndex()
+        index.MERGE_THRESHOLD = 8
+        sha1s = [hashlib.sha1(str(i).encode('ascii')).hexdigest() for i in range(1000)]
+        misses, added, done = [], [], threading.Event()
+        def _lookup():
+            while not done.is_set():
+                # Only blobs whose add has returned
+                for sha1 in sha1s[:len(added)]:
+                    if index.get_size(sha1) is None:
+                        misses.append(sha1)
+        reader = threading.Thread(target=_lookup)
+        reader.start()
+        for sha1 in sha1s:
+            index.add(sha1, 1)
+            added.append(sha1)
+        done.set()
+        reader.join()
+        self.assertEqual(misses, [])
+        self.assertEqual(len(index), len(sha1s))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+""" Tests for the caches in caches.py. """
+import time
+import unittest
+
+from corptest.caches import SizedLruCache, TtlCache, caching_generator
+
+class SizedLruCacheTestCase(unittest.TestCase):
+    """ Test cases for the SizedLruCache class. """
+    def test_negative_size(self):
+        """ Test that a negative max_bytes is rejected. """
+        with self.assertRaises(ValueError):
+            SizedLruCache(-1)
+
+    def test_get_put(self):
+        """ Test that values are cached and hits and misses counted. """
+        cache = SizedLruCache(10)
+        self.assertIsNone(cache.get('a'))
+        self.assertTrue(cache.put('a', b'1234'))
+        self.assertEqual(cache.get('a'), b'1234')
+        self.assertEqual(cache.size, 4)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_too_big(self):
+        """ Test that values bigger than the cache aren't cached. """
+        cache = SizedLruCache(4)
+        self.assertFalse(cache.put('a', b'12345'))
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 0)
+
+    def test_lru_eviction(self):
+        """ Test that the least recently used values are evicted first. """
+        cache = SizedLruCache(8)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        cache.get('a')
+        cache.put('c', b'1234')
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(cache.size, 8)
+
+    def test_replace_and_invalidate(self):
+        """ Test that replaced and invalidated values are accounted for. """
+        cache = SizedLruCache(8)
+        cache.put('a', b'1234')
+        cache.put('a', b'12')
+        self.assertEqual(cache.size, 2)
+        cache.invalidate('a')
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(len(cache), 0)
+
+    def test_caching_generator(self):
+        """ Test that generated bodies are cached unless too big. """
+        cache = SizedLruCache(100)
+        self.assertEqual(list(caching_generator(iter([u'ab', b'cd']), cache, 'a', 10)),
+                         [u'ab', b'cd'])
+        self.assertEqual(cache.get('a'), b'abcd')
+        self.assertEqual(list(caching_generator(iter([b'abcd', b'ef']), cache, 'b', 5)),
+                         [b'abcd', b'ef'])
+        self.assertNotIn('b', cache)
+
+class TtlCacheTestCase(unittest.TestCase):
+    """ Test cases for the TtlCache class. """
+    def test_bad_arguments(self):
+        """ Test that negative sizes and ttls are rejected. """
+        with self.assertRaises(ValueError):
+            TtlCache(-1, 10)
+        with self.assertRaises(ValueError):
+            TtlCache(10, -1)
+
+    def test_expiry(self):
+        """ Test that values expire after ttl seconds. """
+        cache = TtlCache(10, 0.05)
+        cache.put('a', {'Contents': []})
+        self.assertEqual(cache.get('a'), {'Contents': []})
+        self.assertEqual(cache.peek('a'), {'Contents': []})
+        time.sleep(0.1)
+        self.assertIsNone(cache.peek('a'))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_disabled(self):
+        """ Test that a zero ttl caches nothing. """
+        cache = TtlCache(10, 0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_lru_and_invalidation(self):
+        """ Test eviction of least recently used entries and invalidation. """
+        cache = TtlCache(2, 60)
+        cache.put(('bucket', 'a/'), 1)
+        cache.put(('bucket', 'b/'), 2)
+        cache.get(('bucket', 'a/'))
+        cache.put(('bucket', 'a/c/'), 3)
+        self.assertIsNone(cache.peek(('bucket', 'b/')))
+        self.assertEqual(cache.invalidate_where(lambda key: key[1].startswith('a/')), 2)
+        self.assertEqual(len(cache), 0)
+        cache.put('d', 4)
+        cache.invalidate('d')
+        cache.invalidate('e')
+        self.assertIsNone(cache.get('d'))
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+""" Tests for the incremental response compression in compression.py. """
+import unittest
+import zlib
+
+from werkzeug.datastructures import Accept
+
+from corptest.compression import GZIP, GZIP_WBITS, IDENTITY
+from corptest.compression import choose_encoding, compress_generator
+
+class CompressionTestCase(unittest.TestCase):
+    """ Test cases for the compression functions. """
+    def test_choose_encoding(self):
+        """ Test negotiation of the content encoding. """
+        self.assertEqual(choose_encoding(Accept([('gzip', 1), ('br', 1)])), GZIP)
+        self.assertEqual(choose_encoding(Accept([('br', 1)])), IDENTITY)
+        self.assertEqual(choose_encoding(Accept([('gzip', 0)])), IDENTITY)
+        self.assertEqual(choose_encoding(Accept()), IDENTITY)
+
+    def test_identity(self):
+        """ Test that identity encoding passes chunks through untouched. """
+        self.assertEqual(list(compress_generator(iter([u'a', b'b']), IDENTITY)), [u'a', b'b'])
+
+    def test_gzip(self):
+        """ Test that gzipped chunks decompress to the original body. """
+        chunks = [u'{"Path": "folder/file%d.txt", "Size": %d}\n' % (i, i) for i in range(1000)]
+        compressed = b''.join(compress_generator(iter(chunks), GZIP))
+        body = ''.join(chunks).encode('utf-8')
+        self.assertEqual(zlib.decompress(compressed, GZIP_WBITS), body)
+        self.assertLess(len(compressed), len(body) // 5)
+        with self.assertRaises(ValueError):
+            list(compress_generator(iter([b'a']), 'br'))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+""" Tests for the index differences in diff.py. """
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from corptest.diff import IndexDiff, ADDED, REMOVED, MODIFIED
+from corptest.diff import json_diff_generator, ndjson_diff_generator
+from corptest.model_sources import SCHEMES, Source, SourceIndex, Key, ByteSequence
+from corptest.model_sources import FormatToolRelease
+from corptest.model_properties import ByteSequenceProperty, Property, PropertyValue
+
+from tests.const import TEST_DESCRIPTION
+from tests.conf_test import db, session, app# pylint: disable-msg=W0611
+from tests.conf_test import delete_test_rows
+
+def _byte_sequence(char, size, mime):
+    byte_seq = ByteSequence(char * 40, size)
+    byte_seq.put()
+    ByteSequenceProperty.putdate(byte_seq, FormatToolRelease.all()[0],
+                                 Property.putdate('MIME'), PropertyValue.putdate(mime))
+    return byte_seq
+
+def test_index_diff(session):# pylint: disable-msg=W0621, W0613
+    """Test added, removed and modified keys and format drift between indexes."""
+    source = Source("diff.test", "Diff Test", TEST_DESCRIPTION, SCHEMES['FILE'], '/diff')
+    text, xml, html = _byte_sequence('a', 10, 'text/plain'), \
+        _byte_sequence('b', 20, 'text/xml'), _byte_sequence('c', 30, 'text/html')
+    modified = datetime(2017, 1, 1)
+    old_index = SourceIndex(source, datetime.now() - timedelta(days=30))
+    old_index.put()
+    Key(old_index, 'same.txt', 10, modified, text).put()
+    Key(old_index, 'gone.txt', 10, modified, text).put()
+    Key(old_index, 'changed.txt', 10, modified, text).put()
+    Key(old_index, 'touched.txt', 10, modified, text).put()
+    new_index = SourceIndex(source, datetime.now())
+    new_index.put()
+    Key(new_index, 'same.txt', 10, modified, text).put()
+    Key(new_index, 'new.xml', 20, modified, xml).put()
+    Key(new_index, 'changed.txt', 30, modified, html).put()
+    Key(new_index, 'touched.txt', 10, datetime(2017, 2, 1), text).put()
+
+    try:
+        index_diff = IndexDiff(old_index, new_index)
+        counts = index_diff.counts()
+        assert counts[ADDED] == (1, 20)
+        assert counts[REMOVED] == (1, 10)
+        assert counts[MODIFIED] == (2, 40)
+        assert [entry.path for entry in index_diff.changes(ADDED)] == ['new.xml']
+        assert [entry.path for entry in index_diff.changes(REMOVED)] == ['gone.txt']
+        assert [entry.path for entry in index_diff.changes(MODIFIED, 1, 1)] == ['touched.txt']
+        changes = index_diff.iter_changes(batch_size=1)
+        assert [(entry.change, entry.path) for entry in changes] == \
+            [(ADDED, 'new.xml'), (REMOVED, 'gone.txt'),
+             (MODIFIED, 'changed.txt'), (MODIFIED, 'touched.txt')]
+
+        drift = index_diff.format_drift()
+        assert len(drift) == 1
+        assert (drift[0].prop_name, drift[0].old_value, drift[0].new_value, drift[0].count) == \
+            ('MIME', 'text/plain', 'text/html', 1)
+
+        streamed = json.loads(''.join(json_diff_generator(index_diff)))
+        assert streamed['Counts'][MODIFIED]['Count'] == 2
+        assert len(streamed['Changes']) == 4
+        lines = ''.join(ndjson_diff_generator(index_diff)).splitlines()
+        assert json.loads(lines[0])['Path'] == 'new.xml'
+
+        with pytest.raises(ValueError):
+            index_diff.changes('unknown')
+        other = SourceIndex(Source("diff.other", "Diff Other", TEST_DESCRIPTION,
+                                   SCHEMES['FILE'], '/other'), datetime.now())
+        with pytest.raises(ValueError):
+            IndexDiff(old_index, other)
+    finally:
+        delete_test_rows(source, [old_index, new_index], [text, xml, html])
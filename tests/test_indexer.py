@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+""" Tests for the background indexing jobs in indexer.py. """
+from datetime import datetime, timedelta
+import os.path
+import shutil
+import tempfile
+import time
+
+import pytest
+
+from corptest.database import DB_SESSION
+from corptest import indexer
+from corptest.indexer import JobQueue, index_source
+from corptest.model_sources import SCHEMES, Source, SourceIndex, Job, Key
+from corptest.progress import PROGRESS, IndexProgress, ProgressRegistry
+from corptest.sources import source_file_system
+
+from tests.const import TEST_DESCRIPTION
+from tests.conf_test import db, session, app# pylint: disable-msg=W0611
+from tests.conf_test import delete_test_rows
+
+def _wait_for(db_session, job_id, timeout=60):
+    """Poll the job table until the job finishes or timeout seconds pass."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        db_session.expire_all()
+        job = Job.by_id(job_id)
+        if not job.is_active:
+            return job
+        time.sleep(0.2)
+    return Job.by_id(job_id)
+
+def test_job_queue(session):# pylint: disable-msg=W0621, W0613
+    """Test that a submitted job indexes its folder in the background."""
+    root = tempfile.mkdtemp()
+    with open(os.path.join(root, 'job.test.txt'), 'w') as _file:
+        _file.write('Background indexing job test.')
+    source = Source("job.test", "Job Test", TEST_DESCRIPTION, SCHEMES['FILE'], root)
+    jobs = JobQueue(workers=1, poll_interval=0.2)
+    job = jobs.submit(source)
+    source_index, byte_sequences = job.source_index, []
+    try:
+        assert jobs.is_started
+        job = _wait_for(session, job.id)
+        assert job.status == Job.COMPLETED
+        assert job.finished is not None
+        source_index = SourceIndex.by_id(job.source_index_id)
+        assert source_index.completed is not None
+        assert source_index.key_count == 1
+        byte_sequences = [key.byte_sequence for key in source_index.keys]
+        progress = PROGRESS.get(source_index.id)
+        assert progress['status'] == Job.COMPLETED
+        assert (progress['listed'], progress['processed'], progress['errors']) == (1, 1, 0)
+        assert progress['listing_complete']
+        assert progress['hashed_bytes'] == byte_sequences[0].size
+    finally:
+        jobs.stop()
+        assert not jobs.is_started
+        shutil.rmtree(root)
+        delete_test_rows(source, [source_index], byte_sequences)
+
+def test_failed_job(session):# pylint: disable-msg=W0621, W0613
+    """Test that a job whose folder has gone is recorded as failed."""
+    source = Source("job.test", "Failed Job Test", TEST_DESCRIPTION, SCHEMES['FILE'],
+                    os.path.join(tempfile.gettempdir(), 'job.test.missing'))
+    source_index = SourceIndex(source, None)
+    source_index.put()
+    job = Job(source_index)
+    job.put()
+    try:
+        assert Job.claim(job.id)
+        assert not Job.claim(job.id)
+        JobQueue.run(job.id)
+        job = Job.by_id(job.id)
+        assert job.status == Job.FAILED
+        assert job.message
+        assert source_index.completed is None
+    finally:
+        delete_test_rows(source, [source_index], [])
+
+def test_requeue_stale(session):# pylint: disable-msg=W0621, W0613
+    """Test that only jobs whose heartbeat has gone stale are queued again."""
+    source = Source("job.test", "Requeue Test", TEST_DESCRIPTION, SCHEMES['FILE'], '/requeue')
+    source_index = SourceIndex(source, None)
+    source_index.put()
+    job = Job(source_index, recurse=True)
+    job.put()
+    try:
+        assert Job.claim(job.id, 'worker-a')
+        assert Job.by_id(job.id).status == Job.RUNNING
+        # A live job, perhaps run by another process, is left alone
+        assert Job.requeue_stale(60) == 0
+        assert Job.heartbeat('worker-a') == 1
+        assert Job.heartbeat('worker-b') == 0
+        assert Job.acknowledge_control(job.id, 'a.txt', 'worker-b') == Job.LOST
+        assert Job.acknowledge_control(job.id, 'a.txt', 'worker-a') is None
+
+        Job.query.filter(Job.id == job.id).\
+            update({Job.heartbeat_at: datetime.now() - timedelta(seconds=120)})
+        DB_SESSION.commit()
+        assert Job.requeue_stale(60) == 1
+        session.expire_all()
+        job = Job.by_id(job.id)
+        assert (job.status, job.worker_id) == (Job.QUEUED, None)
+        # The interrupted worker finds it's lost the job
+        assert Job.acknowledge_control(job.id, 'b.txt', 'worker-a') == Job.LOST
+        assert Job.by_id(job.id).checkpoint == 'a.txt'
+        with pytest.raises(ValueError):
+            JobQueue(workers=0)
+        with pytest.raises(ValueError):
+            JobQueue(heartbeat_interval=60, heartbeat_timeout=30)
+    finally:
+        delete_test_rows(source, [source_index], [])
+
+def test_job_controls(session):# pylint: disable-msg=W0621, W0613
+    """Test pausing, resuming and cancelling jobs."""
+    root = tempfile.mkdtemp()
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        with open(os.path.join(root, name), 'w') as _file:
+            _file.write('Job control test {}.'.format(name))
+    source = Source("job.test", "Control Test", TEST_DESCRIPTION, SCHEMES['FILE'], root)
+    source_index = SourceIndex(source, None)
+    source_index.put()
+    job = Job(source_index)
+    job.put()
+    byte_sequences = []
+    try:
+        assert job.pause()
+        assert job.status == Job.PAUSED
+        assert not job.pause()
+        assert job.resume()
+        assert job.status == Job.QUEUED
+
+        # A running job acts on requests between batches
+        assert Job.claim(job.id)
+        assert job.pause()
+        assert (job.status, job.control) == (Job.RUNNING, Job.PAUSE)
+        assert job.resume()
+        assert job.control is None
+        checks = []
+        def _check(last_value):
+            checks.append(Job.acknowledge_control(job.id, last_value))
+            return checks[-1]
+        assert index_source(source_index, check=_check, batch_size=2) is None
+        assert len(checks) == 2
+        byte_sequences = [key.byte_sequence for key in source_index.keys]
+        source_index.completed = None
+        assert job.pause()
+        assert index_source(source_index, check=_check, batch_size=2) == Job.PAUSE
+        assert (job.status, job.control) == (Job.PAUSED, None)
+        assert not source_index.is_complete
+
+        assert job.resume()
+        assert Job.claim(job.id)
+        assert job.cancel()
+        assert (job.status, job.control) == (Job.RUNNING, Job.CANCEL)
+        assert not job.pause()
+        JobQueue.run(job.id)
+        job = Job.by_id(job.id)
+        assert job.status == Job.CANCELLED
+        assert source_index.partial
+        assert source_index.is_complete
+        assert not job.cancel()
+        assert not job.resume()
+
+        # Queued and paused jobs are cancelled straight away
+        paused = Job(source_index)
+        paused.put()
+        assert paused.pause()
+        assert paused.cancel()
+        assert paused.status == Job.CANCELLED
+    finally:
+        shutil.rmtree(root)
+        delete_test_rows(source, [source_index], set(byte_sequences))
+
+def test_resume_from_checkpoint(session):# pylint: disable-msg=W0621, W0613
+    """Test that an interrupted index carries on from its checkpoint."""
+    root = tempfile.mkdtemp()
+    for name in ('a.txt', 'b.txt', 'c.txt', 'd.txt'):
+        with open(os.path.join(root, name), 'w') as _file:
+            _file.write('Checkpoint test {}.'.format(name))
+    source = Source("job.test", "Checkpoint Test", TEST_DESCRIPTION, SCHEMES['FILE'], root)
+    source_index = SourceIndex(source, None)
+    source_index.put()
+    checkpoints = []
+    def _interrupt(last_value):
+        checkpoints.append(last_value)
+        return 'stop' if len(checkpoints) == 3 else None
+    byte_sequences = []
+    try:
+        assert index_source(source_index, check=_interrupt, batch_size=1) == 'stop'
+        assert checkpoints == [None, 'a.txt', 'b.txt']
+        assert source_index.key_count == 2
+        byte_sequences = [key.byte_sequence for key in source_index.keys]
+
+        # Resume from an older checkpoint, b.txt is already committed
+        progress = IndexProgress(source_index.id, ProgressRegistry())
+        assert index_source(source_index, progress=progress, start_after='a.txt') is None
+        assert progress.snapshot()['processed_bytes'] == \
+            sum(key.size for key in source_index.keys if key.path in ('c.txt', 'd.txt'))
+        assert progress.errors == 0
+        assert sorted(key.path for key in source_index.keys) == \
+            ['a.txt', 'b.txt', 'c.txt', 'd.txt']
+        assert source_index.is_complete
+        byte_sequences = [key.byte_sequence for key in source_index.keys]
+    finally:
+        shutil.rmtree(root)
+        delete_test_rows(source, [source_index], set(byte_sequences))
+
+def test_single_listing(session):# pylint: disable-msg=W0621, W0613
+    """Test that keys are listed once and listing errors fail the index."""
+    root = tempfile.mkdtemp()
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        with open(os.path.join(root, name), 'w') as _file:
+            _file.write('Single listing test {}.'.format(name))
+    source = Source("job.test", "Listing Test", TEST_DESCRIPTION, SCHEMES['FILE'], root)
+    source_index, failing = SourceIndex(source, None), SourceIndex(source, None)
+    source_index.put()
+    failing.put()
+    _fs = source_file_system(source)
+    list_files, listings = _fs.list_files, []
+    def _list_files(*args, **kwargs):
+        listings.append(kwargs)
+        if len(listings) > 1:
+            raise IOError('Listing failed.')
+        return list_files(*args, **kwargs)
+    _fs.list_files = _list_files
+    byte_sequences = []
+    try:
+        progress = IndexProgress(source_index.id, ProgressRegistry())
+        assert index_source(source_index, progress=progress, batch_size=1) is None
+        assert len(listings) == 1
+        assert (progress.listed, progress.listing_complete) == (3, True)
+        byte_sequences = [key.byte_sequence for key in source_index.keys]
+        with pytest.raises(IOError):
+            index_source(failing, batch_size=1)
+        assert not failing.is_complete
+    finally:
+        del _fs.list_files
+        shutil.rmtree(root)
+        delete_test_rows(source, [source_index, failing], set(byte_sequences))
+
+def test_resume_after_property_failure(session, monkeypatch):# pylint: disable-msg=W0621, W0613
+    """Test that a key whose tool results weren't stored isn't committed, so
+    resuming the index identifies it again."""
+    root = tempfile.mkdtemp()
+    for name in ('a.txt', 'b.txt'):
+        with open(os.path.join(root, name), 'w') as _file:
+            _file.write('Property failure test {}.'.format(name))
+    source = Source("job.test", "Property Failure Test", TEST_DESCRIPTION, SCHEMES['FILE'], root)
+    source_index = SourceIndex(source, None)
+    source_index.put()
+    add_properties, stored = indexer.add_byte_sequence_properties, []
+    def _fail_first(byte_sequence, properties):
+        if not stored:
+            stored.append(None)
+            raise IOError('Interrupted storing properties.')
+        stored.append(byte_sequence.sha1)
+        add_properties(byte_sequence, properties)
+    monkeypatch.setattr(indexer, 'add_byte_sequence_properties', _fail_first)
+    byte_sequences = []
+    try:
+        progress = IndexProgress(source_index.id, ProgressRegistry())
+        assert index_source(source_index, progress=progress) is None
+        assert progress.errors == 1
+        assert [key.path for key in source_index.keys] == ['b.txt']
+        assert not Key.exists(source_index.id, 'a.txt')
+
+        progress = IndexProgress(source_index.id, ProgressRegistry())
+        assert index_source(source_index, progress=progress) is None
+        assert progress.errors == 0
+        keys = dict((key.path, key) for key in source_index.keys)
+        assert sorted(keys) == ['a.txt', 'b.txt']
+        assert stored == [None, keys['b.txt'].byte_sequence.sha1,
+                          keys['a.txt'].byte_sequence.sha1]
+        byte_sequences = [key.byte_sequence for key in keys.values()]
+    finally:
+        shutil.rmtree(root)
+        delete_test_rows(source, [source_index], set(byte_sequences))
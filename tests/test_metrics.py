@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+""" Tests for the metrics registry in metrics.py. """
+import threading
+import unittest
+
+from corptest.database import DB_SESSION
+from corptest.metrics import MetricsRegistry, query_stats, reset_query_stats
+from corptest.model_sources import Source
+
+class MetricsRegistryTestCase(unittest.TestCase):
+    """ Test cases for the MetricsRegistry class. """
+    def test_counter(self):
+        """ Test that counters from every thread are summed. """
+        registry = MetricsRegistry()
+        requests = registry.counter('test_requests_total', 'Requests.', ('operation',))
+        downloaded = registry.counter('test_bytes_total', 'Bytes.')
+        self.assertIn('test_bytes_total 0\n', registry.exposition())
+        def _work():
+            for _ in range(100):
+                requests.inc(('GetObject',))
+            downloaded.inc(amount=10)
+        threads = [threading.Thread(target=_work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        requests.inc(('HeadObject',))
+        exposition = registry.exposition()
+        self.assertIn('# TYPE test_requests_total counter\n', exposition)
+        self.assertIn('test_requests_total{operation="GetObject"} 400\n', exposition)
+        self.assertIn('test_requests_total{operation="HeadObject"} 1\n', exposition)
+        self.assertIn('test_bytes_total 40\n', exposition)
+        # Finished threads are retired without losing their counts
+        self.assertIn('test_requests_total{operation="GetObject"} 400\n', registry.exposition())
+        with self.assertRaises(ValueError):
+            requests.inc()
+        with self.assertRaises(ValueError):
+            registry.counter('test_bytes_total', 'Duplicate.')
+
+    def test_histogram(self):
+        """ Test that observations are reported in cumulative buckets. """
+        registry = MetricsRegistry()
+        latency = registry.histogram('test_seconds', 'Latency.', ('route',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            latency.observe(value, ('/',))
+        with latency.time(('/about/',)):
+            pass
+        exposition = registry.exposition()
+        self.assertIn('test_seconds_bucket{route="/",le="0.1"} 2\n', exposition)
+        self.assertIn('test_seconds_bucket{route="/",le="1"} 3\n', exposition)
+        self.assertIn('test_seconds_bucket{route="/",le="+Inf"} 4\n', exposition)
+        self.assertIn('test_seconds_sum{route="/"} 2.65\n', exposition)
+        self.assertIn('test_seconds_count{route="/"} 4\n', exposition)
+        self.assertIn('test_seconds_count{route="/about/"} 1\n', exposition)
+
+    def test_gauge(self):
+        """ Test that gauges are read at scrape time and failures skipped. """
+        registry = MetricsRegistry()
+        depth = {'queued': 3}
+        registry.gauge('test_jobs', 'Jobs.', lambda: dict(((status,), count)
+                                                          for status, count in depth.items()),
+                       ('status',))
+        registry.gauge('test_broken', 'Broken.', lambda: 1 / 0)
+        self.assertIn('test_jobs{status="queued"} 3\n', registry.exposition())
+        depth['queued'] = 1
+        exposition = registry.exposition()
+        self.assertIn('test_jobs{status="queued"} 1\n', exposition)
+        self.assertNotIn('test_broken 0', exposition)
+
+    def test_query_stats(self):
+        """ Test that the current thread's queries are counted. """
+        reset_query_stats()
+        Source.count()
+        Source.all()
+        count, seconds = query_stats()
+        self.assertEqual(count, 2)
+        self.assertTrue(seconds > 0)
+        reset_query_stats()
+        self.assertEqual(query_stats(), (0, 0.0))
+        DB_SESSION.remove()
@@ -10,16 +10,20 @@
 # about the terms of this license.
 """ Tests for the classes in model.py. """
 import os.path
+import shutil
+import tempfile
 from datetime import datetime
 import unittest
 
 import dateutil.parser
+from sqlalchemy import create_engine
 
 from corptest.const import JISC_BUCKET
 from corptest.model_sources import SCHEMES, ByteSequence, Source, FormatTool
 from corptest.model_sources import SourceIndex, Key, DB_SESSION
 from corptest.utilities import ObjectJsonEncoder
 from corptest.format_tools import FormatToolRelease, get_format_tool_instance
+from corptest.model_properties import upgrade_db
 from corptest.sources import FileSystem, SourceKey
 
 from tests.const import THIS_DIR, TEST_DESCRIPTION, TEST_BUCKET_NAME
@@ -359,3 +363,26 @@ def test_format_tool_release(session):# pylint: disable-msg=W0621, W0613
         assert _tool == _tool_check
         _tool_check = FormatToolRelease.by_tool_and_version(_tool.format_tool, _tool.version)
         assert _tool == _tool_check
+
+def test_upgrade_db():
+    """Test that columns added since a database was created are added to it
+    and backfilled, and that upgrading again changes nothing."""
+    root = tempfile.mkdtemp()
+    engine = create_engine('sqlite:///' + os.path.join(root, 'legacy.db'))
+    try:
+        engine.execute('CREATE TABLE source_index (id INTEGER PRIMARY KEY, ' +
+                       'source_id INTEGER NOT NULL, root_key VARCHAR(2048) NOT NULL, ' +
+                       'timestamp DATETIME NOT NULL)')
+        engine.execute("INSERT INTO source_index VALUES (1, 1, '', '2017-01-02 03:04:05')")
+        engine.execute('CREATE TABLE key (id INTEGER PRIMARY KEY, ' +
+                       'source_index_id INTEGER NOT NULL, path VARCHAR(2048) NOT NULL)')
+        upgrade_db(engine)
+        upgrade_db(engine)
+        assert engine.execute('SELECT completed, partial FROM source_index').fetchall() == \
+            [('2017-01-02 03:04:05', 0)]
+        assert engine.execute('SELECT key_group FROM key').fetchall() == []
+        assert [row[1] for row in engine.execute('PRAGMA index_list(key)')] == \
+            ['ix_key_index_group']
+    finally:
+        engine.dispose()
+        shutil.rmtree(root)
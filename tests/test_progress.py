@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+""" Tests for the index progress counters in progress.py. """
+import time
+import unittest
+
+from corptest.progress import IndexProgress, ProgressRegistry, MEGABYTE
+from corptest.progress import current_progress, record_downloaded, record_hashed, tracking
+
+class IndexProgressTestCase(unittest.TestCase):
+    """ Test cases for the IndexProgress class. """
+    def test_counters(self):
+        """ Test that counters are only published when flushed. """
+        registry = ProgressRegistry()
+        progress = IndexProgress(1, registry, flush_interval=3600)
+        progress.key_listed()
+        progress.key_processed(10, ['Tool 1', 'Tool 2'])
+        snapshot = registry.get(1)
+        self.assertEqual(snapshot['processed'], 1)
+        self.assertEqual(snapshot['identified'], {'Tool 1': 1, 'Tool 2': 1})
+        progress.key_processed(20, ['Tool 1'])
+        progress.error()
+        self.assertEqual(registry.get(1)['processed'], 1)
+        progress.flush('completed')
+        snapshot = registry.get(1)
+        self.assertEqual(snapshot['status'], 'completed')
+        self.assertEqual(snapshot['listed'], 1)
+        self.assertEqual(snapshot['processed'], 2)
+        self.assertEqual(snapshot['processed_bytes'], 30)
+        self.assertEqual(snapshot['errors'], 1)
+        self.assertEqual(snapshot['identified']['Tool 1'], 2)
+        registry.remove(1)
+        self.assertIsNone(registry.get(1))
+
+    def test_throughput_and_eta(self):
+        """ Test the rolling rates and that the ETA waits for the listing. """
+        progress = IndexProgress(2, ProgressRegistry(), flush_interval=3600)
+        progress.listed = 30
+        progress.flush()
+        time.sleep(0.1)
+        progress.processed, progress.processed_bytes = 10, 10 * MEGABYTE
+        progress.flush()
+        snapshot = progress.snapshot()
+        self.assertGreater(snapshot['files_per_sec'], 0)
+        self.assertGreater(snapshot['mb_per_sec'], 0)
+        self.assertIsNone(snapshot['eta_seconds'])
+        progress.listing_complete = True
+        snapshot = progress.snapshot()
+        self.assertAlmostEqual(snapshot['eta_seconds'], 20 / snapshot['files_per_sec'], delta=1)
+
+    def test_tracking(self):
+        """ Test that bytes are recorded against the current thread's progress. """
+        progress = IndexProgress(3, ProgressRegistry())
+        record_hashed(10)
+        self.assertIsNone(current_progress())
+        with tracking(progress):
+            self.assertIs(current_progress(), progress)
+            record_hashed(10)
+            record_downloaded(5)
+        self.assertIsNone(current_progress())
+        self.assertEqual(progress.hashed_bytes, 10)
+        self.assertEqual(progress.downloaded_bytes, 5)
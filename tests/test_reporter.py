@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+""" Tests for the report serialisations in reporter.py. """
+import csv
+import json
+import os.path
+import zlib
+from xml.etree import ElementTree
+from datetime import datetime
+
+import dateutil.parser
+import pytest
+
+from corptest import APP
+from corptest.controller import RESPONSE_CACHE
+from corptest.model_sources import SCHEMES, Source, SourceIndex, Key, FormatToolRelease
+from corptest.model_properties import ByteSequenceProperty, Property, PropertyValue
+from corptest.reporter import json_report_generator, xml_report_generator, report_to_dict
+from corptest.reporter import ndjson_report_generator, csv_report_generator
+from corptest.sources import FileSystem
+
+from tests.const import THIS_DIR, TEST_DESCRIPTION
+from tests.conf_test import db, session, app# pylint: disable-msg=W0611
+from tests.conf_test import delete_test_rows
+
+TEST_BYTES_ROOT = os.path.join(THIS_DIR, "content-corpus")
+
+@pytest.fixture
+def report(session):# pylint: disable-msg=W0621, W0613
+    """Index the content corpus with a single test property per byte sequence,
+    removing the index's rows afterwards."""
+    file_system_source = Source("report.test", "Report Test", TEST_DESCRIPTION,
+                                SCHEMES['FILE'], TEST_BYTES_ROOT)
+    report_index = SourceIndex(file_system_source, datetime.now())
+    report_index.put()
+    byte_sequences = set()
+    try:
+        file_system = FileSystem(file_system_source)
+        release = FormatToolRelease.all()[0]
+        prop = Property.putdate('MIME')
+        prop_val = PropertyValue.putdate('text/plain')
+        for source_key in file_system.all_file_keys():
+            _, byte_seq = file_system.get_path_and_byte_seq(source_key)
+            Key(report_index, source_key.value, source_key.size,
+                dateutil.parser.parse(source_key.last_modified), byte_seq).put()
+            byte_sequences.add(byte_seq)
+            ByteSequenceProperty.putdate(byte_seq, release, prop, prop_val)
+        yield report_index
+    finally:
+        delete_test_rows(file_system_source, [report_index], byte_sequences)
+
+def test_json_report_generator(report):# pylint: disable-msg=W0621
+    """Test that the streamed JSON report matches report_to_dict, in small batches."""
+    expected = json.loads(json.dumps(report_to_dict(report)))
+    streamed = json.loads(''.join(json_report_generator(report, batch_size=1)))
+    assert streamed['Source'] == expected['Source']
+    assert streamed['Root'] == expected['Root']
+    assert len(streamed['Keys']) == report.key_count
+    assert sorted(streamed['Keys'], key=lambda key: key['Path']) == \
+        sorted(expected['Keys'], key=lambda key: key['Path'])
+
+def test_xml_report_generator(report):# pylint: disable-msg=W0621
+    """Test that the streamed XML report parses and holds every key."""
+    expected = report_to_dict(report)
+    root = ElementTree.fromstring(b''.join(xml_report_generator(report, batch_size=1)))
+    assert root.tag == 'report'
+    assert root.get('source') == expected['Source']
+    assert root.get('root') == expected['Root']
+    keys = root.findall('key')
+    assert len(keys) == report.key_count
+    for key in keys:
+        byte_sequence = key.find('byteSequence')
+        assert len(byte_sequence.get('sha1')) == 40
+        for prop in byte_sequence.findall('property'):
+            assert prop.get('name').endswith(':MIME')
+            assert prop.text == 'text/plain'
+
+def test_ndjson_report_generator(report):# pylint: disable-msg=W0621
+    """Test that the NDJSON report has one flat record per key."""
+    lines = ''.join(ndjson_report_generator(report, batch_size=1)).splitlines()
+    assert len(lines) == report.key_count
+    for line in lines:
+        record = json.loads(line)
+        assert len(record['SHA1']) == 40
+        assert [value for name, value in record.items() if name.endswith(':MIME')] == \
+            ['text/plain']
+
+def test_csv_report_generator(report):# pylint: disable-msg=W0621
+    """Test that the CSV report has a header, a row per key and a column per property."""
+    rows = list(csv.reader(''.join(csv_report_generator(report, batch_size=1)).splitlines()))
+    header = rows[0]
+    assert header[:4] == ['Path', 'Size', 'SHA1', 'Byte sequence size']
+    assert len(rows) == report.key_count + 1
+    mime_column = [name for name in header if name.endswith(':MIME')][0]
+    for row in rows[1:]:
+        assert row[header.index(mime_column)] == 'text/plain'
+
+def test_conditional_report(report):# pylint: disable-msg=W0621
+    """Test that completed reports are cached and revalidated with 304s."""
+    report.complete()
+    RESPONSE_CACHE.clear()
+    url = '/api/report/{}/'.format(report.id)
+    headers = {'Accept': 'application/json'}
+    with APP.test_client() as client:
+        first = client.get(url, headers=headers)
+        assert first.status_code == 200
+        etag = first.headers['ETag']
+        assert first.headers['Last-Modified']
+        assert first.headers['Cache-Control'] == 'no-cache'
+        assert json.loads(first.data.decode('utf-8'))['Keys']
+        assert len(RESPONSE_CACHE) == 1
+
+        cached = client.get(url, headers=headers)
+        assert cached.status_code == 200
+        assert cached.data == first.data
+        assert cached.headers['ETag'] == etag
+
+        headers['If-None-Match'] = etag
+        not_modified = client.get(url, headers=headers)
+        assert not_modified.status_code == 304
+        assert not not_modified.data
+
+        del headers['If-None-Match']
+        headers['If-Modified-Since'] = first.headers['Last-Modified']
+        assert client.get(url, headers=headers).status_code == 304
+
+        headers = {'Accept': 'text/xml', 'If-None-Match': etag}
+        assert client.get(url, headers=headers).status_code == 200
+
+def test_compressed_report(report):# pylint: disable-msg=W0621
+    """Test that reports are gzipped for clients that accept it and that the
+    compressed body is cached under its own ETag."""
+    report.complete()
+    RESPONSE_CACHE.clear()
+    url = '/api/report/{}/'.format(report.id)
+    with APP.test_client() as client:
+        plain = client.get(url, headers={'Accept': 'application/x-ndjson'})
+        headers = {'Accept': 'application/x-ndjson', 'Accept-Encoding': 'gzip'}
+        first = client.get(url, headers=headers)
+        assert first.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in first.headers['Vary']
+        assert zlib.decompress(first.data, 16 + zlib.MAX_WBITS) == plain.data
+        assert first.headers['ETag'] != plain.headers['ETag']
+        cached = client.get(url, headers=headers)
+        assert cached.headers['Content-Encoding'] == 'gzip'
+        assert cached.data == first.data
+        assert len(RESPONSE_CACHE) == 2
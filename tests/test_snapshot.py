@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# JISC Format Sniffing
+# Copyright (C) 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+""" Tests for the classes in snapshot.py. """
+import os.path
+import shutil
+import tempfile
+from datetime import datetime
+
+import dateutil.parser
+
+from corptest.model_sources import SCHEMES, Source, SourceIndex, Key
+from corptest.snapshot import export_snapshot, Snapshot
+from corptest.sources import FileSystem
+
+from tests.const import THIS_DIR, TEST_DESCRIPTION
+from tests.conf_test import db, session, app# pylint: disable-msg=W0611
+from tests.conf_test import delete_test_rows
+
+TEST_READABLE_ROOT = os.path.join(THIS_DIR, "disk-corpus")
+
+def test_export_and_load(session):# pylint: disable-msg=W0621, W0613
+    """Test that an exported snapshot loads with the index's keys and sizes."""
+    file_system_source = Source("snapshot.test", "Snapshot Test", TEST_DESCRIPTION,
+                                SCHEMES['FILE'], TEST_READABLE_ROOT)
+    file_system_index = SourceIndex(file_system_source, datetime.now())
+    file_system_index.put()
+    file_system = FileSystem(file_system_source)
+    paths = []
+    dest = tempfile.mkdtemp()
+    try:
+        for key in file_system.all_file_keys():
+            paths.append(key.value)
+            Key(file_system_index, key.value, key.size,
+                dateutil.parser.parse(key.last_modified)).put()
+        export_snapshot(file_system_index, dest)
+        snapshot = Snapshot(dest, mmap_mode='r')
+        assert snapshot.row_count == file_system_index.key_count
+        assert int(snapshot.sizes.sum()) == (file_system_index.size or 0)
+        assert list(snapshot.paths()) == sorted(paths)
+        distribution = snapshot.extension_distribution()
+        assert sum(count for _, count, _ in distribution) == snapshot.row_count
+        assert snapshot.tool_codes(0, 'MIME') is None
+        assert not snapshot.mask_for_value(0, 'MIME', 'text/plain').any()
+    finally:
+        shutil.rmtree(dest)
+        delete_test_rows(file_system_source, [file_system_index], [])
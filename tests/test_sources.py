@@ -9,12 +9,16 @@
 # License, Version 3. See the text file "COPYING" for further details
 # about the terms of this license.
 """ Tests for the classes in sources.py. """
+from datetime import datetime
 import os.path
+import shutil
+import tempfile
 import unittest
 
 from corptest.const import JISC_BUCKET
 from corptest.model_sources import SCHEMES, Source
-from corptest.sources import SourceKey, AS3Bucket, FileSystem
+from corptest.sources import SourceKey, AS3Bucket, FileSystem, SourceRegistry
+from corptest.sources import SORT_MODIFIED, SORT_NAME, SORT_SIZE, MAX_LISTING_OFFSET
 from tests.const import THIS_DIR, TEST_DESCRIPTION, TEST_NAME, TEST_NAMESPACE
 
 TEST_ROOT = "__root__"
@@ -141,6 +145,47 @@ class AS3BucketTestCase(unittest.TestCase):
                                                'ff-t5k-jses.tar.gz'),
                                   False) in listed_folders)
 
+class StubBucket(AS3Bucket):
+    """ AS3Bucket listing a fixed set of object keys in S3's order, files and
+    common prefixes each sorted by their bytes, trailing slashes included. """
+    OBJECT_KEYS = ['a/1', 'a/b/1', 'a-b/1', 'a-b/2', 'a0/1', 'ab/1', 'top']
+
+    @classmethod
+    def validate_bucket(cls, bucket_name):
+        return True
+
+    @staticmethod
+    def _list_object_pages(bucket='', prefix='/', delimeter='/', start_after=None,
+                           max_keys=None):
+        contents, prefixes = [], set()
+        for value in StubBucket.OBJECT_KEYS:
+            if not value.startswith(prefix):
+                continue
+            rest = value[len(prefix):]
+            if '/' in rest:
+                prefixes.add(prefix + rest.split('/')[0] + '/')
+            else:
+                contents.append({'Key': value, 'Size': 1, 'ETag': '"etag"',
+                                 'LastModified': datetime(2017, 1, 1)})
+        yield {'Contents': sorted(contents, key=lambda obj: obj['Key'].encode('utf-8')),
+               'CommonPrefixes': [{'Prefix': common_prefix} for common_prefix in
+                                  sorted(prefixes, key=lambda value: value.encode('utf-8'))]}
+
+class AS3BucketListingTestCase(unittest.TestCase):
+    """ Test cases for AS3Bucket listings against a stubbed bucket. """
+    def test_list_files_start_after(self):
+        """ Test that S3 files are listed in listing order and can be resumed,
+        although S3 lists a-b/ before a/. """
+        bucket = StubBucket(Source(TEST_NAMESPACE, TEST_NAME, TEST_DESCRIPTION,
+                                   SCHEMES['AS3'], 'stub-bucket'))
+        listed_files = [key.value for key in bucket.list_files(recurse=True)]
+        self.assertEqual(sorted(listed_files), sorted(StubBucket.OBJECT_KEYS))
+        self.assertEqual(listed_files, sorted(listed_files, key=AS3Bucket.listing_order))
+        for index, value in enumerate(listed_files):
+            resumed = [key.value for key in bucket.list_files(recurse=True,
+                                                              start_after=value)]
+            self.assertEqual(resumed, listed_files[index + 1:])
+
 class SourceTestCase(unittest.TestCase):
     """ Test cases for the FileSystem class and methods. """
     def test_null_namespace(self):
@@ -194,6 +239,39 @@ class SourceTestCase(unittest.TestCase):
         self.assertEqual(file_system_source.location, TEST_READABLE_ROOT, \
         'file_system_source.root should equal test instance TEST_READABLE_ROOT')
 
+class SourceRegistryTestCase(unittest.TestCase):
+    """ Test cases for the SourceRegistry class. """
+    def test_pooling(self):
+        """ Test that handles are reused until the source changes or expires. """
+        source = Source(TEST_NAMESPACE, TEST_NAME, TEST_DESCRIPTION, SCHEMES['FILE'],
+                        TEST_READABLE_ROOT)
+        registry = SourceRegistry(60)
+        self.assertIsNot(registry.get(source), registry.get(source))
+        source.id = 1
+        handle = registry.get(source)
+        self.assertIs(registry.get(source), handle)
+        self.assertEqual(len(registry), 1)
+        source.location = THIS_DIR
+        moved = registry.get(source)
+        self.assertIsNot(moved, handle)
+        self.assertEqual(moved.file_system.location, THIS_DIR)
+        registry.invalidate(1)
+        self.assertIsNot(registry.get(source), moved)
+        unpooled = SourceRegistry(0)
+        self.assertIsNot(unpooled.get(source), unpooled.get(source))
+
+    def test_invalid_source(self):
+        """ Test that sources that can't be validated aren't pooled. """
+        source = Source(TEST_NAMESPACE, TEST_NAME, TEST_DESCRIPTION, SCHEMES['FILE'],
+                        os.path.join(THIS_DIR, 'no-such-folder'))
+        source.id = 1
+        registry = SourceRegistry(60)
+        with self.assertRaises(ValueError):
+            registry.get(source)
+        self.assertEqual(len(registry), 0)
+        with self.assertRaises(ValueError):
+            SourceRegistry(-1)
+
 class FileSystemTestCase(unittest.TestCase):
     """Tests for Source class."""
     def test_not_dir_root(self):
@@ -285,6 +363,98 @@ class FileSystemTestCase(unittest.TestCase):
         self.assertTrue(SourceKey(os.path.join('folder-key-2', 'sub-folder-key-2',
                                                'file-key-1'), False) in listed_files)
 
+    def test_list_page(self):
+        """ Test sorted, paged folder listings. """
+        root = tempfile.mkdtemp()
+        try:
+            for name, size, mtime in (('b.txt', 30, 1000), ('a.txt', 10, 3000),
+                                      ('c.txt', 20, 2000)):
+                with open(os.path.join(root, name), 'wb') as _file:
+                    _file.write(b'x' * size)
+                os.utime(os.path.join(root, name), (mtime, mtime))
+            os.mkdir(os.path.join(root, 'a'))
+            os.mkdir(os.path.join(root, 'z'))
+            file_system = FileSystem(Source(TEST_NAMESPACE, TEST_NAME, TEST_DESCRIPTION,
+                                            SCHEMES['FILE'], root))
+            pages, cursor = [], None
+            while True:
+                page = file_system.list_page(page_size=2, cursor=cursor)
+                pages.append([key.name for key in page.keys])
+                cursor = page.next_cursor
+                if cursor is None:
+                    break
+            self.assertEqual(pages, [['a.txt', 'a'], ['b.txt', 'c.txt'], ['z']])
+            pages, cursor = [], None
+            while True:
+                page = file_system.list_page(descending=True, page_size=2, cursor=cursor)
+                pages.append([key.name for key in page.keys])
+                cursor = page.next_cursor
+                if cursor is None:
+                    break
+            self.assertEqual(pages, [['z', 'c.txt'], ['b.txt', 'a'], ['a.txt']])
+            # Name order pages only stat their own files
+            file_key, stats = file_system._file_key, []
+            def _counting_file_key(prefix, entry):
+                stats.append(entry.name)
+                return file_key(prefix, entry)
+            file_system._file_key = _counting_file_key
+            page = file_system.list_page(page_size=1, offset=2)
+            self.assertEqual([(key.name, key.size) for key in page.keys], [('b.txt', 30)])
+            self.assertEqual(stats, ['b.txt', 'c.txt'])
+            del file_system._file_key
+            page = file_system.list_page(descending=True, page_size=2, offset=4)
+            self.assertEqual(([key.name for key in page.keys], page.next_cursor), (['a.txt'], None))
+            page = file_system.list_page(sort=SORT_SIZE, descending=True, page_size=10)
+            self.assertEqual([key.name for key in page.keys], ['z', 'a', 'b.txt', 'c.txt', 'a.txt'])
+            self.assertIsNone(page.next_cursor)
+            page = file_system.list_page(sort=SORT_MODIFIED, page_size=2, offset=2)
+            self.assertEqual([key.name for key in page.keys], ['b.txt', 'c.txt'])
+            page = file_system.list_page(sort=SORT_MODIFIED, page_size=2, cursor=page.next_cursor)
+            self.assertEqual([key.name for key in page.keys], ['a.txt'])
+            with self.assertRaises(ValueError):
+                file_system.list_page(cursor='not a cursor')
+            with self.assertRaises(ValueError):
+                file_system.list_page(sort='colour')
+            for sort in (SORT_NAME, SORT_SIZE):
+                with self.assertRaises(ValueError):
+                    file_system.list_page(sort=sort, offset=MAX_LISTING_OFFSET + 1)
+        finally:
+            shutil.rmtree(root)
+
+    def test_list_files_start_after(self):
+        """ Test that files are listed in listing order and can be resumed. """
+        file_system_source = Source(TEST_NAMESPACE, TEST_NAME, TEST_DESCRIPTION,
+                                    SCHEMES['FILE'], TEST_READABLE_ROOT)
+        file_system = FileSystem(file_system_source)
+        listed_files = [key.value for key in file_system.list_files(recurse=True)]
+        self.assertEqual(listed_files, sorted(listed_files, key=FileSystem.listing_order))
+        self.assertEqual(listed_files[:3], [os.path.join('folder-key-1', 'file-key-1'),
+                                            os.path.join('folder-key-1', 'file-key-2'),
+                                            os.path.join('folder-key-1', 'sub-folder-key-1',
+                                                         'file-key-1')])
+        for index, value in enumerate(listed_files):
+            resumed = [key.value for key in file_system.list_files(recurse=True,
+                                                                   start_after=value)]
+            self.assertEqual(resumed, listed_files[index + 1:])
+
+    def test_stream_key(self):
+        """ Test that whole files and byte ranges are streamed in chunks. """
+        root = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(root, 'stream.bin'), 'wb') as _file:
+                _file.write(b'0123456789')
+            file_system = FileSystem(Source(TEST_NAMESPACE, TEST_NAME, TEST_DESCRIPTION,
+                                            SCHEMES['FILE'], root))
+            key = file_system.get_key('stream.bin')
+            self.assertEqual(list(file_system.stream_key(key, chunk_size=4)),
+                             [b'0123', b'4567', b'89'])
+            self.assertEqual(b''.join(file_system.stream_key(key, 2, 5)), b'234')
+            self.assertEqual(b''.join(file_system.stream_key(key, 8, 20)), b'89')
+            with self.assertRaises(ValueError):
+                file_system.stream_key(SourceKey('folder/'))
+        finally:
+            shutil.rmtree(root)
+
     def test_filter_files(self):
         """ Test case for listing file system keys. """
         file_system_source = Source(TEST_NAMESPACE, TEST_NAME, TEST_DESCRIPTION,